@@ -13,10 +13,17 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+import os
+import shutil
 import sys
+import tempfile
+import time
 from unittest import mock
 import uuid
 
+from oslo_utils import units
+
 from cinder import context
 from cinder import exception
 from cinder.tests.unit import test
@@ -35,8 +42,230 @@ UNMANAGE_PREFIX = datera.datc.UNMANAGE_PREFIX
 DateraAPIException = datera.datc.DateraAPIException
 
 
+class FakeSdkExceptions(object):
+    """Stands in for dfs_sdk.exceptions, which is mocked out above"""
+
+    class ApiNotFoundError(Exception):
+        pass
+
+    class ApiConflictError(Exception):
+        pass
+
+    class ApiAuthError(Exception):
+        pass
+
+    class ApiInvalidRequestError(Exception):
+        pass
+
+
+class FakeEntity(dict):
+    """An entity of FakeCluster, with attribute access like SDK entities
+
+    Sub-endpoints are attributes, so ai.storage_instances is an endpoint
+    while ai['storage_instances'] is the body the cluster returned.
+    """
+
+    def __init__(self, cluster, path, data):
+        super(FakeEntity, self).__init__(data, path=path)
+        self.cluster = cluster
+        self.context = cluster.context
+        self.endpoint = None
+        cluster.entities[path] = self
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def set(self, tenant=None, **kwargs):
+        self.cluster.send('PUT', self['path'])
+        kwargs.pop('force', None)
+        self.update(kwargs)
+        return self
+
+    def reload(self, tenant=None):
+        self.cluster.send('GET', self['path'])
+        return self
+
+    def delete(self, tenant=None, **kwargs):
+        self.cluster.send('DELETE', self['path'])
+        self.endpoint.remove(self)
+
+
+class FakeCollection(object):
+    """A collection endpoint of FakeCluster, eg. /app_instances"""
+
+    def __init__(self, cluster, path, build=None):
+        self.cluster = cluster
+        self.path = path
+        self.build = build
+        self.entities = collections.OrderedDict()
+
+    def add(self, entity_id, data):
+        entity = FakeEntity(self.cluster, '{}/{}'.format(self.path, entity_id),
+                            dict(data, id=entity_id))
+        entity.endpoint = self
+        self.entities[entity_id] = entity
+        return entity
+
+    def remove(self, entity):
+        del self.entities[entity['id']]
+
+    def create(self, tenant=None, **kwargs):
+        self.cluster.send('POST', self.path)
+        if self.build:
+            return self.build(self, tenant, **kwargs)
+        entity_id = kwargs.get('id') or kwargs['name']
+        if entity_id in self.entities:
+            raise FakeSdkExceptions.ApiConflictError(entity_id)
+        return self.add(entity_id, dict(kwargs, tenant=tenant))
+
+    def get(self, entity_id, tenant=None):
+        self.cluster.send('GET', '{}/{}'.format(self.path, entity_id))
+        try:
+            return self.entities[entity_id]
+        except KeyError:
+            raise FakeSdkExceptions.ApiNotFoundError(entity_id)
+
+    def list(self, tenant=None, filter=None, offset=0, limit=None, **kwargs):
+        self.cluster.send('GET', self.path)
+        entities = list(self.entities.values())
+        if filter:
+            # The driver only filters by match(name,.*<cinder id>.*)
+            cid = filter[len('match(name,.*'):-len('.*)')]
+            entities = [e for e in entities if cid in e['name']]
+        return entities[offset:][:limit]
+
+
+class FakeSingleton(object):
+    """An endpoint of FakeCluster holding one entity, eg. acl_policy"""
+
+    def __init__(self, cluster, path, data=None):
+        self.cluster = cluster
+        self.path = path
+        self.entity = None
+        if data is not None:
+            self._store(data)
+
+    def _store(self, data):
+        self.entity = FakeEntity(self.cluster, self.path, data)
+        self.entity.endpoint = self
+        return self.entity
+
+    def remove(self, entity):
+        self.entity = None
+
+    def create(self, tenant=None, **kwargs):
+        self.cluster.send('POST', self.path)
+        return self._store(kwargs)
+
+    def get(self, tenant=None):
+        self.cluster.send('GET', self.path)
+        if self.entity is None:
+            raise FakeSdkExceptions.ApiNotFoundError(self.path)
+        return self.entity
+
+    def set(self, tenant=None, **kwargs):
+        self.cluster.send('PUT', self.path)
+        if self.entity is None:
+            return self._store(kwargs)
+        self.entity.update(kwargs)
+        return self.entity
+
+
+class FakeCluster(object):
+    """Stands in for the dfs_sdk api object, keeping what is done to it
+
+    Each SDK call goes out as one request through context.connection, so
+    the request hooks the driver installs see them as they would real
+    requests.  Sent requests are recorded as (method, path).
+    """
+
+    CREATE_SCHEMA = {
+        'template_override': {},
+        'storage_instances': {'items': {'properties': {'volumes': {
+            'items': {'properties': {'performance_policy': {}}}}}}}}
+
+    def __init__(self):
+        self.requests = []
+        # Path --> entity, for dfs_sdk.base.Entity
+        self.entities = {}
+        self.context = mock.Mock()
+        self.context.connection._http_connect_request = self._request
+        self.api = FakeSingleton(self, '/api', {'/app_instances': {
+            'create': {'bodyParamSchema': {
+                'properties': self.CREATE_SCHEMA}}}})
+        self.tenants = FakeCollection(self, '/tenants')
+        self.initiators = FakeCollection(self, '/initiators')
+        self.app_instances = FakeCollection(
+            self, '/app_instances', build=self._create_app_instance)
+        self.snapshot_ts = 1524686547
+
+    def _request(self, method, urlpath, **kwargs):
+        self.requests.append((method, urlpath))
+        return {}, 200, 'OK', {}
+
+    def send(self, method, urlpath):
+        return self.context.connection._http_connect_request(method, urlpath)
+
+    def entity(self, context, data, name, path):
+        return self.entities[path]
+
+    def _create_app_instance(self, endpoint, tenant, **params):
+        ai_id = params.get('uuid') or str(uuid.uuid4())
+        ai = endpoint.add(ai_id, {
+            'name': params['name'], 'tenant': tenant,
+            'admin_state': 'offline',
+            'app_template': params.get('app_template', {'path': ''})})
+        ai.storage_instances = FakeCollection(
+            self, ai['path'] + '/storage_instances')
+        ai.metadata = FakeSingleton(self, ai['path'] + '/metadata', {})
+        si = ai.storage_instances.add('storage-1', {
+            'name': 'storage-1', 'op_state': 'available',
+            'access': {'ips': ['172.28.41.63', '172.28.41.64'],
+                       'iqn': 'iqn.2013-05.com.daterainc:' + ai_id}})
+        si.volumes = FakeCollection(self, si['path'] + '/volumes')
+        si.acl_policy = FakeSingleton(
+            self, si['path'] + '/acl_policy',
+            {'initiators': [], 'initiator_groups': []})
+        si.auth = FakeSingleton(self, si['path'] + '/auth', {})
+        if 'clone_volume_src' in params:
+            vparams = {'size': self.entities[
+                params['clone_volume_src']['path']]['size']}
+        else:
+            vparams = params['storage_instances'][0]['volumes'][0]
+        vol = si.volumes.add('volume-1', {'name': 'volume-1',
+                                          'size': vparams['size']})
+        vol.snapshots = FakeCollection(
+            self, vol['path'] + '/snapshots', build=self._create_snapshot)
+        vol.performance_policy = FakeSingleton(
+            self, vol['path'] + '/performance_policy',
+            vparams.get('performance_policy'))
+        si['volumes'] = [vol]
+        ai['storage_instances'] = [si]
+        return ai
+
+    def _create_snapshot(self, endpoint, tenant, **params):
+        self.snapshot_ts += 1
+        utc_ts = '{}.000000000'.format(self.snapshot_ts)
+        return endpoint.add(utc_ts, dict(params, utc_ts=utc_ts,
+                                         op_state='available'))
+
+
 class DateraVolumeTestCasev22(test.TestCase):
 
+    # Requests to the cluster each operation makes, see test_call_counts
+    CALL_COUNTS = {
+        'create_volume': 3,
+        'extend_volume': 4,
+        'create_export': 11,
+        'initialize_connection': 3,
+        'create_snapshot': 5,
+        'delete_snapshot': 5,
+        'detach_volume': 4,
+        'delete_volume': 6}
+
     def setUp(self):
         self.cfg = mock.Mock(spec=conf.Configuration)
         self.cfg.san_ip = '127.0.0.1'
@@ -52,6 +281,15 @@ class DateraVolumeTestCasev22(test.TestCase):
         self.cfg.driver_client_cert = None
         self.cfg.driver_client_cert_key = None
         self.cfg.datera_disable_profiler = False
+        self.cfg.datera_profile_sample_rate = 0
+        self.cfg.datera_profile_slow_after = 30
+        self.cfg.datera_profile_signal = None
+        self.cfg.datera_metrics_file = None
+        self.cfg.datera_metrics_interval = 15
+        self.cfg.datera_metrics_port = 0
+        self.cfg.datera_metrics_host = '127.0.0.1'
+        self.cfg.safe_get.side_effect = {
+            'volume_backend_name': 'Datera'}.get
         self.cfg.datera_ldap_server = ""
         self.cfg.datera_volume_type_defaults = {}
         self.cfg.datera_disable_template_override = False
@@ -63,8 +301,44 @@ class DateraVolumeTestCasev22(test.TestCase):
         self.cfg.use_chap_auth = False
         self.cfg.chap_username = ""
         self.cfg.chap_password = ""
+        self.cfg.datera_deferred_delete = False
+        self.cfg.datera_deferred_delete_journal = None
+        self.cfg.datera_deferred_delete_interval = 10
+        self.cfg.datera_deferred_delete_batch = 5
+        self.cfg.datera_deferred_delete_max_attempts = 10
+        self.cfg.datera_stats_refresh_interval = 0
+        self.cfg.datera_stats_refresh_timeout = 30
+        self.cfg.datera_stats_stale_after = 300
+        self.cfg.datera_placement_pools = False
+        self.cfg.datera_qos_rebalance_interval = 0
+        self.cfg.datera_qos_rebalance_concurrency = 4
+        self.cfg.datera_qos_rebalance_rate = 0
+        self.cfg.datera_qos_rebalance_dry_run = False
+        self.cfg.datera_clusters = {}
+        self.cfg.datera_health_probe_interval = 0
+        self.cfg.datera_health_probe_timeout = 10
+        self.cfg.datera_health_degraded_latency = 1000
+        self.cfg.datera_operation_deadline = 300
+        self.cfg.datera_operation_deadlines = {}
+        self.cfg.datera_circuit_breaker_threshold = 5
+        self.cfg.datera_circuit_breaker_reset = 30
+        self.cfg.datera_hedge_gets = False
+        self.cfg.datera_hedge_max_rate = 0.05
+        self.cfg.datera_hedge_endpoints = []
+        self.cfg.datera_api_concurrency = 0
+        self.cfg.datera_request_budgets = {'bulk': '4'}
+        self.cfg.datera_list_page_size = 100
+        self.cfg.datera_list_fields = False
+        self.cfg.datera_token_renew_after = 0
+        self.cfg.datera_token_cache = None
+        self.cfg.datera_invalidation_url = None
+        self.cfg.datera_call_budgets = {}
 
         super(DateraVolumeTestCasev22, self).setUp()
+        shared_patcher = mock.patch.dict(datera.datc.SHARED_CLUSTERS,
+                                         clear=True)
+        shared_patcher.start()
+        self.addCleanup(shared_patcher.stop)
         mock_exec = mock.Mock()
         mock_exec.return_value = ('', '')
 
@@ -117,6 +391,759 @@ class DateraVolumeTestCasev22(test.TestCase):
         self.assertIsNone(self.driver.create_volume(mock_volume))
         self.assertTrue(mock_get_type.called)
 
+    @mock.patch.object(datera.datc.dfs_sdk.base, 'Entity')
+    @mock.patch.object(volume_types, 'get_volume_type')
+    def test_create_volume_reuses_created_ai(self, mock_get_type,
+                                             mock_entity):
+        mock_get_type.return_value = _stub_volume_type(
+            {'DF:iops_per_gb': '10', 'DF:total_iops_max': '1000'})
+        testvol = _stub_volume(volume_type_id='type-id', size=5)
+        aimock = self.driver.api.app_instances.create.return_value
+        self.driver._create_volume_2_2(testvol)
+        # Neither QoS nor metadata should search for the new volume
+        self.driver.api.app_instances.list.assert_not_called()
+        aimock.storage_instances.list.assert_not_called()
+        mock_entity.return_value.performance_policy.create.\
+            assert_called_once_with(tenant=mock.ANY, total_iops_max=50)
+        aimock.metadata.set.assert_called_once()
+
+    @mock.patch.object(datera.datc.dfs_sdk.base, 'Entity')
+    @mock.patch.object(volume_types, 'get_volume_type')
+    def test_create_volume_nested_qos(self, mock_get_type, mock_entity):
+        mock_get_type.return_value = _stub_volume_type(
+            {'DF:total_iops_max': '1000'})
+        testvol = _stub_volume(volume_type_id='type-id')
+        self.driver._support_nested_qos_2_2 = mock.Mock(return_value=True)
+        self.driver._create_volume_2_2(testvol)
+        create = self.driver.api.app_instances.create
+        vol = create.call_args[1]['storage_instances'][0]['volumes'][0]
+        self.assertEqual({'total_iops_max': 1000}, vol['performance_policy'])
+        mock_entity.assert_not_called()
+
+    def test_create_volume_pool_placement(self):
+        self.driver.placement_pools = True
+        testvol = _stub_volume()
+        testvol['host'] = 'host@datera#all-flash'
+        self.driver._create_volume_2_2(testvol)
+        create = self.driver.api.app_instances.create
+        vol = create.call_args[1]['storage_instances'][0]['volumes'][0]
+        self.assertEqual({'path': '/placement_policies/all-flash'},
+                         vol['placement_policy'])
+
+    def test_get_volume_stats_placement_pools(self):
+        self.driver.placement_pools = True
+        system = self.driver.api.system.get.return_value
+        system.sw_version = "3.3.3"
+        system.total_capacity = 100 * units.Gi
+        system.available_capacity = 60 * units.Gi
+        system.all_flash_total_capacity = 20 * units.Gi
+        system.all_flash_available_capacity = 5 * units.Gi
+        system.hybrid_total_capacity = 80 * units.Gi
+        system.hybrid_available_capacity = 55 * units.Gi
+        policies = []
+        for name in ('default', 'all-flash', 'hybrid', 'custom'):
+            policy = mock.Mock()
+            policy.name = name
+            policies.append(policy)
+        self.driver.api.placement_policies.list.return_value = policies
+        stats = self.driver._get_volume_stats_2_2(refresh=True)
+        self.driver.api.placement_policies.list.assert_called_once_with(
+            offset=0, limit=100)
+        self.assertEqual(
+            [('default', 100, 60), ('all-flash', 20, 5), ('hybrid', 80, 55),
+             ('custom', 'unknown', 'unknown')],
+            [(p['pool_name'], p['total_capacity_gb'], p['free_capacity_gb'])
+             for p in stats['pools']])
+
+    def test_get_volume_stats_background_refresh(self):
+        self.driver.stats_refresher = mock.Mock()
+        self.driver.cluster_stats = {'volume_backend_name': 'datera'}
+        self.driver.stats_updated = time.time() - 10
+        stats = self.driver._get_volume_stats_2_2(refresh=True)
+        self.driver.api.system.get.assert_not_called()
+        self.assertEqual('up', stats['backend_state'])
+        self.assertGreaterEqual(stats['stats_age'], 10)
+
+        self.driver.stats_updated = time.time() - 1000
+        stats = self.driver._get_volume_stats_2_2(refresh=True)
+        self.assertEqual('degraded', stats['backend_state'])
+
+    def test_health_probe_state(self):
+        health = datera.datc.HealthProbe(window=4)
+        self.assertIsNone(health.state(100))
+        self.assertEqual({}, health.summary())
+        for latency in (0.01, 0.02, 0.03):
+            health.record(latency)
+        self.assertEqual('up', health.state(100))
+        health.record(0.5)
+        self.assertEqual('degraded', health.state(100))
+        self.assertEqual({'probe_error_rate': 0.0,
+                          'probe_latency_p50_ms': 20.0,
+                          'probe_latency_p95_ms': 500.0,
+                          'probe_latency_p99_ms': 500.0},
+                         health.summary())
+        health.record(None)
+        self.assertEqual('degraded', health.state(1000))
+        health.record(None)
+        self.assertEqual('down', health.state(1000))
+        self.assertEqual(0.5, health.summary()['probe_error_rate'])
+
+    def test_health_probe_feeds_stats(self):
+        self.driver.stats_refresher = mock.Mock()
+        self.driver.cluster_stats = {'volume_backend_name': 'datera',
+                                     'pools': [{'pool_name': 'datera'}]}
+        self.driver.stats_updated = time.time()
+        self.driver._probe_health()
+        self.driver.api.system.get.side_effect = DateraAPIException
+        self.driver._probe_health()
+        stats = self.driver._get_volume_stats_2_2()
+        self.assertEqual('down', stats['backend_state'])
+        self.assertEqual(0.5, stats['probe_error_rate'])
+        self.assertIn('probe_latency_p95_ms', stats)
+        self.assertEqual('down', stats['pools'][0]['backend_state'])
+
+    def test_operation_deadline(self):
+        deadlines = []
+
+        def _create(volume):
+            deadlines.append(self.driver.thread_local.deadline)
+            # Operations called by another one don't restart the clock
+            self.driver.extend_volume(volume, 2)
+
+        self.driver.deadlines['create_volume'] = 30
+        self.driver._create_volume_2_2 = _create
+        self.driver._extend_volume_2_2 = lambda *args: deadlines.append(
+            self.driver.thread_local.deadline)
+        self.driver._extend_volume_2_1 = self.driver._extend_volume_2_2
+        self.driver._create_volume_2_1 = _create
+        self.driver.create_volume(_stub_volume())
+        self.assertEqual('create_volume', deadlines[0][0])
+        self.assertEqual(30, deadlines[0][2])
+        self.assertIs(deadlines[0], deadlines[1])
+        self.assertIsNone(self.driver.thread_local.deadline)
+
+        self.cfg.datera_operation_deadlines = {'create_export': '5'}
+        driver = datera.DateraDriver(execute=mock.Mock(),
+                                     configuration=self.cfg)
+        self.assertEqual(5, driver.deadlines['create_export'])
+        self.assertEqual(60, driver.deadlines['initialize_connection'])
+        self.assertNotIn('create_volume', driver.deadlines)
+
+    def test_clone_image_outlives_deadline(self):
+        api = mock.MagicMock()
+        datera.datc.install_request_hook(
+            api, datera.datc.get_deadline_hook(self.driver.thread_local))
+        self.driver.default_deadline = 0.01
+
+        def _clone_image(*args):
+            # Caching the image takes longer than operations may
+            datera.eventlet.sleep(0.05)
+            api.context.connection._http_connect_request(
+                'PUT', '/app_instances/ai-1')
+            return None, True
+        self.driver.impl_names['clone_image'] = '_clone_image_stub'
+        self.driver._clone_image_stub = _clone_image
+        self.assertEqual((None, True), self.driver.clone_image(
+            None, _stub_volume(), 'image-location', {}, None))
+
+        self.driver.impl_names['create_volume'] = '_create_volume_stub'
+        self.driver._create_volume_stub = _clone_image
+        self.assertRaises(datera.datc.DateraDeadlineExceeded,
+                          self.driver.create_volume, _stub_volume())
+
+    def test_deadline_hook(self):
+        thread_local = self.driver.thread_local
+        hook = datera.datc.get_deadline_hook(thread_local)
+        send = mock.Mock(return_value='response')
+        self.assertEqual('response', hook(send, 'GET', '/system'))
+        thread_local.deadline = ('create_export', time.time() + 0.05, 1)
+        # Requests in flight when the deadline passes are abandoned
+        send.side_effect = lambda *args: datera.eventlet.sleep(1)
+        self.assertRaises(datera.datc.DateraDeadlineExceeded,
+                          hook, send, 'GET', '/system')
+        send.reset_mock()
+        self.assertRaises(datera.datc.DateraDeadlineExceeded,
+                          hook, send, 'GET', '/system')
+        send.assert_not_called()
+        # So are polls
+        thread_local.deadline = ('create_volume', time.time() + 0.05, 1)
+        si = mock.Mock()
+        si.reload.return_value.op_state = 'unavailable'
+        self.assertRaises(datera.datc.DateraDeadlineExceeded,
+                          self.driver._si_poll_2_2, None, si, None)
+
+    def test_circuit_breaker(self):
+        breaker = datera.datc.CircuitBreaker(
+            'cluster', 2, 0.05, FakeSdkExceptions.ApiConflictError)
+        send = mock.Mock(side_effect=FakeSdkExceptions.ApiConflictError)
+        for __ in range(2):
+            self.assertRaises(FakeSdkExceptions.ApiConflictError,
+                              breaker.hook, send, 'GET', '/system')
+        self.assertEqual('open', breaker.state)
+        # Open breakers don't send anything
+        self.assertRaises(datera.datc.DateraCircuitOpen,
+                          breaker.hook, send, 'GET', '/system')
+        self.assertEqual(2, send.call_count)
+        self.driver.breaker = breaker
+        self.assertEqual('down', self.driver._get_health_state())
+
+        # A single request probes the cluster once the reset time is up
+        time.sleep(0.05)
+
+        def _probe(*args):
+            self.assertEqual('half_open', breaker.state)
+            self.assertRaises(datera.datc.DateraCircuitOpen,
+                              breaker.hook, mock.Mock(), 'GET', '/system')
+            raise FakeSdkExceptions.ApiConflictError()
+
+        send.side_effect = _probe
+        self.assertRaises(FakeSdkExceptions.ApiConflictError,
+                          breaker.hook, send, 'GET', '/system')
+        self.assertEqual('open', breaker.state)
+
+        time.sleep(0.05)
+        send.side_effect = FakeSdkExceptions.ApiNotFoundError
+        self.assertRaises(FakeSdkExceptions.ApiNotFoundError,
+                          breaker.hook, send, 'GET', '/system')
+        self.assertEqual({'api_circuit_state': 'closed',
+                          'api_consecutive_failures': 0},
+                         breaker.summary())
+
+    def test_hedged_gets(self):
+        thread_local = self.driver.thread_local
+        operations = []
+
+        def _hedge(*args):
+            operations.append(thread_local.operation)
+            return 'hedged'
+        hedge = mock.Mock(side_effect=_hedge)
+        hedging = datera.datc.HedgedRequests(0.25, [hedge], min_samples=2,
+                                             thread_local=thread_local)
+        send = mock.Mock(return_value='first')
+        path = '/app_instances/OS-1/storage_instances'
+        for __ in range(2):
+            self.assertEqual('first', hedging.hook(send, 'GET', path))
+        self.assertEqual('app_instances/storage_instances',
+                         hedging.get_site(path))
+
+        def _slow(*args):
+            datera.eventlet.sleep(0.5)
+            return 'slow'
+
+        send.side_effect = _slow
+        start = time.time()
+        thread_local.operation = 'create_export'
+        self.assertEqual('hedged', hedging.hook(send, 'GET', path))
+        thread_local.operation = None
+        self.assertLess(time.time() - start, 0.5)
+        hedge.assert_called_once_with('GET', path)
+        # The hedge is sent as part of the operation
+        self.assertEqual(['create_export'], operations)
+        # Only a quarter of the call site's GETs may be hedged
+        self.assertEqual('slow', hedging.hook(send, 'GET', path))
+        self.assertEqual(1, hedge.call_count)
+        # Neither are writes
+        self.assertEqual('slow', hedging.hook(send, 'PUT', path))
+        self.assertEqual({'app_instances/storage_instances': {
+            'requests': 4, 'hedged': 1, 'hedge_wins': 1}},
+            hedging.counters())
+        self.assertEqual({'api_hedged_requests': 1, 'api_hedge_wins': 1},
+                         hedging.summary())
+
+    def test_paged_list(self):
+        self.driver.page_size = 2
+        items = list(range(5))
+        endpoint = mock.Mock()
+        endpoint.list.side_effect = (
+            lambda offset, limit, **params: items[offset:offset + limit])
+        self.assertEqual(items, list(self.driver.paged_list(
+            endpoint, tenant='/root')))
+        self.assertEqual([mock.call(offset=0, limit=2, tenant='/root'),
+                          mock.call(offset=2, limit=2, tenant='/root'),
+                          mock.call(offset=4, limit=2, tenant='/root')],
+                         endpoint.list.call_args_list)
+        # Nothing past what the caller consumed is fetched
+        endpoint.list.reset_mock()
+        self.assertEqual(1, next(item for item in
+                                 self.driver.paged_list(endpoint) if item))
+        endpoint.list.assert_called_once_with(offset=0, limit=2)
+
+    @mock.patch.object(datera.datc.dfs_sdk, 'exceptions')
+    def test_paged_list_fields(self, mock_exceptions):
+        mock_exceptions.ApiInvalidRequestError = (
+            FakeSdkExceptions.ApiConflictError)
+        endpoint = mock.Mock()
+        endpoint.list.return_value = ['ai']
+        self.assertEqual(['ai'], list(self.driver.paged_list(
+            endpoint, fields=('name',))))
+        endpoint.list.assert_called_once_with(offset=0, limit=100)
+
+        self.driver.list_fields = True
+        endpoint.list.reset_mock()
+        self.assertEqual(['ai'], list(self.driver.paged_list(
+            endpoint, fields=('name',))))
+        endpoint.list.assert_called_once_with(
+            offset=0, limit=100, fields='name,path,tenant')
+        # Clusters that don't know the fields parameter get whole entities
+        endpoint.list.reset_mock()
+        endpoint.list.side_effect = [FakeSdkExceptions.ApiConflictError,
+                                     ['ai']]
+        self.assertEqual(['ai'], list(self.driver.paged_list(
+            endpoint, fields=('name',))))
+        self.assertEqual(mock.call(offset=0, limit=100),
+                         endpoint.list.call_args)
+        self.assertFalse(self.driver.list_fields)
+
+    @mock.patch.object(datera, 'dexceptions')
+    @mock.patch.object(datera.dfs_sdk, 'get_api')
+    def test_backends_share_cluster(self, mock_get_api, mock_exceptions):
+        other = datera.DateraDriver(execute=mock.Mock(),
+                                    configuration=self.cfg)
+        self.driver.api = None
+        self.driver.do_setup(None)
+        other.do_setup(None)
+        mock_get_api.assert_called_once()
+        self.assertIs(self.driver.api, other.api)
+        self.assertIs(self.driver.breaker, other.breaker)
+        self.assertIs(self.driver.request_stats, other.request_stats)
+        self.assertIs(self.driver.snapshot_index, other.snapshot_index)
+
+        # The other backend reuses the snapshot the first one fetched
+        system_get = self.driver.api.system.get
+        system_get.reset_mock()
+        self.driver.get_volume_stats(refresh=True)
+        other.get_volume_stats(refresh=True)
+        system_get.assert_called_once_with()
+        self.driver.get_volume_stats(refresh=True)
+        self.assertEqual(2, system_get.call_count)
+
+        # Backends in another tenant mode get a client of their own
+        self.cfg.datera_tenant_id = 'map'
+        mapped = datera.DateraDriver(execute=mock.Mock(),
+                                     configuration=self.cfg)
+        self.assertIsNot(self.driver.shared, mapped.shared)
+
+    @mock.patch.object(datera, 'dexceptions')
+    @mock.patch.object(datera.dfs_sdk, 'get_api')
+    def test_hedge_apis_share_login_tokens(self, mock_get_api,
+                                           mock_exceptions):
+        self.cfg.datera_hedge_gets = True
+        self.cfg.datera_hedge_endpoints = ['127.0.0.2']
+        apis = [mock.MagicMock(), mock.MagicMock()]
+        raw_sends = [api.context.connection._http_connect_request
+                     for api in apis]
+        mock_get_api.side_effect = apis
+        self.driver.api = None
+        self.driver.do_setup(None)
+        self.assertEqual(
+            [False, False], [c[1]['immediate_login']
+                             for c in mock_get_api.call_args_list])
+        # The hedge endpoint gets the primary's token without logging in
+        self.driver.shared.tokens.key = 'k1'
+        self.driver.shared.tokens.issued = time.time()
+        hedge_send = self.driver.hedging.senders[0]
+        self.assertEqual(({'key': 'k1'}, 200, 'OK', {}),
+                         hedge_send('PUT', '/login'))
+        raw_sends[1].assert_not_called()
+
+    def test_login_tokens_shared_through_cache(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'tokens.json')
+        login = ('PUT', '/login')
+        send = mock.Mock(return_value=({'key': 'k1'}, 200, 'OK', {}))
+        tokens = datera.datc.LoginTokens(
+            'user@127.0.0.1/', 3000, datera.datc.TokenCache(path),
+            (FakeSdkExceptions.ApiAuthError,))
+        self.assertEqual('k1', tokens.hook(send, *login)[0]['key'])
+        self.assertEqual(0o600, os.stat(path).st_mode & 0o777)
+
+        # Another process picks the token up instead of logging in
+        other = datera.datc.LoginTokens(
+            'user@127.0.0.1/', 3000, datera.datc.TokenCache(path),
+            (FakeSdkExceptions.ApiAuthError,))
+        self.assertEqual('k1', other.hook(send, *login)[0]['key'])
+        send.assert_called_once()
+        self.assertGreater(other.renew_in(), 2990)
+
+        # Until the cluster refuses it
+        send.side_effect = FakeSdkExceptions.ApiAuthError
+        self.assertRaises(FakeSdkExceptions.ApiAuthError, other.hook,
+                          send, 'GET', '/system',
+                          headers={'Auth-Token': 'k1'})
+        send.side_effect = None
+        send.return_value = ({'key': 'k2'}, 200, 'OK', {})
+        self.assertEqual('k2', other.hook(send, *login)[0]['key'])
+        self.assertEqual('k2', tokens.hook(send, *login)[0]['key'])
+        self.assertEqual(3, send.call_count)
+
+        # Tokens due for renewal aren't handed out
+        send.return_value = ({'key': 'k3'}, 200, 'OK', {})
+        later = time.time() + 3000
+        with mock.patch.object(datera.datc.time, 'time', return_value=later):
+            self.assertEqual('k3', tokens.hook(send, *login)[0]['key'])
+        self.assertEqual(4, send.call_count)
+
+        # Without renewal a refused token is only replaced by logging in
+        tokens = datera.datc.LoginTokens(
+            'user@127.0.0.1/', 0, None, (FakeSdkExceptions.ApiAuthError,))
+        self.assertEqual('k3', tokens.hook(send, *login)[0]['key'])
+        send.side_effect = FakeSdkExceptions.ApiAuthError
+        self.assertRaises(FakeSdkExceptions.ApiAuthError, tokens.hook,
+                          send, 'GET', '/system',
+                          headers={'Auth-Token': 'k3'})
+        send.side_effect = None
+        send.return_value = ({'key': 'k4'}, 200, 'OK', {})
+        self.assertEqual('k4', tokens.hook(send, *login)[0]['key'])
+
+    def test_renew_token(self):
+        self.driver.shared.tokens = mock.Mock(renew_after=3000)
+        self.driver.shared.tokens.renew_in.return_value = 120
+        self.assertEqual(120, self.driver._renew_token())
+        self.driver.api.context.connection.login.assert_not_called()
+
+        self.driver.shared.tokens.renew_in.side_effect = [0, 3000]
+        self.assertEqual(3000, self.driver._renew_token())
+        self.driver.api.context.connection.login.assert_called_once_with()
+
+        self.driver.shared.tokens.renew_in.side_effect = None
+        self.driver.shared.tokens.renew_in.return_value = 0
+        self.driver.api.context.connection.login.side_effect = (
+            DateraAPIException)
+        self.assertEqual(60, self.driver._renew_token())
+
+    def test_invalidations_reach_other_nodes(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.cfg.datera_invalidation_url = 'file://{}/inval.log'.format(
+            tmpdir)
+        nodes = []
+        for __ in range(2):
+            node = datera.DateraDriver(execute=mock.Mock(),
+                                       configuration=self.cfg)
+            node.api = mock.MagicMock()
+            node.apiv = "2.2"
+            nodes.append(node)
+        local, remote = nodes
+
+        local.provision_tally.set('vol1', 'Datera', 'tenant', 10)
+        local.provision_tally.resize('vol1', 20)
+        local.publish_invalidation('volume', 'vol2')
+        remote.snapshot_index['vol2'] = {'snap': '1234.5'}
+        self.assertEqual({}, remote.provision_tally.volumes)
+        remote._apply_invalidations()
+        self.assertEqual({'vol1': ('Datera', 'tenant', 20)},
+                         remote.provision_tally.volumes)
+        self.assertNotIn('vol2', remote.snapshot_index)
+        # Nothing comes back to the sender
+        local.provision_tally.volumes.clear()
+        local._apply_invalidations()
+        self.assertEqual({}, local.provision_tally.volumes)
+
+        # Losing track of the journal drops the caches
+        local.invalidations.max_bytes = 0
+        remote.provision_tally.seeded = True
+        remote.snapshot_index['vol3'] = {}
+        local.provision_tally.remove('vol1')
+        remote._apply_invalidations()
+        self.assertFalse(remote.provision_tally.seeded)
+        self.assertEqual({}, remote.snapshot_index)
+
+    def test_invalidation_url_scheme(self):
+        self.cfg.datera_invalidation_url = 'etcd://127.0.0.1:2379'
+        self.assertRaises(exception.InvalidInput, datera.DateraDriver,
+                          execute=mock.Mock(), configuration=self.cfg)
+
+    def test_request_scheduler(self):
+        scheduler = datera.datc.RequestScheduler(
+            1, {'bulk': 1}, self.driver.thread_local)
+        sent = []
+        release = datera.eventlet.event.Event()
+
+        def _request(operation):
+            self.driver.thread_local.operation = operation
+
+            def _send(*args):
+                sent.append(operation)
+                if len(sent) == 1:
+                    release.wait()
+            scheduler.hook(_send, 'GET', '/system')
+
+        threads = [datera.eventlet.spawn(_request, operation) for operation in
+                   ('get_manageable_volumes', 'update_cluster_stats',
+                    'create_volume', 'initialize_connection')]
+        datera.eventlet.sleep(0)
+        self.assertEqual({'api_requests_waiting': 3}, scheduler.summary())
+        release.send()
+        for thread in threads:
+            thread.wait()
+        # Waiting requests go by priority, not arrival
+        self.assertEqual(['get_manageable_volumes', 'initialize_connection',
+                          'create_volume', 'update_cluster_stats'], sent)
+
+        # Bulk requests over budget don't hold up the others
+        scheduler.concurrency = 0
+        self.driver.thread_local.operation = 'rebalance_qos'
+        scheduler.in_flight['bulk'] = 1
+        self.driver.thread_local.deadline = ('rebalance_qos',
+                                             time.time() + 0.01, 0.01)
+        self.assertRaises(datera.datc.DateraDeadlineExceeded,
+                          scheduler.hook, mock.Mock(), 'GET', '/system')
+        self.driver.thread_local.deadline = None
+        self.driver.thread_local.operation = 'detach_volume'
+        send = mock.Mock()
+        scheduler.hook(send, 'GET', '/system')
+        send.assert_called_once_with('GET', '/system')
+        self.driver.thread_local.operation = None
+
+    def test_lookup_dispatch_resolved_once(self):
+        self.assertIn('create_volume', datera.datc.LOOKUPS)
+        datera.datc.resolve_lookups(self.driver)
+        self.assertEqual(
+            '_create_volume_' + self.driver.apiv.replace('.', '_'),
+            self.driver.impl_names['create_volume'])
+        self.driver.impl_names['create_volume'] = '_create_volume_stub'
+        self.driver._create_volume_stub = mock.Mock(return_value=None)
+        testvol = _stub_volume()
+        self.driver.create_volume(testvol)
+        self.driver._create_volume_stub.assert_called_once_with(testvol)
+
+    def test_lookup_missing_impl(self):
+        # A failed dispatch leaves no operation behind on the thread
+        self.driver.impl_names['create_volume'] = '_create_volume_missing'
+        self.assertRaises(AttributeError, self.driver.create_volume,
+                          _stub_volume())
+        self.assertIsNone(
+            getattr(self.driver.thread_local, 'operation', None))
+        self.assertIsNone(
+            getattr(self.driver.thread_local, 'deadline', None))
+        self.assertIsNone(getattr(self.driver.thread_local, 'calls', None))
+
+    @mock.patch.object(datera.datc, 'LOG')
+    def test_sampled_profiler(self, mock_log):
+        self.driver.profiler = datera.datc.SampledProfiler(2, 0)
+        stub = mock.Mock(return_value=None)
+        self.driver.impl_names['create_volume'] = '_create_volume_stub'
+        self.driver._create_volume_stub = stub
+        self.driver.create_volume(_stub_volume())
+        mock_log.info.assert_not_called()
+        self.driver.create_volume(_stub_volume())
+        self.assertEqual(1, mock_log.info.call_count)
+        self.assertIn('profile', mock_log.info.call_args[0][0])
+
+        with mock.patch.object(datera.signal, 'signal') as mock_signal:
+            self.driver._install_profile_signal('SIGUSR1')
+        handler = mock_signal.call_args[0][1]
+        self.assertEqual(datera.signal.SIGUSR1, mock_signal.call_args[0][0])
+        handler(datera.signal.SIGUSR1, None)
+        self.driver.create_volume(_stub_volume())
+        self.assertEqual(3, mock_log.info.call_count)
+        handler(datera.signal.SIGUSR1, None)
+        self.assertFalse(self.driver.profiler.forced)
+
+    def test_metrics(self):
+        metrics = datera.datc.Metrics()
+        self.driver.metrics = metrics
+        self.driver.impl_names['create_volume'] = '_create_volume_stub'
+        self.driver._create_volume_stub = mock.Mock(
+            side_effect=[None, DateraAPIException])
+        self.driver.create_volume(_stub_volume())
+        self.assertRaises(DateraAPIException, self.driver.create_volume,
+                          _stub_volume())
+        hook = datera.datc.get_metrics_hook(
+            metrics, '127.0.0.1', (FakeSdkExceptions.ApiConflictError,))
+        hook(mock.Mock(), 'get', '/app_instances/ai-1/storage_instances')
+        self.assertRaises(FakeSdkExceptions.ApiConflictError, hook,
+                          mock.Mock(side_effect=(
+                              FakeSdkExceptions.ApiConflictError)),
+                          'PUT', '/app_instances/ai-1')
+        self.driver._count_cache('snapshot_index', True)
+        metrics.collect('datera_operations_in_flight', {'backend': 'Datera'},
+                        lambda: 2)
+
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'datera.prom')
+        metrics.write(path)
+        with open(path) as f:
+            lines = f.read().splitlines()
+        for line in (
+                '# TYPE datera_operation_duration_seconds histogram',
+                'datera_operation_duration_seconds_count{backend="Datera",'
+                'operation="create_volume"} 2.0',
+                'datera_operation_errors_total{backend="Datera",'
+                'operation="create_volume"} 1.0',
+                'datera_request_duration_seconds_bucket{cluster="127.0.0.1",'
+                'endpoint="/app_instances/{id}/storage_instances",'
+                'method="GET",le="+Inf"} 1.0',
+                'datera_request_errors_total{cluster="127.0.0.1",'
+                'endpoint="/app_instances/{id}",error="ApiConflictError",'
+                'method="PUT"} 1.0',
+                'datera_request_retries_total{cluster="127.0.0.1",'
+                'endpoint="/app_instances/{id}",method="PUT"} 1.0',
+                'datera_cache_lookups_total{cache="snapshot_index",'
+                'cluster="127.0.0.1",result="hit"} 1.0',
+                'datera_operations_in_flight{backend="Datera"} 2.0'):
+            self.assertIn(line, lines)
+
+        start_response = mock.Mock()
+        body = metrics.wsgi_app({}, start_response)
+        self.assertEqual(metrics.render().encode('utf-8'), body[0])
+        self.assertEqual('200 OK', start_response.call_args[0][0])
+
+    def _use_fake_cluster(self):
+        cluster = FakeCluster()
+        self.driver.api = cluster
+        datera.datc.install_request_hook(
+            cluster, datera.datc.get_call_count_hook(self.driver.thread_local))
+        for patcher in (
+                mock.patch.object(datera.api21, 'dexceptions',
+                                  FakeSdkExceptions),
+                mock.patch.object(datera.api22, 'dexceptions',
+                                  FakeSdkExceptions),
+                mock.patch.object(datera.datc.dfs_sdk, 'exceptions',
+                                  FakeSdkExceptions),
+                mock.patch.object(datera.datc.dfs_sdk.base, 'Entity',
+                                  cluster.entity)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        return cluster
+
+    def test_call_counts(self):
+        cluster = self._use_fake_cluster()
+        metrics = datera.datc.Metrics()
+        self.driver.metrics = metrics
+        testvol = _stub_volume()
+        testsnap = _stub_snapshot(volume_id=testvol['id'])
+        connector = {'initiator': 'iqn.1993-08.org.debian:01:cafe'}
+        ctxt = context.get_admin_context()
+
+        self.driver.create_volume(testvol)
+        self.driver.extend_volume(testvol, 2)
+        self.driver.create_export(ctxt, testvol, connector)
+        self.driver.initialize_connection(testvol, connector)
+        testsnap.update(self.driver.create_snapshot(testsnap))
+        self.driver.delete_snapshot(testsnap)
+        self.driver.detach_volume(ctxt, testvol)
+        self.driver.delete_volume(testvol)
+        self.assertEqual({}, dict(cluster.app_instances.entities))
+
+        counts = {dict(labels)['operation']: value for (name, labels), value
+                  in metrics.counters.items()
+                  if name == 'datera_operation_requests_total'}
+        self.assertEqual(self.CALL_COUNTS, counts)
+        self.assertEqual(len(cluster.requests), sum(counts.values()))
+
+    @mock.patch.object(datera.datc, 'LOG')
+    def test_call_budget_exceeded(self, mock_log):
+        self._use_fake_cluster()
+        self.driver.call_budgets = {'create_volume': 1, 'delete_volume': 20}
+        self.driver.create_volume(_stub_volume())
+        self.driver.delete_volume(_stub_volume())
+        self.assertEqual(1, mock_log.warning.call_count)
+        self.assertEqual('create_volume',
+                         mock_log.warning.call_args[0][1]['op'])
+        self.assertIsNone(self.driver.thread_local.calls)
+
+    def test_refresh_stats_times_out(self):
+        self.cfg.datera_stats_refresh_timeout = 0.01
+        self.driver.api.system.get.side_effect = (
+            lambda: datera.eventlet.sleep(1))
+        self.driver._refresh_stats()
+        self.assertIsNone(self.driver.stats_updated)
+
+    def test_provision_tally_seed_outlives_refresh_timeout(self):
+        def _list(**kwargs):
+            datera.eventlet.sleep(0.05)
+            return [{'name': OS_PREFIX + '-' + str(uuid.uuid4()),
+                     'storage_instances': [{'volumes': [{'size': 10}]}]}]
+        self.driver.api.app_instances.list.side_effect = _list
+        self.driver.api.system.get.side_effect = (
+            lambda: datera.eventlet.sleep(1))
+        self.assertRaises(datera.eventlet.Timeout,
+                          self._timed_update_cluster_stats, 0.01)
+        self.driver.seeder.wait()
+        self.assertTrue(self.driver.provision_tally.seeded)
+        self.assertEqual(({'Datera': (10, 1)}, mock.ANY),
+                         self.driver.provision_tally.totals())
+
+    def _timed_update_cluster_stats(self, timeout):
+        with datera.eventlet.Timeout(timeout):
+            self.driver._update_cluster_stats_2_2()
+
+    def test_provisioned_capacity_tally(self):
+        cinder_id = str(uuid.uuid4())
+        ais = [{'name': OS_PREFIX + '-' + cinder_id,
+                'storage_instances': [{'volumes': [{'size': 10}]}]},
+               {'name': 'not-cinder',
+                'storage_instances': [{'volumes': [{'size': 5}]}]},
+               {'name': datera.datc.get_pending_delete('x'),
+                'storage_instances': [{'volumes': [{'size': 7}]}]}]
+        self.driver.api.app_instances.list.return_value = ais
+        self.driver.api.system.get.return_value.sw_version = "3.3.3"
+        self.driver._update_cluster_stats_2_2()
+        self.driver.seeder.wait()
+        self.assertIsNone(self.driver.seeder)
+        stats = self.driver._get_volume_stats_2_2()
+        self.assertEqual(15, stats['provisioned_capacity_gb'])
+        self.assertEqual(2, stats['total_volumes'])
+        self.driver.api.app_instances.list.reset_mock()
+        self.driver.cvol_to_ai = mock.MagicMock()
+
+        testvol = _stub_volume(id=str(uuid.uuid4()), size=3)
+        aimock = self.driver.api.app_instances.create.return_value
+        aimock.__getitem__.side_effect = {
+            'storage_instances': [{'volumes': [{'size': 3}]}]}.__getitem__
+        self.driver._create_volume_2_2(testvol)
+        self.driver.cvol_to_dvol = mock.MagicMock()
+        self.driver._extend_volume_2_2(_stub_volume(id=cinder_id, size=10),
+                                       12)
+        self.driver._delete_volume_2_2({'id': 'not-cinder',
+                                        'project_id': 'test-project'})
+        stats = self.driver._get_volume_stats_2_2()
+        self.assertEqual(15, stats['provisioned_capacity_gb'])
+        self.assertEqual(2, stats['total_volumes'])
+        self.driver.api.app_instances.list.assert_not_called()
+
+    def test_provision_tally_replays_changes_during_seed(self):
+        tally = datera.datc.ProvisionTally()
+        tally.begin_seed()
+        tally.set('new', 'pool', 'tenant', 1)
+        tally.remove('gone')
+        tally.seed({'gone': ('pool', 'tenant', 4),
+                    'kept': ('pool', 'tenant', 2)})
+        self.assertEqual(({'pool': (3, 2)}, {'tenant': (3, 2)}),
+                         tally.totals())
+
+    def test_request_hook_records_latency(self):
+        api = mock.MagicMock()
+        send = api.context.connection._http_connect_request
+        send.return_value = ({}, 200, 'OK', {})
+        stats = datera.datc.RequestStats()
+        datera.datc.install_request_hook(api, stats.hook)
+        api.context.connection._http_connect_request(
+            'GET', '/system', headers={})
+        send.assert_called_once_with('GET', '/system', headers={})
+        summary = stats.summary()
+        self.assertEqual(0, summary['api_requests_in_flight'])
+        self.assertIn('api_latency_p95_ms', summary)
+
+    def test_get_volume_stats_headroom(self):
+        system = self.driver.api.system.get.return_value
+        system.all_flash_total_capacity = 100
+        system.all_flash_available_capacity = 25
+        system.hybrid_total_capacity = 0
+        system.hybrid_available_capacity = 0
+        read = self.driver.api.context.connection.read_endpoint
+        read.return_value = [{'path': '/system', 'point': [
+            {'time': 2, 'value': 300}, {'time': 1, 'value': 100}]}]
+        stats = self.driver._get_volume_stats_2_2(refresh=True)
+        self.assertEqual(75.0, stats['flash_utilization'])
+        self.assertEqual(0, stats['hybrid_utilization'])
+        self.assertEqual(300, stats['cluster_iops_write'])
+        self.assertEqual(0, stats['operations_in_flight'])
+        self.assertIn('api_requests_in_flight', stats)
+
     def test_create_cloned_volume_success(self):
         testvol = _stub_volume()
         ref = _stub_volume(id=str(uuid.uuid4()))
@@ -132,6 +1159,60 @@ class DateraVolumeTestCasev22(test.TestCase):
         self.driver.create_cloned_volume(testvol, ref)
         mock_extend.assert_called_once_with(testvol, newsize)
 
+    def test_create_cloned_volume_larger_override(self):
+        testvol = _stub_volume(size=2)
+        ref = _stub_volume(id=str(uuid.uuid4()))
+        self.driver.cvol_to_dvol = mock.Mock()
+        self.driver.cvol_to_dvol.return_value.path = (
+            '/app_instances/x/storage_instances/storage-1/volumes/volume-1')
+        self.driver._support_template_override_2_2 = mock.Mock(
+            return_value=True)
+        self.driver._extend_volume_2_2 = mock.Mock()
+        self.driver._create_cloned_volume_2_2(testvol, ref)
+        create = self.driver.api.app_instances.create
+        self.assertEqual(
+            {'storage_instances': {'storage-1': {'volumes': {
+                'volume-1': {'size': '2'}}}}},
+            create.call_args[1]['template_override'])
+        self.driver._extend_volume_2_2.assert_not_called()
+
+    @mock.patch.object(datera.api22, 'dexceptions', FakeSdkExceptions)
+    def test_create_cloned_volume_larger_override_rejected(self):
+        testvol = _stub_volume(size=2)
+        ref = _stub_volume(id=str(uuid.uuid4()))
+        self.driver.cvol_to_dvol = mock.Mock()
+        self.driver.cvol_to_dvol.return_value.path = (
+            '/app_instances/x/storage_instances/storage-1/volumes/volume-1')
+        self.driver._support_template_override_2_2 = mock.Mock(
+            return_value=True)
+        sizes = []
+        self.driver._extend_volume_2_2 = mock.Mock(
+            side_effect=lambda vol, size: sizes.append((vol['size'], size)))
+        create = self.driver.api.app_instances.create
+        create.side_effect = [FakeSdkExceptions.ApiInvalidRequestError(),
+                              mock.MagicMock()]
+        self.driver._create_cloned_volume_2_2(testvol, ref)
+        self.assertEqual(2, create.call_count)
+        self.assertIn('template_override', create.call_args_list[0][1])
+        self.assertNotIn('template_override', create.call_args_list[1][1])
+        self.assertEqual([(1, 2)], sizes)
+        self.assertEqual(2, testvol['size'])
+
+    def test_create_cloned_volume_larger_extends_from_source(self):
+        testvol = _stub_volume(size=2)
+        ref = _stub_volume(id=str(uuid.uuid4()))
+        self.driver._support_template_override_2_2 = mock.Mock(
+            return_value=False)
+        sizes = []
+        self.driver._extend_volume_2_2 = mock.Mock(
+            side_effect=lambda vol, size: sizes.append((vol['size'], size)))
+        self.driver._create_cloned_volume_2_2(testvol, ref)
+        self.assertNotIn('template_override',
+                         self.driver.api.app_instances.create.call_args[1])
+        self.assertEqual([(1, 2)], sizes)
+        self.assertEqual(2, testvol['size'])
+
+    @mock.patch.object(datera.api22, 'dexceptions', FakeSdkExceptions)
     def test_create_cloned_volume_fails(self):
         testvol = _stub_volume()
         ref = _stub_volume(id=str(uuid.uuid4()))
@@ -149,13 +1230,124 @@ class DateraVolumeTestCasev22(test.TestCase):
     def test_delete_volume_not_found(self):
         testvol = _stub_volume()
         self.driver.api.app_instances.list.side_effect = exception.NotFound
+        self.driver.publish_invalidation = mock.Mock()
         self.assertIsNone(self.driver.delete_volume(testvol))
+        self.driver.publish_invalidation.assert_called_once_with(
+            'volume', testvol['id'])
 
     def test_delete_volume_fails(self):
         testvol = _stub_volume()
         self.driver.api.app_instances.list.side_effect = DateraAPIException
+        self.driver.publish_invalidation = mock.Mock()
         self.assertRaises(DateraAPIException,
                           self.driver.delete_volume, testvol)
+        self.driver.publish_invalidation.assert_not_called()
+
+    def test_delete_volume_deferred(self):
+        testvol = _stub_volume()
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        journal = os.path.join(tmpdir, 'journal.json')
+        self.driver.deferred_delete = True
+        self.driver.delete_journal = datera.datc.DeleteJournal(journal)
+        aimock = mock.MagicMock()
+        aimock.id = 'ai-uuid'
+        aimock.name = datera.datc.get_name(testvol)
+        self.driver.cvol_to_ai = mock.Mock(return_value=aimock)
+
+        self.assertIsNone(self.driver._delete_volume_2_2(testvol))
+        aimock.set.assert_called_once_with(
+            tenant=mock.ANY, name='DELETING-ai-uuid')
+        aimock.delete.assert_not_called()
+        # A restarted driver picks the pending delete back up
+        self.driver.delete_journal = datera.datc.DeleteJournal(journal)
+        self.assertEqual(1, self.driver.delete_journal.stats()[0])
+
+        self.driver.api.app_instances.get.return_value = aimock
+        self.driver._reap_deletes_2_2()
+        self.driver.api.app_instances.get.assert_called_once_with(
+            'ai-uuid', tenant=mock.ANY)
+        aimock.delete.assert_called_once_with(tenant=mock.ANY, force=True)
+        self.assertEqual((0, 0), self.driver.delete_journal.stats())
+
+    def test_delete_volume_deferred_rename_fails(self):
+        testvol = _stub_volume()
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.driver.deferred_delete = True
+        self.driver.delete_journal = datera.datc.DeleteJournal(
+            os.path.join(tmpdir, 'journal.json'))
+        self.driver.provision_tally.set(testvol['id'], 'pool', 'tenant', 1)
+        aimock = mock.MagicMock()
+        aimock.id = 'ai-uuid'
+        aimock.name = datera.datc.get_name(testvol)
+        aimock.set.side_effect = DateraAPIException
+        self.driver.cvol_to_ai = mock.Mock(return_value=aimock)
+
+        self.assertRaises(DateraAPIException,
+                          self.driver._delete_volume_2_2, testvol)
+        self.assertEqual(0, self.driver.delete_journal.stats()[0])
+        self.assertEqual(({'pool': (1, 1)}, {'tenant': (1, 1)}),
+                         self.driver.provision_tally.totals())
+
+    @mock.patch.object(datera.api22, 'dexceptions', FakeSdkExceptions)
+    def test_reap_deletes_retries_failures(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.driver.delete_journal = datera.datc.DeleteJournal(
+            os.path.join(tmpdir, 'journal.json'))
+        self.driver.delete_journal.add('ai-uuid', '/root', 'OS-test')
+        aimock = mock.MagicMock()
+        aimock.delete.side_effect = DateraAPIException
+        self.driver.api.app_instances.get.return_value = aimock
+        self.driver._reap_deletes_2_2()
+        self.assertEqual(
+            1, self.driver.delete_journal.entries['ai-uuid']['attempts'])
+
+    @mock.patch.object(datera.api22, 'dexceptions', FakeSdkExceptions)
+    def test_reap_deletes_gives_up(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        journal = os.path.join(tmpdir, 'journal.json')
+        self.driver.delete_journal = datera.datc.DeleteJournal(
+            journal, max_attempts=2)
+        self.driver.delete_journal.add('ai-uuid', '/root', 'OS-test')
+        aimock = mock.MagicMock()
+        aimock.delete.side_effect = DateraAPIException
+        self.driver.api.app_instances.get.return_value = aimock
+        self.driver._reap_deletes_2_2()
+        self.assertIn('ai-uuid', self.driver.delete_journal)
+        self.driver._reap_deletes_2_2()
+        self.assertNotIn('ai-uuid', self.driver.delete_journal)
+        self.assertEqual(
+            (0, 0), datera.datc.DeleteJournal(journal).stats())
+
+    def test_delete_volume_deferred_again(self):
+        testvol = _stub_volume()
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.driver.deferred_delete = True
+        self.driver.delete_journal = datera.datc.DeleteJournal(
+            os.path.join(tmpdir, 'journal.json'))
+        aimock = mock.MagicMock()
+        aimock.id = testvol['id']
+        aimock.name = datera.datc.get_pending_delete(testvol['id'])
+        self.driver.cvol_to_ai = mock.Mock(return_value=aimock)
+        self.driver.delete_journal.add(aimock.id, '/root', 'OS-test')
+        self.driver.delete_journal.failed(aimock.id)
+
+        # A retried delete leaves the pending one as it is
+        self.assertIsNone(self.driver._delete_volume_2_2(testvol))
+        aimock.set.assert_not_called()
+        self.assertEqual(
+            1, self.driver.delete_journal.entries[aimock.id]['attempts'])
+
+        # ... unless the reaper gave up on it
+        self.driver.delete_journal.remove(aimock.id)
+        self.assertIsNone(self.driver._delete_volume_2_2(testvol))
+        aimock.set.assert_not_called()
+        self.assertEqual(
+            0, self.driver.delete_journal.entries[aimock.id]['attempts'])
 
     def test_ensure_export_success(self):
         testvol = _stub_volume()
@@ -262,10 +1454,12 @@ class DateraVolumeTestCasev22(test.TestCase):
         snapmock.reload.return_value = snapmock
         snapmock.uuid = testsnap['id']
         snapmock.op_state = "available"
+        snapmock.utc_ts = '1524686547.123456789'
         volmock.snapshots.create.return_value = snapmock
         self.driver.cvol_to_dvol = mock.MagicMock()
         self.driver.cvol_to_dvol.return_value = volmock
-        self.assertIsNone(self.driver.create_snapshot(testsnap))
+        self.assertEqual({'provider_location': snapmock.utc_ts},
+                         self.driver.create_snapshot(testsnap))
 
     def test_create_snapshot_fails(self):
         testsnap = _stub_snapshot(volume_id=str(uuid.uuid4()))
@@ -310,6 +1504,45 @@ class DateraVolumeTestCasev22(test.TestCase):
         self.assertIsNone(self.driver.create_volume_from_snapshot(
             testvol, testsnap))
 
+    def test_create_volume_from_snapshot_keyed_get(self):
+        testsnap = _stub_snapshot(volume_id=str(uuid.uuid4()))
+        testsnap['provider_location'] = '1524686547.123456789'
+        testvol = _stub_volume()
+        volmock = mock.MagicMock()
+        snapmock = volmock.snapshots.get.return_value
+        snapmock.reload.return_value = snapmock
+        snapmock.op_state = "available"
+        self.driver.cvol_to_dvol = mock.MagicMock(return_value=volmock)
+        self.driver.create_volume_from_snapshot(testvol, testsnap)
+        volmock.snapshots.get.assert_called_once_with(
+            testsnap['provider_location'], tenant=mock.ANY)
+        volmock.snapshots.list.assert_not_called()
+
+    def test_delete_snapshot_uses_uuid_index(self):
+        parent = str(uuid.uuid4())
+        snaps = []
+        for i in range(3):
+            snap = mock.MagicMock(uuid=str(uuid.uuid4()),
+                                  utc_ts='152468654{}.1'.format(i))
+            snaps.append(snap)
+        volmock = mock.MagicMock()
+        volmock.snapshots.list.return_value = snaps
+        self.driver.cvol_to_dvol = mock.MagicMock(return_value=volmock)
+
+        self.driver.delete_snapshot(
+            _stub_snapshot(id=snaps[0].uuid, volume_id=parent))
+        snaps[0].delete.assert_called_once_with(tenant=mock.ANY)
+        self.driver.delete_snapshot(
+            _stub_snapshot(id=snaps[2].uuid, volume_id=parent))
+        volmock.snapshots.list.assert_called_once_with(
+            offset=0, limit=100, tenant=mock.ANY)
+        volmock.snapshots.get.assert_called_once_with(
+            snaps[2].utc_ts, tenant=mock.ANY)
+        volmock.snapshots.get.return_value.delete.assert_called_once_with(
+            tenant=mock.ANY)
+        self.assertEqual({snaps[1].uuid: snaps[1].utc_ts},
+                         self.driver.snapshot_index[parent])
+
     def test_create_volume_from_snapshot_fails(self):
         testsnap = _stub_snapshot(volume_id=str(uuid.uuid4()))
         testvol = _stub_volume()
@@ -333,6 +1566,7 @@ class DateraVolumeTestCasev22(test.TestCase):
         self.driver._offline_flip_2_1 = mock.MagicMock()
         self.assertIsNone(self.driver.extend_volume(testvol, newsize))
 
+    @mock.patch.object(datera.api22, 'dexceptions', FakeSdkExceptions)
     def test_extend_volume_fails(self):
         newsize = 2
         testvol = _stub_volume()
@@ -348,12 +1582,134 @@ class DateraVolumeTestCasev22(test.TestCase):
                           testvol,
                           newsize)
 
+    def test_extend_volume_online(self):
+        testvol = _stub_volume()
+        mockvol = mock.MagicMock()
+        self.driver.cvol_to_dvol = mock.MagicMock(return_value=mockvol)
+        self.driver._offline_flip_2_2 = mock.MagicMock()
+        self.driver._extend_volume_2_2(testvol, 2)
+        mockvol.set.assert_called_once_with(tenant=mock.ANY, size=2)
+        self.driver._offline_flip_2_2.assert_not_called()
+
+    def test_extend_volume_offline_flip_fallback(self):
+        testvol = _stub_volume()
+        mockvol = mock.MagicMock()
+        self.driver.datera_version = "3.2.1"
+        self.driver.cvol_to_dvol = mock.MagicMock(return_value=mockvol)
+        self.driver._offline_flip_2_2 = mock.MagicMock()
+        self.driver._extend_volume_2_2(testvol, 2)
+        mockvol.set.assert_called_once_with(tenant=mock.ANY, size=2)
+        self.driver._offline_flip_2_2.assert_called_once_with(testvol)
+
+    @mock.patch.object(datera.api22, 'dexceptions', FakeSdkExceptions)
+    def test_extend_volume_online_rejected(self):
+        testvol = _stub_volume()
+        mockvol = mock.MagicMock()
+        mockvol.set.side_effect = [
+            FakeSdkExceptions.ApiInvalidRequestError, None]
+        self.driver.cvol_to_dvol = mock.MagicMock(return_value=mockvol)
+        self.driver._offline_flip_2_2 = mock.MagicMock()
+        self.driver._extend_volume_2_2(testvol, 2)
+        self.assertEqual(2, mockvol.set.call_count)
+        mockvol.set.assert_called_with(tenant=mock.ANY, size=2)
+        self.driver._offline_flip_2_2.assert_called_once_with(testvol)
+
+    @mock.patch.object(volume_types, 'get_volume_type')
+    def test_extend_volume_recomputes_qos(self, mock_get_type):
+        mock_get_type.return_value = _stub_volume_type(
+            {'DF:iops_per_gb': '10', 'DF:total_iops_max': '1000'})
+        testvol = _stub_volume(volume_type_id='type-id')
+        mockvol = mock.MagicMock()
+        pp = mockvol.performance_policy.get.return_value
+        pp.items.return_value = [('total_iops_max', 10),
+                                 ('read_iops_max', 0),
+                                 ('path', '/performance_policy')]
+        self.driver.cvol_to_dvol = mock.MagicMock(return_value=mockvol)
+        self.driver._extend_volume_2_2(testvol, 5)
+        pp.set.assert_called_once_with(tenant=mock.ANY, total_iops_max=50,
+                                       read_iops_max=0)
+        pp.delete.assert_not_called()
+        mockvol.performance_policy.create.assert_not_called()
+
+    def test_update_qos_skips_unchanged_policy(self):
+        testvol = _stub_volume(volume_type_id='type-id')
+        mockvol = mock.MagicMock()
+        pp = mockvol.performance_policy.get.return_value
+        pp.items.return_value = [('total_iops_max', 1000),
+                                 ('read_iops_max', 0)]
+        self.driver._update_qos_2_2(
+            testvol, {'total_iops_max': 1000, 'read_iops_max': 0},
+            dvol=mockvol, tenant='tenant')
+        pp.set.assert_not_called()
+        pp.delete.assert_not_called()
+
+    @mock.patch.object(datera.api22.objects.VolumeList, 'get_all_by_host')
+    @mock.patch.object(volume_types, 'get_volume_type')
+    def test_rebalance_qos(self, mock_get_type, mock_get_all):
+        mock_get_type.return_value = _stub_volume_type(
+            {'DF:iops_per_gb': '10', 'DF:total_iops_max': '1000'})
+        vols = [_stub_volume(id=str(uuid.uuid4()), volume_type_id='type-id',
+                             size=size)
+                for size in (1, 5)]
+        vols.append(_stub_volume(id=str(uuid.uuid4()),
+                                 volume_type_id='type-id', status='deleting'))
+        mock_get_all.return_value = vols
+        policies = {}
+        for vol, iops in zip(vols, (10, 20)):
+            pp = mock.MagicMock()
+            pp.items.return_value = [('total_iops_max', iops)]
+            policies[vol['id']] = pp
+        operations = []
+
+        def _cvol_to_dvol(vol, tenant):
+            operations.append(self.driver.thread_local.operation)
+            return mock.MagicMock(**{
+                'performance_policy.get.return_value': policies[vol['id']]})
+        self.driver.cvol_to_dvol = mock.MagicMock(side_effect=_cvol_to_dvol)
+        self.driver.host = 'localhost@datera'
+        ctxt = context.get_admin_context()
+
+        report = self.driver._rebalance_qos_2_2(ctxt, 'type-id', dry_run=True)
+        mock_get_all.assert_called_with(
+            ctxt, 'localhost@datera', filters={'volume_type_id': 'type-id'})
+        self.assertEqual(2, report['checked'])
+        self.assertEqual(
+            {vols[1]['id']: {'current': {'total_iops_max': 20},
+                             'target': {'total_iops_max': 50}}},
+            report['changed'])
+        policies[vols[1]['id']].set.assert_not_called()
+
+        # The workers run as part of the rebalance_qos operation, which is
+        # only implemented for 2.2
+        del operations[:]
+        self.driver.impl_names['rebalance_qos'] = '_rebalance_qos_2_2'
+        self.driver.rebalance_qos(ctxt, 'type-id')
+        self.assertEqual(['rebalance_qos'] * 2, operations)
+        self.assertIsNone(self.driver.thread_local.operation)
+        policies[vols[0]['id']].set.assert_not_called()
+        policies[vols[1]['id']].set.assert_called_once_with(
+            tenant=mock.ANY, total_iops_max=50)
+
     def test_manage_existing(self):
         existing_ref = {'source-name': "A:B:C:D"}
         testvol = _stub_volume()
-        self.driver.cvol_to_ai = mock.MagicMock()
+        aimock = mock.MagicMock()
+        aimock.name = 'C'
+        self.driver.cvol_to_ai = mock.MagicMock(return_value=aimock)
         self.assertIsNone(self.driver.manage_existing(testvol, existing_ref))
 
+    def test_manage_existing_pending_delete(self):
+        existing_ref = {'source-name': "A:B:C:D"}
+        testvol = _stub_volume()
+        aimock = mock.MagicMock()
+        aimock.name = datera.datc.get_pending_delete('ai-uuid')
+        self.driver.cvol_to_ai = mock.MagicMock(return_value=aimock)
+        self.assertRaises(exception.ManageExistingInvalidReference,
+                          self.driver.manage_existing,
+                          testvol,
+                          existing_ref)
+        aimock.set.assert_not_called()
+
     def test_manage_existing_wrong_ref(self):
         existing_ref = {'source-name': "ABCD"}
         testvol = _stub_volume()
@@ -421,8 +1777,12 @@ class DateraVolumeTestCasev22(test.TestCase):
         mockvol2.size = v2['size']
         mocksi2.volumes.list.return_value = [mockvol2]
 
+        # Pending deferred deletes aren't offered
+        mock3 = mock.MagicMock()
+        mock3.__getitem__.side_effect = ['DELETING-ai-uuid']
+
         listmock = mock.MagicMock()
-        listmock.return_value = [mock1, mock2]
+        listmock.return_value = [mock1, mock2, mock3]
         self.driver.api.app_instances.list = listmock
 
         marker = mock.MagicMock()
@@ -450,9 +1810,104 @@ class DateraVolumeTestCasev22(test.TestCase):
         testvol = _stub_volume()
         self.assertIsNone(self.driver.unmanage(testvol))
 
+    def _multi_cluster_driver(self):
+        self.cfg.datera_clusters = {'east': '172.28.0.2'}
+        driver = datera.DateraDriver(execute=mock.Mock(),
+                                     configuration=self.cfg)
+        for cluster in driver.clusters.values():
+            cluster.api = mock.MagicMock()
+            cluster.apiv = "2.2"
+            cluster.datera_version = "3.3.3"
+        return driver
+
+    def test_multi_cluster_pools(self):
+        driver = self._multi_cluster_driver()
+        self.assertEqual(['Datera', 'east'], list(driver.clusters))
+        self.assertEqual('127.0.0.1', driver.clusters['Datera'].san_ip)
+        self.assertEqual('172.28.0.2', driver.clusters['east'].san_ip)
+        for name, free in (('Datera', 10), ('east', 30)):
+            driver.clusters[name].cluster_stats = {
+                'volume_backend_name': 'Datera',
+                'total_capacity_gb': 100,
+                'free_capacity_gb': free}
+            driver.clusters[name].stats_refresher = mock.Mock()
+        stats = driver.get_volume_stats()
+        self.assertEqual(200, stats['total_capacity_gb'])
+        self.assertEqual(40, stats['free_capacity_gb'])
+        self.assertEqual(['Datera', 'east'],
+                         [pool['pool_name'] for pool in stats['pools']])
+        self.assertNotIn('volume_backend_name', stats['pools'][1])
+        self.assertEqual(30, stats['pools'][1]['free_capacity_gb'])
+
+    def test_multi_cluster_create_scheduled_pool(self):
+        driver = self._multi_cluster_driver()
+        testvol = _stub_volume()
+        testvol['host'] = 'host@datera#east'
+        with mock.patch.object(driver.clusters['east'],
+                               '_create_volume_2_2') as create:
+            self.assertEqual({'provider_id': 'east'},
+                             driver.create_volume(testvol))
+            create.assert_called_once_with(testvol)
+        self.assertEqual([], driver.clusters['Datera'].api.mock_calls)
+
+    def test_multi_cluster_create_least_loaded(self):
+        driver = self._multi_cluster_driver()
+        driver.clusters['Datera'].cluster_stats = {'free_capacity_gb': 50}
+        driver.clusters['east'].cluster_stats = {'free_capacity_gb': 60}
+        # Two operations already running on east leave it 20 GB per slot
+        driver.clusters['east'].ops_in_flight = 2
+        testvol = _stub_volume()
+        testvol['host'] = 'host@datera#gone'
+        with mock.patch.object(driver.clusters['Datera'],
+                               '_create_volume_2_2'):
+            self.assertEqual({'provider_id': 'Datera'},
+                             driver.create_volume(testvol))
+
+    def test_multi_cluster_routes_by_provider_id(self):
+        driver = self._multi_cluster_driver()
+        testvol = _stub_volume()
+        testvol['provider_id'] = 'east'
+        testsnap = _stub_snapshot(volume_id=testvol['id'])
+        testsnap['provider_id'] = 'east'
+        with mock.patch.object(driver.clusters['east'],
+                               '_delete_volume_2_2') as delete, \
+                mock.patch.object(driver.clusters['east'],
+                                  '_create_volume_from_snapshot_2_2') as \
+                create:
+            driver.delete_volume(testvol)
+            delete.assert_called_once_with(testvol)
+            newvol = _stub_volume(id=str(uuid.uuid4()))
+            newvol['host'] = 'host@datera#Datera'
+            # A snapshot can only be cloned on its own cluster
+            self.assertEqual(
+                {'provider_id': 'east'},
+                driver.create_volume_from_snapshot(newvol, testsnap))
+            create.assert_called_once_with(newvol, testsnap)
+
+    def test_multi_cluster_update_provider_info(self):
+        driver = self._multi_cluster_driver()
+        old = _stub_volume()
+        old['host'] = 'host@datera#Datera'
+        new = _stub_volume(id=str(uuid.uuid4()))
+        new['provider_id'] = 'east'
+        snap = _stub_snapshot(volume_id=old['id'])
+        volume_updates, snapshot_updates = driver.update_provider_info(
+            [old, new], [snap])
+        self.assertEqual([{'id': old['id'], 'provider_id': 'Datera'}],
+                         volume_updates)
+        self.assertEqual([{'id': snap['id'], 'provider_id': 'Datera'}],
+                         snapshot_updates)
+        self.assertEqual((None, None),
+                         self.driver.update_provider_info([old], [snap]))
+
 
 class DateraVolumeTestCasev21(DateraVolumeTestCasev22):
 
+    # QoS and metadata look the new volume up again, and resizing offlines
+    # the app_instance around it
+    CALL_COUNTS = dict(DateraVolumeTestCasev22.CALL_COUNTS,
+                       create_volume=7, extend_volume=6)
+
     def setUp(self):
         super(DateraVolumeTestCasev21, self).setUp()
         self.driver.api = mock.MagicMock()
@@ -470,9 +1925,17 @@ def _stub_volume(*args, **kwargs):
     volume['size'] = kwargs.get('size', size)
     volume['provider_location'] = kwargs.get('provider_location', None)
     volume['volume_type_id'] = kwargs.get('volume_type_id', None)
+    volume['status'] = kwargs.get('status', 'available')
     return volume
 
 
+def _stub_volume_type(extra_specs):
+    return {'name': 'datera-type',
+            'id': 'type-id',
+            'qos_specs_id': None,
+            'extra_specs': extra_specs}
+
+
 def _stub_snapshot(*args, **kwargs):
     uuid = '0bb34f0c-fea4-48e0-bf96-591120ac7e3c'
     name = 'snapshot-00000001'
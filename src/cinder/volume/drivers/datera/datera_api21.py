@@ -15,12 +15,12 @@
 
 import contextlib
 import ipaddress
+import itertools
 import math
 import random
 import time
 import uuid
 
-import eventlet
 from os_brick import exception as brick_exception
 from oslo_log import log as logging
 from oslo_serialization import jsonutils as json
@@ -156,6 +156,7 @@ class DateraApi(object):
     # =================
 
     def _delete_volume_2_1(self, volume):
+        self.snapshot_index.pop(volume['id'], None)
         try:
             tenant = self.get_tenant(volume['project_id'])
             ai = self.cvol_to_ai(volume, tenant=tenant)
@@ -177,6 +178,9 @@ class DateraApi(object):
             msg = ("Tried to delete volume %s, but it was not found in the "
                    "Datera cluster. Continuing with delete.")
             LOG.info(msg, datc.get_name(volume))
+        # Only once it is gone, so a failed delete leaves the volume cached
+        # on the other nodes
+        self.publish_invalidation('volume', volume['id'])
 
     # =================
     # = Ensure Export =
@@ -384,6 +388,9 @@ class DateraApi(object):
         }
         snap = dvol.snapshots.create(tenant=tenant, **snap_params)
         self._snap_poll_2_1(snap, tenant)
+        # The timestamp is the snapshot's key, so later lookups can GET it
+        # directly instead of searching the volume's snapshots for the uuid
+        return {'provider_location': snap.utc_ts}
 
     # ===================
     # = Delete Snapshot =
@@ -396,18 +403,8 @@ class DateraApi(object):
         tenant = self.get_tenant(dummy_vol['project_id'])
         dvol = self.cvol_to_dvol(dummy_vol, tenant=tenant)
 
-        snapshots = None
-
-        # Shortcut if this is a managed snapshot
-        provider_location = snapshot.get('provider_location')
-        if provider_location:
-            snap = dvol.snapshots.get(provider_location, tenant=tenant)
-            snap.delete(tenant=tenant)
-            return
-
-        # Long-way.  UUID identification
         try:
-            snapshots = dvol.snapshots.list(tenant=tenant)
+            snap = self._find_snapshot_2_1(dvol, snapshot, tenant)
         except exception.NotFound:
             msg = ("Tried to delete snapshot %s, but parent volume %s was "
                    "not found in Datera cluster. Continuing with delete.")
@@ -416,17 +413,52 @@ class DateraApi(object):
                      datc.get_name({'id': snapshot['volume_id']}))
             return
 
-        try:
-            for snap in snapshots:
-                if snap.uuid == snapshot['id']:
-                    snap.delete(tenant=tenant)
-                    break
-            else:
-                raise exception.NotFound
-        except exception.NotFound:
+        if snap is None:
             msg = ("Tried to delete snapshot %s, but was not found in "
                    "Datera cluster. Continuing with delete.")
             LOG.info(msg, datc.get_name(snapshot))
+            return
+        snap.delete(tenant=tenant)
+        self.snapshot_index.get(snapshot['volume_id'], {}).pop(
+            snapshot['id'], None)
+        self.publish_invalidation('snapshot', snapshot['volume_id'],
+                                  snapshot['id'])
+
+    def _find_snapshot_2_1(self, dvol, snapshot, tenant):
+        """Gets a snapshot with a keyed GET where we can
+
+        Snapshots carry their timestamp in provider_location, except for
+        ones created before we recorded it.  Those are looked up in the
+        uuid index, which a single listing of the parent volume fills in
+        for all of its snapshots.  Returns None if the snapshot is gone.
+        """
+        index = self.snapshot_index.setdefault(snapshot['volume_id'], {})
+        timestamp = snapshot.get('provider_location')
+        if not timestamp:
+            timestamp = index.get(snapshot['id'])
+            self._count_cache('snapshot_index', bool(timestamp))
+        if timestamp:
+            try:
+                return dvol.snapshots.get(timestamp, tenant=tenant)
+            except dexceptions.ApiNotFoundError:
+                index.pop(snapshot['id'], None)
+                if snapshot.get('provider_location'):
+                    return None
+
+        # Pages already fetched are indexed in full, the rest aren't
+        # fetched once the snapshot turns up
+        found = None
+        for page in self.list_pages(dvol.snapshots,
+                                    fields=('uuid', 'utc_ts'),
+                                    tenant=tenant):
+            for snap in page:
+                if snap.uuid:
+                    index[snap.uuid] = snap.utc_ts
+                if snap.uuid == snapshot['id']:
+                    found = snap
+            if found:
+                break
+        return found
 
     # ========================
     # = Volume From Snapshot =
@@ -438,18 +470,9 @@ class DateraApi(object):
                      'project_id': snapshot['project_id']}
         tenant = self.get_tenant(dummy_vol['project_id'])
         dvol = self.cvol_to_dvol(dummy_vol, tenant=tenant)
-        found_snap = None
-        provider_location = snapshot.get('provider_location')
-        if provider_location:
-            found_snap = dvol.snapshots.get(provider_location, tenant=tenant)
-        else:
-            snapshots = dvol.snapshots.list(tenant=tenant)
-            for snap in snapshots:
-                if snap.uuid == snapshot['id']:
-                    found_snap = snap
-                    break
-            else:
-                raise exception.SnapshotNotFound(snapshot_id=snapshot['id'])
+        found_snap = self._find_snapshot_2_1(dvol, snapshot, tenant)
+        if found_snap is None:
+            raise exception.SnapshotNotFound(snapshot_id=snapshot['id'])
 
         self._snap_poll_2_1(found_snap, tenant)
 
@@ -537,6 +560,10 @@ class DateraApi(object):
                      'project_id': volume['project_id']}
         tenant = self.get_tenant(volume['project_id'])
         ai = self.cvol_to_ai(dummy_vol, tenant=tenant)
+        if ai.name.startswith(datc.DELETE_PREFIX):
+            raise exception.ManageExistingInvalidReference(
+                existing_ref=existing_ref,
+                reason=_("App Instance is pending deletion"))
         data = {'name': datc.get_name(volume)}
         ai.set(tenant=tenant, **data)
         self._add_vol_meta_2_1(volume)
@@ -564,7 +591,8 @@ class DateraApi(object):
             tenant = self.get_tenant(cinder_volumes[0]['project_id'])
         else:
             tenant = None
-        app_instances = self.api.app_instances.list(tenant=tenant)
+        app_instances = self.paged_list(self.api.app_instances,
+                                        fields=('name',), tenant=tenant)
 
         results = []
 
@@ -575,6 +603,9 @@ class DateraApi(object):
 
         for ai in app_instances:
             ai_name = ai['name']
+            # Pending deferred deletes belong to the reaper
+            if ai_name.startswith(datc.DELETE_PREFIX):
+                continue
             reference = None
             size = None
             safe_to_manage = False
@@ -590,7 +621,9 @@ class DateraApi(object):
             vol_name = vol.name
             size = vol.size
             snaps = [(snap.utc_ts, snap.uuid)
-                     for snap in vol.snapshots.list(tenant=tenant)]
+                     for snap in self.paged_list(
+                         vol.snapshots, fields=('utc_ts', 'uuid'),
+                         tenant=tenant)]
             extra_info["snapshots"] = json.dumps(snaps)
             reference = {"source-name": "{}:{}:{}".format(
                 ai_name, si_name, vol_name)}
@@ -857,7 +890,10 @@ class DateraApi(object):
     def _get_vol_timestamp_2_1(self, volume):
         tenant = self.get_tenant(volume['project_id'])
         dvol = self.cvol_to_dvol(volume, tenant=tenant)
-        snapshots = dvol.snapshots.list(tenant=tenant)
+        # Only whether there's exactly one matters
+        snapshots = list(itertools.islice(
+            self.paged_list(dvol.snapshots, page_size=2,
+                            fields=('utc_ts',), tenant=tenant), 2))
         if len(snapshots) == 1:
             return float(snapshots[0].utc_ts)
         else:
@@ -906,7 +942,7 @@ class DateraApi(object):
                                   "polling period")
                         raise
                     LOG.debug("Failed to login to portal, retrying")
-                    eventlet.sleep(2)
+                    datc.deadline_sleep(self.thread_local, 2)
             device_path = attach_info['path']
             yield device_path
         finally:
@@ -923,7 +959,7 @@ class DateraApi(object):
     # ===========
 
     def _snap_poll_2_1(self, snap, tenant):
-        eventlet.sleep(datc.DEFAULT_SNAP_SLEEP)
+        datc.deadline_sleep(self.thread_local, datc.DEFAULT_SNAP_SLEEP)
         TIMEOUT = 20
         retry = 0
         poll = True
@@ -933,14 +969,14 @@ class DateraApi(object):
             if snap.op_state == 'available':
                 poll = False
             else:
-                eventlet.sleep(1)
+                datc.deadline_sleep(self.thread_local, 1)
         if retry >= TIMEOUT:
             raise exception.VolumeDriverException(
                 message=_('Snapshot not ready.'))
 
     def _si_poll_2_1(self, volume, si, tenant):
         # Initial 4 second sleep required for some Datera versions
-        eventlet.sleep(datc.DEFAULT_SI_SLEEP)
+        datc.deadline_sleep(self.thread_local, datc.DEFAULT_SI_SLEEP)
         TIMEOUT = 10
         retry = 0
         poll = True
@@ -950,7 +986,7 @@ class DateraApi(object):
             if si.op_state == 'available':
                 poll = False
             else:
-                eventlet.sleep(1)
+                datc.deadline_sleep(self.thread_local, 1)
         if retry >= TIMEOUT:
             raise exception.VolumeDriverException(
                 message=_('Resource not ready.'))
@@ -1044,7 +1080,9 @@ class DateraApi(object):
         """Takes a string ipaddress and return the ip_pool API object dict """
         pool = 'default'
         ip_obj = ipaddress.ip_address(six.text_type(ip))
-        ip_pools = self.api.access_network_ip_pools.list(tenant=tenant)
+        ip_pools = self.paged_list(self.api.access_network_ip_pools,
+                                   fields=('name', 'network_paths'),
+                                   tenant=tenant)
         for ipdata in ip_pools:
             for adata in ipdata['network_paths']:
                 if not adata.get('start_ip'):
@@ -15,6 +15,7 @@
 
 import contextlib
 import ipaddress
+import itertools
 import math
 import random
 import time
@@ -28,9 +29,11 @@ from oslo_utils import importutils
 from oslo_utils import units
 import six
 
+from cinder import context as cinder_context
 from cinder import exception
 from cinder.i18n import _
 from cinder.image import image_utils
+from cinder import objects
 from cinder import utils
 import cinder.volume.drivers.datera.datera_common as datc
 from cinder.volume import volume_types
@@ -54,6 +57,7 @@ class DateraApi(object):
 
     def _create_volume_2_2(self, volume):
         policies = self._get_policies_for_resource(volume)
+        self._apply_pool_placement_2_2(volume, policies)
         num_replicas = int(policies['replica_count'])
         storage_name = 'storage-1'
         volume_name = 'volume-1'
@@ -113,10 +117,22 @@ class DateraApi(object):
             else:
                 create_vol['placement_mode'] = placement
 
+        # Send the performance_policy along with the volume when the cluster
+        # accepts it nested, otherwise set it on the volume we get back.
+        # Either way we skip looking the new volume up again.
+        qos = self._get_qos_2_2(volume, policies)
+        nested_qos = False
+        if qos and not template and self._support_nested_qos_2_2():
+            create_vol['performance_policy'] = qos
+            nested_qos = True
+
         tenant = self.create_tenant(volume['project_id'])
-        self.api.app_instances.create(tenant=tenant, **app_params)
-        self._update_qos_2_2(volume, policies)
-        self._add_vol_meta_2_2(volume)
+        ai = self.api.app_instances.create(tenant=tenant, **app_params)
+        if qos and not nested_qos:
+            dvol = datc.ai_to_dvol(ai)
+            dvol.performance_policy.create(tenant=tenant, **qos)
+        self._add_vol_meta_2_2(volume, ai=ai, tenant=tenant)
+        self._tally_ai_2_2(volume['id'], ai, tenant, size=volume['size'])
 
     # =================
     # = Extend Volume =
@@ -139,11 +155,31 @@ class DateraApi(object):
                         {'volume': volume, 'template': template})
             return
 
-        with self._offline_flip_2_2(volume):
-            # Change Volume Size
-            tenant = self.get_tenant(volume['project_id'])
+        tenant = self.get_tenant(volume['project_id'])
+        online = self._support_online_resize_2_2()
+        if online:
+            # No need to take the target away from an attached guest
             dvol = self.cvol_to_dvol(volume, tenant)
-            dvol.set(tenant=tenant, size=new_size)
+            try:
+                dvol.set(tenant=tenant, size=new_size)
+            except (dexceptions.ApiInvalidRequestError,
+                    dexceptions.ApiConflictError) as e:
+                LOG.warning("Online resize of volume %(volume)s was "
+                            "rejected, resizing it offline: %(error)s",
+                            {'volume': volume['id'], 'error': e})
+                online = False
+        if not online:
+            with self._offline_flip_2_2(volume):
+                # Change Volume Size
+                dvol = self.cvol_to_dvol(volume, tenant)
+                dvol.set(tenant=tenant, size=new_size)
+
+        self.provision_tally.resize(volume['id'], new_size)
+
+        # Per-GB limits scale with the new size
+        if self._has_per_gb_qos_2_2(policies):
+            self._update_qos_2_2(volume, policies, size=new_size, dvol=dvol,
+                                 tenant=tenant)
 
     # =================
     # = Cloned Volume =
@@ -159,39 +195,132 @@ class DateraApi(object):
             'uuid': str(volume['id']),
             'clone_volume_src': {'path': src},
         }
-        tenant = self.get_tenant(volume['project_id'])
-        self.api.app_instances.create(tenant=tenant, **data)
+        resize = self._clone_size_2_2(data, src, volume, src_vref['size'])
+        try:
+            ai = self.api.app_instances.create(tenant=tenant, **data)
+        except dexceptions.ApiInvalidRequestError as e:
+            if 'template_override' not in data:
+                raise
+            LOG.warning("Sized clone of volume %(volume)s was rejected, "
+                        "cloning it at the source size and extending it: "
+                        "%(error)s", {'volume': volume['id'], 'error': e})
+            del data['template_override']
+            ai = self.api.app_instances.create(tenant=tenant, **data)
+            resize = True
+
+        if resize:
+            self._resize_clone_2_2(volume, src_vref['size'])
+        else:
+            self._update_clone_qos_2_2(volume, ai, tenant, src_vref['size'])
+        self._add_vol_meta_2_2(volume, ai=ai, tenant=tenant)
+        self._tally_ai_2_2(volume['id'], ai, tenant, size=volume['size'])
 
-        if volume['size'] > src_vref['size']:
-            self._extend_volume_2_2(volume, volume['size'])
-        self._add_vol_meta_2_2(volume)
+    def _clone_size_2_2(self, app_params, src, volume, src_size):
+        """Sizes a clone in its create call when the cluster allows it
+
+        Returns True if the clone still has to be extended afterwards
+        """
+        if volume['size'] <= src_size:
+            return False
+        if not self._support_template_override_2_2():
+            return True
+        app_params['template_override'] = datc.get_size_override(
+            src, volume['size'])
+        return False
+
+    def _update_clone_qos_2_2(self, volume, ai, tenant, src_size):
+        # A clone sized up in its create call never goes through extend,
+        # so its per-GB limits are worked out for the new size here
+        if volume['size'] <= src_size:
+            return
+        policies = self._get_policies_for_resource(volume)
+        if self._has_per_gb_qos_2_2(policies):
+            self._update_qos_2_2(volume, policies, dvol=datc.ai_to_dvol(ai),
+                                 tenant=tenant)
+
+    def _resize_clone_2_2(self, volume, src_size):
+        # The clone comes up at the source size, which is what extend has
+        # to compare the requested size against
+        vol_size = volume['size']
+        volume['size'] = src_size
+        try:
+            self._extend_volume_2_2(volume, vol_size)
+        finally:
+            volume['size'] = vol_size
 
     # =================
     # = Delete Volume =
     # =================
 
-    def _delete_volume_2_2(self, volume):
+    def _delete_volume_2_2(self, volume, defer=None):
+        self.snapshot_index.pop(volume['id'], None)
+        if defer is None:
+            defer = self.deferred_delete
         try:
             tenant = self.get_tenant(volume['project_id'])
             ai = self.cvol_to_ai(volume, tenant=tenant)
-            si = ai.storage_instances.list(tenant=tenant)[0]
-
-            # Clear out ACL
-            acl = si.acl_policy.get(tenant=tenant)
-            acl.set(tenant=tenant, initiators=[])
-
-            # Bring volume offline
-            data = {
-                'admin_state': 'offline',
-                'force': True
-            }
-            ai.set(tenant=tenant, **data)
-
-            ai.delete(tenant=tenant, force=True)
+            if defer:
+                self._defer_delete_2_2(ai, tenant)
+            else:
+                self._purge_ai_2_2(ai, tenant)
         except exception.NotFound:
             msg = ("Tried to delete volume %s, but it was not found in the "
                    "Datera cluster. Continuing with delete.")
             LOG.info(msg, datc.get_name(volume))
+        # Only once it is gone, or on its way out, so a failed delete
+        # leaves the volume counted and cached on the other nodes
+        self.provision_tally.remove(volume['id'])
+        self.publish_invalidation('volume', volume['id'])
+
+    def _purge_ai_2_2(self, ai, tenant):
+        si = ai.storage_instances.list(tenant=tenant)[0]
+
+        # Clear out ACL
+        acl = si.acl_policy.get(tenant=tenant)
+        acl.set(tenant=tenant, initiators=[])
+
+        # Bring volume offline
+        data = {
+            'admin_state': 'offline',
+            'force': True
+        }
+        ai.set(tenant=tenant, **data)
+
+        ai.delete(tenant=tenant, force=True)
+
+    def _defer_delete_2_2(self, ai, tenant):
+        # ai.id is still the Cinder ID, so a retried delete finds the
+        # renamed app_instance again.  It is already on its way out unless
+        # the reaper gave up on it, so only that case gets journaled anew.
+        if ai.name.startswith(datc.DELETE_PREFIX):
+            if ai.id not in self.delete_journal:
+                self.delete_journal.add(ai.id, tenant, ai.name)
+            return
+        # The rename keeps it out of the manageable listing
+        name = ai.name
+        LOG.debug("Deferring delete of %s, renaming to %s",
+                  name, datc.get_pending_delete(ai.id))
+        ai.set(tenant=tenant, name=datc.get_pending_delete(ai.id))
+        # Journaled only once renamed, so the reaper never purges a volume
+        # whose delete failed
+        self.delete_journal.add(ai.id, tenant, name)
+
+    def _reap_deletes_2_2(self):
+        batch = self.configuration.datera_deferred_delete_batch
+        for ai_id, entry in self.delete_journal.oldest(batch):
+            tenant = entry['tenant']
+            try:
+                ai = self.api.app_instances.get(ai_id, tenant=tenant)
+                self._purge_ai_2_2(ai, tenant)
+            except dexceptions.ApiNotFoundError:
+                LOG.debug("Pending delete %s already gone", entry['name'])
+            except Exception as e:
+                LOG.warning("Deferred delete of %s failed, will retry: %s",
+                            entry['name'], e)
+                self.delete_journal.failed(ai_id)
+                continue
+            LOG.debug("Finished deferred delete of %s", entry['name'])
+            self.delete_journal.remove(ai_id)
 
     # =================
     # = Ensure Export =
@@ -352,7 +481,8 @@ class DateraApi(object):
                 si.auth.set(tenant=tenant, **data)
         # Check to ensure we're ready for go-time
         self._si_poll_2_2(volume, si, tenant)
-        self._add_vol_meta_2_2(volume, connector=connector)
+        self._add_vol_meta_2_2(volume, connector=connector, ai=ai,
+                               tenant=tenant)
 
     # =================
     # = Detach Volume =
@@ -413,6 +543,9 @@ class DateraApi(object):
         }
         snap = dvol.snapshots.create(tenant=tenant, **snap_params)
         self._snap_poll_2_2(snap, tenant)
+        # The timestamp is the snapshot's key, so later lookups can GET it
+        # directly instead of searching the volume's snapshots for the uuid
+        return {'provider_location': snap.utc_ts}
 
     # ===================
     # = Delete Snapshot =
@@ -425,18 +558,8 @@ class DateraApi(object):
         tenant = self.get_tenant(dummy_vol['project_id'])
         dvol = self.cvol_to_dvol(dummy_vol, tenant=tenant)
 
-        snapshots = None
-
-        # Shortcut if this is a managed snapshot
-        provider_location = snapshot.get('provider_location')
-        if provider_location:
-            snap = dvol.snapshots.get(provider_location, tenant=tenant)
-            snap.delete(tenant=tenant)
-            return
-
-        # Long-way.  UUID identification
         try:
-            snapshots = dvol.snapshots.list(tenant=tenant)
+            snap = self._find_snapshot_2_2(dvol, snapshot, tenant)
         except exception.NotFound:
             msg = ("Tried to delete snapshot %s, but parent volume %s was "
                    "not found in Datera cluster. Continuing with delete.")
@@ -445,17 +568,52 @@ class DateraApi(object):
                      datc.get_name({'id': snapshot['volume_id']}))
             return
 
-        try:
-            for snap in snapshots:
-                if snap.uuid == snapshot['id']:
-                    snap.delete(tenant=tenant)
-                    break
-            else:
-                raise exception.NotFound
-        except exception.NotFound:
+        if snap is None:
             msg = ("Tried to delete snapshot %s, but was not found in "
                    "Datera cluster. Continuing with delete.")
             LOG.info(msg, datc.get_name(snapshot))
+            return
+        snap.delete(tenant=tenant)
+        self.snapshot_index.get(snapshot['volume_id'], {}).pop(
+            snapshot['id'], None)
+        self.publish_invalidation('snapshot', snapshot['volume_id'],
+                                  snapshot['id'])
+
+    def _find_snapshot_2_2(self, dvol, snapshot, tenant):
+        """Gets a snapshot with a keyed GET where we can
+
+        Snapshots carry their timestamp in provider_location, except for
+        ones created before we recorded it.  Those are looked up in the
+        uuid index, which a single listing of the parent volume fills in
+        for all of its snapshots.  Returns None if the snapshot is gone.
+        """
+        index = self.snapshot_index.setdefault(snapshot['volume_id'], {})
+        timestamp = snapshot.get('provider_location')
+        if not timestamp:
+            timestamp = index.get(snapshot['id'])
+            self._count_cache('snapshot_index', bool(timestamp))
+        if timestamp:
+            try:
+                return dvol.snapshots.get(timestamp, tenant=tenant)
+            except dexceptions.ApiNotFoundError:
+                index.pop(snapshot['id'], None)
+                if snapshot.get('provider_location'):
+                    return None
+
+        # Pages already fetched are indexed in full, the rest aren't
+        # fetched once the snapshot turns up
+        found = None
+        for page in self.list_pages(dvol.snapshots,
+                                    fields=('uuid', 'utc_ts'),
+                                    tenant=tenant):
+            for snap in page:
+                if snap.uuid:
+                    index[snap.uuid] = snap.utc_ts
+                if snap.uuid == snapshot['id']:
+                    found = snap
+            if found:
+                break
+        return found
 
     # ========================
     # = Volume From Snapshot =
@@ -467,18 +625,9 @@ class DateraApi(object):
                      'project_id': snapshot['project_id']}
         tenant = self.get_tenant(dummy_vol['project_id'])
         dvol = self.cvol_to_dvol(dummy_vol, tenant=tenant)
-        found_snap = None
-        provider_location = snapshot.get('provider_location')
-        if provider_location:
-            found_snap = dvol.snapshots.get(provider_location, tenant=tenant)
-        else:
-            snapshots = dvol.snapshots.list(tenant=tenant)
-            for snap in snapshots:
-                if snap.uuid == snapshot['id']:
-                    found_snap = snap
-                    break
-            else:
-                raise exception.SnapshotNotFound(snapshot_id=snapshot['id'])
+        found_snap = self._find_snapshot_2_2(dvol, snapshot, tenant)
+        if found_snap is None:
+            raise exception.SnapshotNotFound(snapshot_id=snapshot['id'])
 
         self._snap_poll_2_2(found_snap, tenant)
 
@@ -490,11 +639,17 @@ class DateraApi(object):
                 'name': datc.get_name(volume),
                 'clone_snapshot_src': {'path': src},
             })
+        resize = self._clone_size_2_2(
+            app_params, src, volume, snapshot['volume_size'])
 
-        self.api.app_instances.create(tenant=tenant, **app_params)
-        if (volume['size'] > snapshot['volume_size']):
-            self._extend_volume_2_2(volume, volume['size'])
-        self._add_vol_meta_2_2(volume)
+        ai = self.api.app_instances.create(tenant=tenant, **app_params)
+        if resize:
+            self._resize_clone_2_2(volume, snapshot['volume_size'])
+        else:
+            self._update_clone_qos_2_2(
+                volume, ai, tenant, snapshot['volume_size'])
+        self._add_vol_meta_2_2(volume, ai=ai, tenant=tenant)
+        self._tally_ai_2_2(volume['id'], ai, tenant, size=volume['size'])
 
     # ==========
     # = Retype =
@@ -587,9 +742,15 @@ class DateraApi(object):
                      'project_id': volume['project_id']}
         tenant = self.get_tenant(volume['project_id'])
         ai = self.cvol_to_ai(dummy_vol, tenant=tenant)
+        if ai.name.startswith(datc.DELETE_PREFIX):
+            raise exception.ManageExistingInvalidReference(
+                existing_ref=existing_ref,
+                reason=_("App Instance is pending deletion"))
         data = {'name': datc.get_name(volume)}
         ai.set(tenant=tenant, **data)
-        self._add_vol_meta_2_2(volume)
+        self._add_vol_meta_2_2(volume, ai=ai, tenant=tenant)
+        self.provision_tally.remove(app_inst_name)
+        self._tally_ai_2_2(volume['id'], ai, tenant)
 
     # ===================
     # = Manage Get Size =
@@ -614,7 +775,8 @@ class DateraApi(object):
             tenant = self.get_tenant(cinder_volumes[0]['project_id'])
         else:
             tenant = None
-        app_instances = self.api.app_instances.list(tenant=tenant)
+        app_instances = self.paged_list(self.api.app_instances,
+                                        fields=('name',), tenant=tenant)
 
         results = []
 
@@ -625,6 +787,9 @@ class DateraApi(object):
 
         for ai in app_instances:
             ai_name = ai['name']
+            # Pending deferred deletes belong to the reaper
+            if ai_name.startswith(datc.DELETE_PREFIX):
+                continue
             reference = None
             size = None
             safe_to_manage = False
@@ -640,7 +805,9 @@ class DateraApi(object):
             vol_name = vol.name
             size = vol.size
             snaps = [(snap.utc_ts, snap.uuid)
-                     for snap in vol.snapshots.list(tenant=tenant)]
+                     for snap in self.paged_list(
+                         vol.snapshots, fields=('utc_ts', 'uuid'),
+                         tenant=tenant)]
             extra_info["snapshots"] = json.dumps(snaps)
             reference = {"source-name": "{}:{}:{}".format(
                 ai_name, si_name, vol_name)}
@@ -691,6 +858,8 @@ class DateraApi(object):
         tenant = self.get_tenant(volume['project_id'])
         ai = self.cvol_to_ai(volume, tenant=tenant)
         ai.set(tenant=tenant, **data)
+        # Still provisioned on the cluster, just not by Cinder
+        self.provision_tally.rename(volume['id'], data['name'])
 
     # ===================
     # = Manage Snapshot =
@@ -794,6 +963,7 @@ class DateraApi(object):
         cached = self._vol_exists_2_2(src_vol)
 
         if cached:
+            src_vol['size'] = datc._get_size(cached)
             tenant = self.get_tenant(src_vol['project_id'])
             ai = self.cvol_to_ai(src_vol, tenant=tenant)
             metadata = ai.metadata.get(tenant=tenant)
@@ -817,7 +987,9 @@ class DateraApi(object):
             elif mts > ts and metadata.get('type') != 'image':
                 LOG.debug("Cache is older than original image, deleting cache")
                 cached = False
-                self._delete_volume_2_2(src_vol)
+                # The replacement reuses this volume's uuid, so it has to be
+                # gone before we re-cache
+                self._delete_volume_2_2(src_vol, defer=False)
 
         # If we don't have the image, we'll cache it
         if not cached:
@@ -826,12 +998,8 @@ class DateraApi(object):
             self._cache_vol_2_2(context, src_vol, image_meta, image_service)
 
         # Now perform the clone of the found image or newly cached image
+        # The clone is resized to the volume size along the way
         self._create_cloned_volume_2_2(volume, src_vol)
-        # Force volume resize
-        vol_size = volume['size']
-        volume['size'] = 0
-        self._extend_volume_2_2(volume, vol_size)
-        volume['size'] = vol_size
         # Determine if we need to retype the newly created volume
         vtype_id = volume.get('volume_type_id')
         if vtype_id and self.image_type and vtype_id != self.image_type:
@@ -907,7 +1075,10 @@ class DateraApi(object):
     def _get_vol_timestamp_2_2(self, volume):
         tenant = self.get_tenant(volume['project_id'])
         dvol = self.cvol_to_dvol(volume, tenant=tenant)
-        snapshots = dvol.snapshots.list(tenant=tenant)
+        # Only whether there's exactly one matters
+        snapshots = list(itertools.islice(
+            self.paged_list(dvol.snapshots, page_size=2,
+                            fields=('utc_ts',), tenant=tenant), 2))
         if len(snapshots) == 1:
             return float(snapshots[0].utc_ts)
         else:
@@ -956,7 +1127,7 @@ class DateraApi(object):
                                   "polling period")
                         raise
                     LOG.debug("Failed to login to portal, retrying")
-                    eventlet.sleep(2)
+                    datc.deadline_sleep(self.thread_local, 2)
             device_path = attach_info['path']
             yield device_path
         finally:
@@ -973,7 +1144,7 @@ class DateraApi(object):
     # ===========
 
     def _snap_poll_2_2(self, snap, tenant):
-        eventlet.sleep(datc.DEFAULT_SNAP_SLEEP)
+        datc.deadline_sleep(self.thread_local, datc.DEFAULT_SNAP_SLEEP)
         TIMEOUT = 20
         retry = 0
         poll = True
@@ -983,14 +1154,14 @@ class DateraApi(object):
             if snap.op_state == 'available':
                 poll = False
             else:
-                eventlet.sleep(1)
+                datc.deadline_sleep(self.thread_local, 1)
         if retry >= TIMEOUT:
             raise exception.VolumeDriverException(
                 message=_('Snapshot not ready.'))
 
     def _si_poll_2_2(self, volume, si, tenant):
         # Initial 4 second sleep required for some Datera versions
-        eventlet.sleep(datc.DEFAULT_SI_SLEEP)
+        datc.deadline_sleep(self.thread_local, datc.DEFAULT_SI_SLEEP)
         TIMEOUT = 10
         retry = 0
         poll = True
@@ -1000,7 +1171,7 @@ class DateraApi(object):
             if si.op_state == 'available':
                 poll = False
             else:
-                eventlet.sleep(1)
+                datc.deadline_sleep(self.thread_local, 1)
         if retry >= TIMEOUT:
             raise exception.VolumeDriverException(
                 message=_('Resource not ready.'))
@@ -1012,93 +1183,485 @@ class DateraApi(object):
     def _get_volume_stats_2_2(self, refresh=False):
         # cluster_stats is defined by datera_iscsi
         # pylint: disable=access-member-before-definition
-        if refresh or not self.cluster_stats:
+        # With the background refresher running we only wait on the
+        # cluster when there is nothing to report yet
+        if (refresh or not self.cluster_stats) and (
+                not self.stats_refresher or not self.cluster_stats):
             try:
-                LOG.debug("Updating cluster stats info.")
-
-                results = self.api.system.get()
-                self.datera_version = results.sw_version
-
-                if 'uuid' not in results:
-                    LOG.error(
-                        'Failed to get updated stats from Datera Cluster.')
-
-                stats = {
-                    'volume_backend_name': self.backend_name,
-                    'vendor_name': 'Datera',
-                    'driver_version': self.VERSION,
-                    'storage_protocol': 'iSCSI',
-                    'total_capacity_gb': (
-                        int(results.total_capacity) / units.Gi),
-                    'free_capacity_gb': (
-                        int(results.available_capacity) / units.Gi),
-                    'total_flash_capacity_gb': (
-                        int(results.all_flash_total_capacity) / units.Gi),
-                    'total_hybrid_capacity_gb': (
-                        int(results.hybrid_total_capacity) / units.Gi),
-                    'free_flash_capacity_gb': (
-                        int(results.all_flash_available_capacity) / units.Gi),
-                    'free_hybrid_capacity_gb': (
-                        int(results.hybrid_available_capacity) / units.Gi),
-                    'reserved_percentage': 0,
-                    'QoS_support': True,
-                    'compression': results.get('compression_enabled', False),
-                    'compression_ratio': results.get('compression_ratio', '0'),
-                    'l3_enabled': results.get('l3_enabled', False),
-                    'filter_function': self.filterf,
-                    'goodness_function': self.goodnessf
-                }
-
-                self.cluster_stats = stats
+                self._update_cluster_stats_2_2()
             except exception.DateraAPIException:
                 LOG.error('Failed to get updated stats from Datera cluster.')
+        if self.delete_journal:
+            depth, age = self.delete_journal.stats()
+            self.cluster_stats['deferred_delete_queue_depth'] = depth
+            self.cluster_stats['deferred_delete_oldest_age'] = age
+        state = None
+        if self.stats_updated:
+            stats_age = round(time.time() - self.stats_updated, 1)
+            stale = stats_age > self.configuration.datera_stats_stale_after
+            state = 'degraded' if stale else 'up'
+            self.cluster_stats['stats_age'] = stats_age
+        health = self.health.summary()
+        if self.breaker:
+            health.update(self.breaker.summary())
+        state = datc.worst_state(state, self._get_health_state())
+        if state:
+            health['backend_state'] = state
+        self.cluster_stats.update(health)
+        for pool in self.cluster_stats.get('pools', []):
+            pool.update(health)
+        if self.provision_tally.seeded:
+            self._add_provisioned_stats_2_2()
+        self._add_headroom_stats_2_2()
         return self.cluster_stats
 
+    def _add_headroom_stats_2_2(self):
+        # Load indicators for filter_function and goodness_function, on
+        # the backend as well as each pool since those are what the
+        # scheduler evaluates them against
+        headroom = dict(self.cluster_load)
+        headroom.update(self.request_stats.summary())
+        if self.hedging:
+            headroom.update(self.hedging.summary())
+            LOG.debug("Hedged GETs by call site: %s",
+                      self.hedging.counters())
+        if self.scheduler:
+            headroom.update(self.scheduler.summary())
+        headroom['operations_in_flight'] = self.ops_in_flight
+        if self.provision_tally.seeded:
+            headroom['app_instance_count'] = len(
+                self.provision_tally.volumes)
+        self.cluster_stats.update(headroom)
+        for pool in self.cluster_stats.get('pools', []):
+            pool.update(headroom)
+
+    def _add_provisioned_stats_2_2(self):
+        pools, tenants = self.provision_tally.totals()
+        stats = self.cluster_stats
+        stats['provisioned_capacity_gb'] = sum(
+            gb for gb, __ in pools.values())
+        stats['total_volumes'] = sum(count for __, count in pools.values())
+        stats['tenant_provisioned_capacity_gb'] = {
+            tenant: gb for tenant, (gb, __) in tenants.items()}
+        for pool in stats.get('pools', []):
+            gb, count = pools.get(pool['pool_name'], (0, 0))
+            pool['provisioned_capacity_gb'] = gb
+            pool['total_volumes'] = count
+
+    def _seed_provision_tally_2_2(self):
+        """Counts everything provisioned on the cluster, once
+
+        Afterwards the tally is kept up to date by the operations that
+        change it.  Runs on its own greenthread, see
+        _update_cluster_stats_2_2.
+        """
+        if self.tenant_id and self.tenant_id.lower() == 'map':
+            tenants = [datc._format_tenant(t.name)
+                       for t in self.paged_list(self.api.tenants,
+                                                fields=('name',))
+                       if t.name.startswith(datc.OS_PREFIX)]
+        else:
+            tenants = [self.get_tenant(None)]
+        volumes = {}
+        seeded = False
+        self.provision_tally.begin_seed()
+        try:
+            for tenant in tenants:
+                for ai in self.paged_list(
+                        self.api.app_instances,
+                        fields=('name', 'storage_instances'),
+                        tenant=tenant):
+                    name = ai['name']
+                    if (name.startswith(datc.DELETE_PREFIX) or
+                            not ai['storage_instances']):
+                        continue
+                    match = datc.UUID4_RE.match(name)
+                    key = match.group(1) if match else name
+                    vols = [vol for si in ai['storage_instances']
+                            for vol in si['volumes']]
+                    volumes[key] = (self._get_vol_pool_2_2(vols[0]), tenant,
+                                    sum(vol['size'] for vol in vols))
+            self.provision_tally.seed(volumes)
+            seeded = True
+            LOG.debug("Counted %s provisioned app_instances", len(volumes))
+        except Exception as e:
+            LOG.warning("Could not count provisioned capacity, will retry "
+                        "on the next stats update: %s", e)
+        finally:
+            # Timeouts and kills aren't Exceptions, and would otherwise
+            # leave the tally replaying changes for good
+            if not seeded:
+                self.provision_tally.abort_seed()
+            self.seeder = None
+
+    def _tally_ai_2_2(self, key, ai, tenant, size=None):
+        vol = ai['storage_instances'][0]['volumes'][0]
+        if size is None:
+            size = vol['size']
+        self.provision_tally.set(key, self._get_vol_pool_2_2(vol), tenant,
+                                 size)
+
+    def _get_vol_pool_2_2(self, vol):
+        """Names the pool a backend volume counts towards"""
+        if not self.placement_pools:
+            return self.backend_name
+        policy = vol.get('placement_policy')
+        if policy:
+            return policy['path'].split('/')[-1]
+        return vol.get('placement_mode', self.backend_name)
+
+    def _update_cluster_stats_2_2(self):
+        LOG.debug("Updating cluster stats info.")
+        if not self.provision_tally.seeded and not self.seeder:
+            # Listing every app_instance can take longer than a stats
+            # refresh may, so the seed runs outside of it
+            self.seeder = eventlet.spawn(self._seed_provision_tally_2_2)
+
+        results, self.cluster_load, updated = self._get_system_2_2()
+        self.datera_version = results.sw_version
+
+        if 'uuid' not in results:
+            LOG.error(
+                'Failed to get updated stats from Datera Cluster.')
+
+        stats = {
+            'volume_backend_name': self.backend_name,
+            'vendor_name': 'Datera',
+            'driver_version': self.VERSION,
+            'storage_protocol': 'iSCSI',
+            'total_capacity_gb': (
+                int(results.total_capacity) / units.Gi),
+            'free_capacity_gb': (
+                int(results.available_capacity) / units.Gi),
+            'total_flash_capacity_gb': (
+                int(results.all_flash_total_capacity) / units.Gi),
+            'total_hybrid_capacity_gb': (
+                int(results.hybrid_total_capacity) / units.Gi),
+            'free_flash_capacity_gb': (
+                int(results.all_flash_available_capacity) / units.Gi),
+            'free_hybrid_capacity_gb': (
+                int(results.hybrid_available_capacity) / units.Gi),
+            'reserved_percentage': 0,
+            'thin_provisioning_support': True,
+            'thick_provisioning_support': False,
+            'max_over_subscription_ratio': self.configuration.safe_get(
+                'max_over_subscription_ratio'),
+            'QoS_support': True,
+            'compression': results.get('compression_enabled', False),
+            'compression_ratio': results.get('compression_ratio', '0'),
+            'l3_enabled': results.get('l3_enabled', False),
+            'filter_function': self.filterf,
+            'goodness_function': self.goodnessf
+        }
+
+        if self.placement_pools:
+            stats['pools'] = self._get_placement_pools_2_2(results)
+
+        self.cluster_stats = stats
+        self.stats_updated = updated
+
+    def _get_system_2_2(self):
+        """The system entity, its load and when they were fetched
+
+        A snapshot fetched by another backend on the same cluster since
+        this one last updated its stats is used rather than asking again.
+        """
+        shared = self.shared
+        with shared.stats_lock:
+            fetch = (not shared.system_updated or
+                     shared.system_updated <= (self.stats_updated or 0))
+            self._count_cache('system', not fetch)
+            if fetch:
+                system = self.api.system.get()
+                shared.cluster_load = self._get_cluster_load_2_2(system)
+                shared.system = system
+                shared.system_updated = time.time()
+            return (shared.system, dict(shared.cluster_load),
+                    shared.system_updated)
+
+    def _get_cluster_load_2_2(self, system):
+        load = {}
+        for tier, total, free in (
+                ('flash', system.all_flash_total_capacity,
+                 system.all_flash_available_capacity),
+                ('hybrid', system.hybrid_total_capacity,
+                 system.hybrid_available_capacity)):
+            total, free = int(total), int(free)
+            load[tier + '_utilization'] = (
+                round(100.0 * (total - free) / total, 1) if total else 0)
+
+        # Metrics the cluster doesn't know about aren't asked for again
+        connection = self.api.context.connection
+        for field, metric in datc.LOAD_METRICS.items():
+            if metric in self.shared.unavailable_metrics:
+                continue
+            try:
+                data = connection.read_endpoint(
+                    '/system/metrics/{}'.format(metric))
+            except (dexceptions.ApiNotFoundError,
+                    dexceptions.ApiInvalidRequestError):
+                LOG.debug("Cluster metric %s is unavailable", metric)
+                self.shared.unavailable_metrics.add(metric)
+                continue
+            except dexceptions.ApiError as e:
+                LOG.debug("Could not read cluster metric %s: %s", metric, e)
+                continue
+            value = datc.latest_metric_value(data)
+            if value is not None:
+                load[field] = value
+        return load
+
+    def _get_placement_pools_2_2(self, system):
+        capacity = {
+            None: (system.total_capacity, system.available_capacity),
+            'flash': (system.all_flash_total_capacity,
+                      system.all_flash_available_capacity),
+            'hybrid': (system.hybrid_total_capacity,
+                       system.hybrid_available_capacity)}
+        defaults = self._get_policies_for_volume_type(None)
+        if datc.dat_version_gte(self.datera_version, '3.3.0.0'):
+            names = [pp.name for pp in self.paged_list(
+                self.api.placement_policies, fields=('name',))]
+            default = defaults['placement_policy']
+        else:
+            names = datc.PLACEMENT_MODES
+            default = defaults['placement_mode']
+        pools = []
+        for name in names:
+            media = datc.get_pool_media(name)
+            if media is None and name != default:
+                # The cluster doesn't report capacity per placement policy,
+                # and handing each one all of it would overcommit the
+                # cluster once per pool
+                total = free = 'unknown'
+            else:
+                total, free = capacity[media]
+                total, free = int(total) / units.Gi, int(free) / units.Gi
+            pools.append({
+                'pool_name': name,
+                'total_capacity_gb': total,
+                'free_capacity_gb': free,
+                'reserved_percentage': 0,
+                'thin_provisioning_support': True,
+                'thick_provisioning_support': False,
+                'max_over_subscription_ratio': self.configuration.safe_get(
+                    'max_over_subscription_ratio'),
+                'QoS_support': True,
+                'filter_function': self.filterf,
+                'goodness_function': self.goodnessf})
+        return pools
+
+    def _apply_pool_placement_2_2(self, volume, policies):
+        """Places the volume according to the pool it was scheduled to
+
+        The volume-type's own placement wins, the pool only stands in for
+        the configured default.
+        """
+        if not self.placement_pools or not volume.get('host'):
+            return
+        pool = volutils.extract_host(volume['host'], 'pool')
+        if not pool:
+            return
+        if datc.dat_version_gte(self.datera_version, '3.3.0.0'):
+            key = 'placement_policy'
+        elif pool in datc.PLACEMENT_MODES:
+            key = 'placement_mode'
+        else:
+            return
+        default = self._init_vendor_properties()[0]['DF:' + key]['default']
+        if str(policies[key]) == str(default):
+            policies[key] = pool
+
     # =======
     # = QoS =
     # =======
 
-    def _update_qos_2_2(self, volume, policies, clear_old=False):
-        tenant = self.get_tenant(volume['project_id'])
-        dvol = self.cvol_to_dvol(volume, tenant=tenant)
+    def _get_qos_2_2(self, volume, policies, size=None):
+        """Returns the performance_policy values for a volume of this size
+
+        size stands in for the volume's size, for volumes being resized
+        """
         type_id = volume.get('volume_type_id', None)
-        if type_id is not None:
-            iops_per_gb = int(policies.get('iops_per_gb', 0))
-            bandwidth_per_gb = int(policies.get('bandwidth_per_gb', 0))
-            # Filter for just QOS policies in result. All of their keys
-            # should end with "max"
-            fpolicies = {k: int(v) for k, v in
-                         policies.items() if k.endswith("max")}
-            # Filter all 0 values from being passed
-            fpolicies = {k: int(v) for k, v in
-                         fpolicies.items() if v > 0}
-            # Calculate and set iops/gb and bw/gb, but only if they don't
-            # exceed total_iops_max and total_bw_max aren't set since they take
-            # priority
-            if iops_per_gb:
-                ipg = iops_per_gb * volume['size']
-                # Not using zero, because zero means unlimited
-                im = fpolicies.get('total_iops_max', 1)
-                r = ipg
-                if ipg > im:
-                    r = im
-                fpolicies['total_iops_max'] = r
-            if bandwidth_per_gb:
-                bpg = bandwidth_per_gb * volume['size']
-                # Not using zero, because zero means unlimited
-                bm = fpolicies.get('total_bandwidth_max', 1)
-                r = bpg
-                if bpg > bm:
-                    r = bm
-                fpolicies['total_bandwidth_max'] = r
-            if fpolicies or clear_old:
-                try:
-                    pp = dvol.performance_policy.get(tenant=tenant)
-                    pp.delete(tenant=tenant)
-                except dexceptions.ApiNotFoundError:
-                    LOG.debug("No existing performance policy found")
-            if fpolicies:
+        if type_id is None:
+            return {}
+        if size is None:
+            size = volume['size']
+        iops_per_gb = int(policies.get('iops_per_gb', 0))
+        bandwidth_per_gb = int(policies.get('bandwidth_per_gb', 0))
+        # Filter for just QOS policies in result. All of their keys
+        # should end with "max"
+        fpolicies = {k: int(v) for k, v in
+                     policies.items() if k.endswith("max")}
+        # Filter all 0 values from being passed
+        fpolicies = {k: int(v) for k, v in
+                     fpolicies.items() if v > 0}
+        # Calculate and set iops/gb and bw/gb, but only if they don't
+        # exceed total_iops_max and total_bw_max aren't set since they take
+        # priority
+        if iops_per_gb:
+            ipg = iops_per_gb * size
+            # Not using zero, because zero means unlimited
+            im = fpolicies.get('total_iops_max', 1)
+            r = ipg
+            if ipg > im:
+                r = im
+            fpolicies['total_iops_max'] = r
+        if bandwidth_per_gb:
+            bpg = bandwidth_per_gb * size
+            # Not using zero, because zero means unlimited
+            bm = fpolicies.get('total_bandwidth_max', 1)
+            r = bpg
+            if bpg > bm:
+                r = bm
+            fpolicies['total_bandwidth_max'] = r
+        return fpolicies
+
+    def _update_qos_2_2(self, volume, policies, clear_old=False, size=None,
+                        dvol=None, tenant=None, dry_run=False):
+        """Brings the volume's performance_policy in line with policies
+
+        The current policy is compared with the target first, so nothing
+        is written when they already match and a change is a single set.
+        Callers that just resized the volume pass the new size, and those
+        holding the volume entity pass it in to save looking it up again.
+        Returns the change as {'current': ..., 'target': ...}, or None if
+        there was nothing to do.  With dry_run the change isn't applied.
+        """
+        type_id = volume.get('volume_type_id', None)
+        if type_id is None:
+            return None
+        fpolicies = self._get_qos_2_2(volume, policies, size=size)
+        if not (fpolicies or clear_old):
+            return None
+        if tenant is None:
+            tenant = self.get_tenant(volume['project_id'])
+        if dvol is None:
+            dvol = self.cvol_to_dvol(volume, tenant=tenant)
+        try:
+            pp = dvol.performance_policy.get(tenant=tenant)
+        except dexceptions.ApiNotFoundError:
+            LOG.debug("No existing performance policy found")
+            if not fpolicies:
+                return None
+            if not dry_run:
                 dvol.performance_policy.create(tenant=tenant, **fpolicies)
+            return {'current': {}, 'target': fpolicies}
+        current = {k: int(v or 0) for k, v in pp.items() if k.endswith("max")}
+        if not fpolicies:
+            if not dry_run:
+                pp.delete(tenant=tenant)
+            return {'current': current, 'target': {}}
+        # Limits the target leaves out go back to unlimited
+        target = dict.fromkeys(current, 0)
+        target.update(fpolicies)
+        if target == current:
+            LOG.debug("Performance policy already up to date: %s", current)
+            return None
+        if not dry_run:
+            pp.set(tenant=tenant, **target)
+        return {'current': current, 'target': target}
+
+    def _has_per_gb_qos_2_2(self, policies):
+        return bool(int(policies.get('iops_per_gb', 0)) or
+                    int(policies.get('bandwidth_per_gb', 0)))
+
+    # =================
+    # = QoS Rebalance =
+    # =================
+
+    def _rebalance_qos_2_2(self, context, volume_type_id=None,
+                           dry_run=False):
+        if volume_type_id:
+            vtypes = [volume_types.get_volume_type(context, volume_type_id)]
+        else:
+            vtypes = list(volume_types.get_all_types(context).values())
+        report = {'checked': 0, 'changed': {}, 'failed': {}}
+        for vtype in vtypes:
+            self._rebalance_type_qos_2_2(context, vtype, dry_run, report)
+        return report
+
+    def _rebalance_type_qos_2_2(self, context, vtype, dry_run, report):
+        policies = self._get_policies_for_volume_type(vtype)
+        filters = {'volume_type_id': vtype['id']}
+        if self.host:
+            # Matches the host@backend#pool of volumes in our pools too
+            volumes = objects.VolumeList.get_all_by_host(
+                context, self.host, filters=filters)
+        else:
+            volumes = objects.VolumeList.get_all(context, filters=filters)
+        volumes = [vol for vol in volumes
+                   if vol['status'] in ('available', 'in-use') and
+                   self._is_cluster_resource(vol)]
+        total = len(volumes)
+        if not total:
+            return
+        LOG.info("%(action)s QoS of %(total)s volumes of type %(type)s",
+                 {'action': 'Checking' if dry_run else 'Rebalancing',
+                  'total': total, 'type': vtype['name']})
+        # Log progress about every tenth of the way
+        step = max(total // 10, 1)
+        done = [0]
+
+        def _rebalance(volume):
+            try:
+                change = self._update_qos_2_2(volume, policies,
+                                              dry_run=dry_run)
+            except Exception as e:
+                LOG.warning("QoS rebalance of volume %s failed: %s",
+                            volume['id'], e)
+                report['failed'][volume['id']] = six.text_type(e)
+            else:
+                report['checked'] += 1
+                if change:
+                    report['changed'][volume['id']] = change
+                    if dry_run:
+                        LOG.info("Volume %(id)s performance policy would "
+                                 "change from %(current)s to %(target)s",
+                                 dict(change, id=volume['id']))
+            done[0] += 1
+            if done[0] % step == 0 or done[0] == total:
+                LOG.info("QoS rebalance of type %(type)s: %(done)s/%(total)s "
+                         "volumes", {'type': vtype['name'], 'done': done[0],
+                                     'total': total})
+
+        pool = eventlet.GreenPool(
+            self.configuration.datera_qos_rebalance_concurrency)
+        rate = self.configuration.datera_qos_rebalance_rate
+        # The workers' requests belong to this operation
+        _rebalance = datc.with_operation_context(self.thread_local,
+                                                 _rebalance)
+        for volume in volumes:
+            pool.spawn_n(_rebalance, volume)
+            if rate > 0:
+                eventlet.sleep(1.0 / rate)
+        pool.waitall()
+
+    def _check_qos_changes_2_2(self):
+        # Exceptions would stop the looping call for good
+        try:
+            context = cinder_context.get_admin_context()
+            fingerprints = {}
+            for vtype in volume_types.get_all_types(context).values():
+                policies = self._get_policies_for_volume_type(vtype)
+                fingerprints[vtype['id']] = {
+                    k: v for k, v in policies.items()
+                    if k.endswith('max') or k.endswith('per_gb')}
+            previous, self.qos_fingerprints = (
+                self.qos_fingerprints, fingerprints)
+            # The first check only records where things stand
+            if previous is None:
+                return
+            dry_run = self.configuration.datera_qos_rebalance_dry_run
+            for type_id, fingerprint in fingerprints.items():
+                if previous.get(type_id, fingerprint) != fingerprint:
+                    LOG.info("QoS of volume-type %s changed", type_id)
+                    report = self._rebalance_qos_2_2(
+                        context, type_id, dry_run)
+                    if report['failed']:
+                        # Have the next check pick up the stragglers
+                        self.qos_fingerprints[type_id] = previous[type_id]
+        except Exception as e:
+            LOG.warning("QoS rebalance check failed: %s", e)
 
     # ============
     # = IP Pools =
@@ -1108,7 +1671,9 @@ class DateraApi(object):
         """Takes a string ipaddress and return the ip_pool API object dict """
         pool = 'default'
         ip_obj = ipaddress.ip_address(six.text_type(ip))
-        ip_pools = self.api.access_network_ip_pools.list(tenant=tenant)
+        ip_pools = self.paged_list(self.api.access_network_ip_pools,
+                                   fields=('name', 'network_paths'),
+                                   tenant=tenant)
         for ipdata in ip_pools:
             for adata in ipdata['network_paths']:
                 if not adata.get('start_ip'):
@@ -1146,7 +1711,8 @@ class DateraApi(object):
         if reonline:
             ai.set(tenant=tenant, admin_state='online')
 
-    def _add_vol_meta_2_2(self, volume, connector=None):
+    def _add_vol_meta_2_2(self, volume, connector=None, ai=None,
+                          tenant=None):
         if not self.do_metadata:
             return
         metadata = {'host': volume.get('host', ''),
@@ -1157,19 +1723,41 @@ class DateraApi(object):
         if connector:
             metadata.update(connector)
         LOG.debug("Adding volume metadata: %s", metadata)
-        tenant = self.get_tenant(volume['project_id'])
-        ai = self.cvol_to_ai(volume, tenant=tenant)
+        if not tenant:
+            tenant = self.get_tenant(volume['project_id'])
+        # Callers that already hold the app_instance pass it in to save
+        # looking it up again
+        if ai is None:
+            ai = self.cvol_to_ai(volume, tenant=tenant)
         ai.metadata.set(tenant=tenant, **metadata)
 
-    def _support_template_override_2_2(self):
+    def _get_create_schema_2_2(self):
         # Getting the whole api schema is expensive
         # so we only want to do this once per driver
         # instantiation.
+        if not hasattr(self, '_create_schema'):
+            api = self.api.api.get()
+            self._create_schema = api['/app_instances']['create'][
+                'bodyParamSchema']['properties']
+        return self._create_schema
+
+    def _support_template_override_2_2(self):
         if not self.template_override:
             return False
-        if not hasattr(self, '_to_22'):
-            api = self.api.api.get()
-            prop = api['/app_instances']['create']['bodyParamSchema'][
-                'properties']
-            self._to_22 = 'template_override' in prop
-        return self._to_22
+        return 'template_override' in self._get_create_schema_2_2()
+
+    def _support_online_resize_2_2(self):
+        # Volumes can be resized while their app_instance is online in
+        # product versions 3.3.X+, earlier ones need it offlined first
+        return datc.dat_version_gte(self.datera_version, '3.3.0.0')
+
+    def _support_nested_qos_2_2(self):
+        # Newer clusters accept a volume's performance_policy inline in the
+        # app_instance create body
+        prop = self._get_create_schema_2_2()
+        try:
+            vol_prop = prop['storage_instances']['items']['properties'][
+                'volumes']['items']['properties']
+        except (KeyError, TypeError):
+            return False
+        return 'performance_policy' in vol_prop
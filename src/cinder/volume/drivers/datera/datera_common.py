@@ -13,7 +13,14 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+import cProfile
 import functools
+import io
+import itertools
+import json
+import os
+import pstats
 import random
 import re
 import string
@@ -21,9 +28,15 @@ import time
 import types
 import uuid
 
+import eventlet
+from eventlet.green import threading
+from eventlet import queue as eventlet_queue
 from glanceclient import exc as glance_exc
+from oslo_concurrency import lockutils
 from oslo_log import log as logging
 from oslo_utils import importutils
+from oslo_utils import units
+from six.moves.urllib import parse as urlparse
 
 from cinder import context
 from cinder import exception
@@ -38,6 +51,7 @@ dfs_sdk = importutils.try_import('dfs_sdk')
 
 OS_PREFIX = "OS"
 UNMANAGE_PREFIX = "UNMANAGED"
+DELETE_PREFIX = "DELETING"
 
 # Taken from this SO post :
 # http://stackoverflow.com/a/18516125
@@ -54,15 +68,92 @@ DEFAULT_SI_SLEEP = 1
 DEFAULT_SI_SLEEP_API_2 = 5
 DEFAULT_SNAP_SLEEP = 1
 API_VERSIONS = ["2.1", "2.2"]
+# Placement modes, which double as pool names before placement policies
+PLACEMENT_MODES = ["single_flash", "all_flash", "hybrid"]
 API_TIMEOUT = 20
 
+# Seconds a driver operation may take, including its polling, unless set
+# by datera_operation_deadlines.  0 for no deadline.  Operations not listed
+# get datera_operation_deadline
+OPERATION_DEADLINES = {
+    'create_export': 60,
+    'initialize_connection': 60,
+    'ensure_export': 60,
+    'detach_volume': 60,
+    'get_volume_stats': 60,
+    # Background work bounded by its own interval or timeout
+    'update_cluster_stats': 0,
+    'check_qos_changes': 0,
+    'rebalance_qos': 0,
+    'reap_deletes': 0,
+    # Caching an image downloads and converts it, which takes as long as
+    # the image is big
+    'clone_image': 0}
+
+# Operation --> class of the requests it makes, for RequestScheduler.
+# Operations not listed are 'normal'
+REQUEST_CLASSES = {
+    'create_export': 'interactive',
+    'initialize_connection': 'interactive',
+    'ensure_export': 'interactive',
+    'detach_volume': 'interactive',
+    'get_manageable_volumes': 'bulk',
+    'get_manageable_snapshots': 'bulk',
+    'clone_image': 'bulk',
+    'get_volume_stats': 'bulk',
+    'update_cluster_stats': 'bulk',
+    'update_provider_info': 'bulk',
+    'reap_deletes': 'bulk',
+    'check_qos_changes': 'bulk',
+    'rebalance_qos': 'bulk'}
+
+# Metric name --> (Prometheus type, help)
+METRIC_HELP = {
+    'datera_operation_duration_seconds': (
+        'histogram', 'Duration of driver operations'),
+    'datera_operation_errors_total': (
+        'counter', 'Driver operations that raised'),
+    'datera_operations_in_flight': (
+        'gauge', 'Driver operations running'),
+    'datera_operation_requests_total': (
+        'counter', 'REST requests made by driver operations'),
+    'datera_request_duration_seconds': (
+        'histogram', 'Duration of REST requests to the cluster'),
+    'datera_request_errors_total': (
+        'counter', 'REST requests that failed, by exception type'),
+    'datera_request_retries_total': (
+        'counter', 'REST requests failed with a 503 or connection error, '
+                   'which the SDK retries'),
+    'datera_requests_in_flight': (
+        'gauge', 'REST requests to the cluster in flight'),
+    'datera_requests_waiting': (
+        'gauge', 'REST requests waiting on the request scheduler'),
+    'datera_cache_lookups_total': (
+        'counter', 'Cache lookups, by cache and hit or miss')}
+
 VALID_CHARS = set(string.ascii_letters + string.digits + "-_.")
 
+# Stats field --> cluster metric reported in it
+LOAD_METRICS = {'cluster_iops_read': 'iops_read',
+                'cluster_iops_write': 'iops_write',
+                'cluster_bandwidth_read': 'thpt_read',
+                'cluster_bandwidth_write': 'thpt_write'}
+
 
 class DateraAPIException(exception.VolumeBackendAPIException):
     message = _("Bad response from Datera API")
 
 
+class DateraDeadlineExceeded(DateraAPIException):
+    message = _("Datera operation %(operation)s did not finish within its "
+                "%(deadline)ss deadline")
+
+
+class DateraCircuitOpen(DateraAPIException):
+    message = _("Datera cluster %(cluster)s is failing requests, not "
+                "sending more until it recovers")
+
+
 def get_name(resource):
     dn = resource.get('display_name')
     cid = resource.get('id')
@@ -81,30 +172,1312 @@ def get_unmanaged(name):
     return "-".join((UNMANAGE_PREFIX, name))
 
 
+def get_pending_delete(ai_id):
+    return "-".join((DELETE_PREFIX, ai_id))
+
+
 def filter_chars(s):
     if s:
         return ''.join([c for c in s if c in VALID_CHARS])
     return s
 
 
+class DeleteJournal(object):
+    """On-disk record of app_instances waiting on the deferred delete reaper
+
+    Entries are keyed by app_instance id so a rename can't lose track of
+    them.  The whole journal is rewritten on every change, which is fine
+    since it only ever holds the backlog of pending deletes.  An entry is
+    dropped after max_attempts failed purges (0 retries forever).
+    """
+
+    def __init__(self, path, max_attempts=0):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.load()
+
+    def load(self):
+        with self.lock:
+            if not os.path.exists(self.path):
+                self.entries = {}
+                return
+            try:
+                with io.open(self.path, 'r') as f:
+                    self.entries = json.load(f)
+            except (IOError, ValueError) as e:
+                LOG.error("Could not read deferred delete journal %s: %s",
+                          self.path, e)
+                self.entries = {}
+            if self.entries:
+                LOG.info("Resuming %s pending deletes from journal %s",
+                         len(self.entries), self.path)
+
+    def _save(self):
+        tmp = self.path + ".tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.entries, f)
+        os.rename(tmp, self.path)
+
+    def add(self, ai_id, tenant, name):
+        with self.lock:
+            self.entries[ai_id] = {'tenant': tenant,
+                                   'name': name,
+                                   'queued': time.time(),
+                                   'attempts': 0}
+            self._save()
+
+    def remove(self, ai_id):
+        with self.lock:
+            if self.entries.pop(ai_id, None) is not None:
+                self._save()
+
+    def __contains__(self, ai_id):
+        with self.lock:
+            return ai_id in self.entries
+
+    def failed(self, ai_id):
+        with self.lock:
+            entry = self.entries.get(ai_id)
+            if entry is None:
+                return
+            entry['attempts'] += 1
+            if self.max_attempts and entry['attempts'] >= self.max_attempts:
+                LOG.error("Giving up on deferred delete of %s (app_instance "
+                          "%s) after %s attempts, it must be deleted by "
+                          "hand or by deleting the volume again",
+                          entry['name'], ai_id, entry['attempts'])
+                del self.entries[ai_id]
+            self._save()
+
+    def oldest(self, count):
+        with self.lock:
+            items = sorted(self.entries.items(),
+                           key=lambda item: item[1]['queued'])
+        return items[:count]
+
+    def stats(self):
+        """Returns (queue depth, age in seconds of the oldest entry)"""
+        with self.lock:
+            if not self.entries:
+                return 0, 0
+            oldest = min(e['queued'] for e in self.entries.values())
+            return len(self.entries), round(time.time() - oldest, 1)
+
+
+class ProvisionTally(object):
+    """Running totals of provisioned GiB and volume counts
+
+    Totals are kept per pool and per tenant and adjusted as volumes come
+    and go, so reporting them never has to list the cluster.  Volumes are
+    keyed by Cinder volume id, or app_instance name for everything else.
+    seed() replaces the lot with the result of a full listing, replaying
+    the adjustments made while that listing was running.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.seeded = False
+        self.volumes = {}
+        self.pools = {}
+        self.tenants = {}
+        self._replay = None
+        # Called with (key, entry or None) for every change made here, as
+        # opposed to ones applied from elsewhere
+        self.listener = None
+
+    def _count(self, entry, sign):
+        pool, tenant, size = entry
+        for totals, name in ((self.pools, pool), (self.tenants, tenant)):
+            gb, count = totals.get(name, (0, 0))
+            gb, count = gb + sign * size, count + sign
+            if count:
+                totals[name] = (gb, count)
+            else:
+                totals.pop(name, None)
+
+    def _set(self, key, entry):
+        self._remove(key)
+        self.volumes[key] = entry
+        self._count(entry, 1)
+        if self._replay is not None:
+            self._replay.append((key, entry))
+
+    def _remove(self, key):
+        entry = self.volumes.pop(key, None)
+        if entry:
+            self._count(entry, -1)
+        if self._replay is not None:
+            self._replay.append((key, None))
+
+    def _changed(self, *changes):
+        if self.listener:
+            for key, entry in changes:
+                self.listener(key, entry)
+
+    def set(self, key, pool, tenant, size):
+        with self.lock:
+            self._set(key, (pool, tenant, size))
+        self._changed((key, (pool, tenant, size)))
+
+    def remove(self, key):
+        with self.lock:
+            self._remove(key)
+        self._changed((key, None))
+
+    def resize(self, key, size):
+        with self.lock:
+            entry = self.volumes.get(key)
+            if entry:
+                entry = (entry[0], entry[1], size)
+                self._set(key, entry)
+        if entry:
+            self._changed((key, entry))
+
+    def rename(self, key, new_key):
+        with self.lock:
+            entry = self.volumes.get(key)
+            if entry:
+                self._remove(key)
+                self._set(new_key, entry)
+        if entry:
+            self._changed((key, None), (new_key, entry))
+
+    def apply(self, key, entry):
+        """Takes a change made elsewhere, entry None meaning removal"""
+        with self.lock:
+            if entry:
+                self._set(key, tuple(entry))
+            else:
+                self._remove(key)
+
+    def reset(self):
+        """Has the next stats update count everything again"""
+        with self.lock:
+            self.seeded = False
+
+    def begin_seed(self):
+        with self.lock:
+            self._replay = []
+
+    def seed(self, volumes):
+        """Takes {key: (pool, tenant, size)} from a full listing"""
+        with self.lock:
+            replay, self._replay = self._replay or [], None
+            self.volumes, self.pools, self.tenants = {}, {}, {}
+            for key, entry in volumes.items():
+                self._set(key, entry)
+            for key, entry in replay:
+                if entry:
+                    self._set(key, entry)
+                else:
+                    self._remove(key)
+            self.seeded = True
+
+    def abort_seed(self):
+        with self.lock:
+            self._replay = None
+
+    def totals(self):
+        """Copies of the pool and tenant totals, as {name: (GiB, count)}"""
+        with self.lock:
+            return dict(self.pools), dict(self.tenants)
+
+
+class RequestStats(object):
+    """Latency and concurrency of the requests made to the cluster
+
+    Latencies are kept for the last `window` requests.
+    """
+
+    def __init__(self, window=200):
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=window)
+        self.in_flight = 0
+
+    def hook(self, send, *args, **kwargs):
+        """Request hook, see install_request_hook"""
+        with self.lock:
+            self.in_flight += 1
+        start = time.time()
+        try:
+            return send(*args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            with self.lock:
+                self.in_flight -= 1
+                self.latencies.append(elapsed)
+
+    def summary(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            summary = {'api_requests_in_flight': self.in_flight}
+        if latencies:
+            summary['api_latency_avg_ms'] = round(
+                1000 * sum(latencies) / len(latencies), 1)
+            summary['api_latency_p95_ms'] = round(
+                1000 * percentile(latencies, 95), 1)
+        return summary
+
+
+class HealthProbe(object):
+    """Outcomes of the last `window` health probes of the cluster
+
+    A probe is a round trip to a cheap endpoint, recorded with its latency
+    in seconds, or None if it failed.
+    """
+
+    def __init__(self, window=20):
+        self.lock = threading.Lock()
+        self.probes = collections.deque(maxlen=window)
+
+    def record(self, latency):
+        with self.lock:
+            self.probes.append(latency)
+
+    def state(self, degraded_ms):
+        """'up', 'degraded' or 'down', or None before the first probe
+
+        The cluster is down when at least half of the probes failed and
+        degraded when any failed or the p95 latency is over degraded_ms.
+        """
+        with self.lock:
+            probes = list(self.probes)
+        if not probes:
+            return None
+        latencies = sorted(p for p in probes if p is not None)
+        failed = len(probes) - len(latencies)
+        if failed * 2 >= len(probes):
+            return 'down'
+        if failed or 1000 * percentile(latencies, 95) > degraded_ms:
+            return 'degraded'
+        return 'up'
+
+    def summary(self):
+        with self.lock:
+            probes = list(self.probes)
+        if not probes:
+            return {}
+        latencies = sorted(p for p in probes if p is not None)
+        summary = {'probe_error_rate': round(
+            1.0 - float(len(latencies)) / len(probes), 2)}
+        if latencies:
+            for pct in (50, 95, 99):
+                summary['probe_latency_p{}_ms'.format(pct)] = round(
+                    1000 * percentile(latencies, pct), 1)
+        return summary
+
+
+class CircuitBreaker(object):
+    """Fails requests fast while the cluster's API keeps failing them
+
+    After `threshold` failed requests in a row the breaker opens and
+    requests fail right away with DateraCircuitOpen.  `reset_after` seconds
+    later a single request is let through to probe the cluster, closing
+    the breaker if it gets a response and opening it again if it fails.
+    Only the `failures` exceptions count as failures, other API errors are
+    still responses.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, cluster, threshold, reset_after, failures):
+        self.cluster = cluster
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = failures
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failed = 0
+        self.opened = None
+        self.probing = False
+
+    def hook(self, send, *args, **kwargs):
+        """Request hook, see install_request_hook"""
+        probe = self._admit()
+        responded = None
+        try:
+            result = send(*args, **kwargs)
+            responded = True
+            return result
+        except self.failures:
+            responded = False
+            raise
+        except DateraDeadlineExceeded:
+            # The operation ran out of time, which says nothing about the
+            # cluster
+            raise
+        except Exception:
+            responded = True
+            raise
+        finally:
+            self._record(probe, responded)
+
+    def _admit(self):
+        """Whether the request probes the cluster, raises if it can't go"""
+        with self.lock:
+            if self.state == self.OPEN:
+                if time.time() - self.opened < self.reset_after:
+                    raise DateraCircuitOpen(cluster=self.cluster)
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN:
+                if self.probing:
+                    raise DateraCircuitOpen(cluster=self.cluster)
+                self.probing = True
+                return True
+            return False
+
+    def _record(self, probe, responded):
+        with self.lock:
+            if probe:
+                self.probing = False
+            # Requests that didn't finish leave the breaker as it was
+            if responded is None:
+                return
+            if responded:
+                if self.state != self.CLOSED:
+                    LOG.info("Datera cluster %s is responding again, closing "
+                             "its circuit breaker", self.cluster)
+                self.state = self.CLOSED
+                self.failed = 0
+                return
+            self.failed += 1
+            if probe or (self.state == self.CLOSED and
+                         self.failed >= self.threshold):
+                LOG.warning("Datera cluster %(cluster)s failed %(failed)s "
+                            "requests in a row, failing requests fast for "
+                            "%(reset)ss",
+                            {'cluster': self.cluster, 'failed': self.failed,
+                             'reset': self.reset_after})
+                self.state = self.OPEN
+                self.opened = time.time()
+
+    def summary(self):
+        return {'api_circuit_state': self.state,
+                'api_consecutive_failures': self.failed}
+
+
+class HedgedRequests(object):
+    """Sends a second copy of GETs that are slower than usual
+
+    A GET that hasn't been answered by the p95 latency of its call site
+    (its URL with the names left out, eg. app_instances/storage_instances)
+    is sent again through the next of `senders`, or through the same
+    connection without any.  The first answer wins.  At most `max_rate` of
+    a call site's GETs are hedged, and call sites without `min_samples`
+    timed GETs yet aren't hedged at all.  The copies are sent from
+    greenthreads running with the operation context of thread_local.
+    """
+
+    def __init__(self, max_rate, senders=None, window=100, min_samples=20,
+                 thread_local=None):
+        self.max_rate = max_rate
+        self.senders = senders or []
+        self.thread_local = thread_local
+        self.window = window
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+        self.next_sender = 0
+        # Call site --> {'latencies', 'requests', 'hedged', 'hedge_wins'}
+        self.sites = {}
+
+    @staticmethod
+    def get_site(urlpath):
+        return '/'.join(urlpath.strip('/').split('/')[::2])
+
+    def hook(self, send, method, urlpath, *args, **kwargs):
+        """Request hook, see install_request_hook"""
+        if method.upper() != 'GET':
+            return send(method, urlpath, *args, **kwargs)
+        site = self._get_site(urlpath)
+        delay = self._get_delay(site)
+        if delay is None:
+            start = time.time()
+            result = send(method, urlpath, *args, **kwargs)
+            self._record(site, time.time() - start)
+            return result
+        answers = eventlet_queue.LightQueue()
+
+        def _send(sender, hedge):
+            start = time.time()
+            try:
+                answers.put((hedge, True, sender(
+                    method, urlpath, *args, **kwargs)))
+            except Exception as e:
+                answers.put((hedge, False, e))
+            else:
+                self._record(site, time.time() - start)
+
+        if self.thread_local is not None:
+            _send = with_operation_context(self.thread_local, _send)
+        eventlet.spawn_n(_send, send, False)
+        pending = 1
+        try:
+            answer = answers.get(timeout=delay)
+        except eventlet_queue.Empty:
+            answer = None
+            if self._admit_hedge(site):
+                eventlet.spawn_n(_send, self._get_sender(send), True)
+                pending += 1
+        while True:
+            if answer is None:
+                answer = answers.get()
+            pending -= 1
+            hedge, succeeded, result = answer
+            # An error only wins when there's no other answer to wait for
+            if succeeded or not pending:
+                break
+            answer = None
+        if hedge:
+            with self.lock:
+                site['hedge_wins'] += 1
+        if succeeded:
+            return result
+        raise result
+
+    def _get_site(self, urlpath):
+        name = self.get_site(urlpath)
+        with self.lock:
+            if name not in self.sites:
+                self.sites[name] = {
+                    'latencies': collections.deque(maxlen=self.window),
+                    'requests': 0, 'hedged': 0, 'hedge_wins': 0}
+            site = self.sites[name]
+            site['requests'] += 1
+            return site
+
+    def _get_delay(self, site):
+        """Seconds to wait before hedging, None to never hedge"""
+        with self.lock:
+            latencies = sorted(site['latencies'])
+        if len(latencies) < self.min_samples:
+            return None
+        return percentile(latencies, 95)
+
+    def _admit_hedge(self, site):
+        with self.lock:
+            if site['hedged'] >= self.max_rate * site['requests']:
+                return False
+            site['hedged'] += 1
+            return True
+
+    def _get_sender(self, send):
+        if not self.senders:
+            return send
+        with self.lock:
+            sender = self.senders[self.next_sender % len(self.senders)]
+            self.next_sender += 1
+        return sender
+
+    def _record(self, site, latency):
+        with self.lock:
+            site['latencies'].append(latency)
+
+    def counters(self):
+        """Call site --> its request, hedge and hedge win counts"""
+        with self.lock:
+            return {name: {key: site[key]
+                           for key in ('requests', 'hedged', 'hedge_wins')}
+                    for name, site in self.sites.items()}
+
+    def summary(self):
+        counters = self.counters().values()
+        return {'api_hedged_requests': sum(c['hedged'] for c in counters),
+                'api_hedge_wins': sum(c['hedge_wins'] for c in counters)}
+
+
+class RequestScheduler(object):
+    """Admits requests to the cluster by the class of their operation
+
+    At most `concurrency` requests are in flight at once, 0 for no limit,
+    and at most budgets[cls] of those belong to class cls.  Requests over
+    either limit wait, and as room frees up waiting classes are let
+    through in the order of CLASSES.  Waiting counts against the
+    operation's deadline.
+    """
+
+    CLASSES = ('interactive', 'normal', 'bulk')
+
+    def __init__(self, concurrency, budgets, thread_local):
+        self.cond = threading.Condition()
+        self.concurrency = concurrency
+        self.budgets = budgets
+        self.thread_local = thread_local
+        self.in_flight = dict.fromkeys(self.CLASSES, 0)
+        self.waiting = dict.fromkeys(self.CLASSES, 0)
+
+    def classify(self):
+        operation = getattr(self.thread_local, 'operation', None)
+        return REQUEST_CLASSES.get(operation, 'normal')
+
+    def _within_budget(self, cls):
+        budget = self.budgets.get(cls)
+        return not budget or self.in_flight[cls] < budget
+
+    def _admissible(self, cls):
+        if (self.concurrency and
+                sum(self.in_flight.values()) >= self.concurrency):
+            return False
+        if not self._within_budget(cls):
+            return False
+        for other in self.CLASSES[:self.CLASSES.index(cls)]:
+            if self.waiting[other] and self._within_budget(other):
+                return False
+        return True
+
+    def hook(self, send, *args, **kwargs):
+        """Request hook, see install_request_hook"""
+        cls = self.classify()
+        with self.cond:
+            self.waiting[cls] += 1
+            try:
+                while not self._admissible(cls):
+                    self.cond.wait(check_deadline(self.thread_local))
+            finally:
+                self.waiting[cls] -= 1
+            self.in_flight[cls] += 1
+        try:
+            return send(*args, **kwargs)
+        finally:
+            with self.cond:
+                self.in_flight[cls] -= 1
+                self.cond.notify_all()
+
+    def summary(self):
+        with self.cond:
+            return {'api_requests_waiting': sum(self.waiting.values())}
+
+
+class SampledProfiler(object):
+    """Runs one in every `sample_every` operations under cProfile
+
+    While switched on with toggle(), e.g. from a signal handler, every
+    operation is profiled instead.  Sampled operations log how long they
+    took, and the ones taking slow_after seconds or more log their
+    profile as well.  Under eventlet that profile also covers whatever
+    other greenthreads ran while the operation waited, and only one
+    operation in the process is profiled at a time.
+    """
+
+    _lock = threading.Lock()
+
+    def __init__(self, sample_every, slow_after):
+        self.sample_every = sample_every
+        self.slow_after = slow_after
+        self.counter = itertools.count(1)
+        self.forced = False
+
+    def toggle(self, *args):
+        self.forced = not self.forced
+        LOG.info("Profiling of every operation switched %s",
+                 'on' if self.forced else 'off')
+
+    def sampled(self):
+        return self.forced or bool(
+            self.sample_every and
+            next(self.counter) % self.sample_every == 0)
+
+    def run(self, name, func, *args, **kwargs):
+        if not self._lock.acquire(False):
+            return func(*args, **kwargs)
+        profile = cProfile.Profile()
+        start = time.time()
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            self._lock.release()
+            elapsed = round(time.time() - start, 3)
+            LOG.debug("Profile for method %s: %ss", name, elapsed)
+            if elapsed >= self.slow_after:
+                report = io.StringIO()
+                stats = pstats.Stats(profile, stream=report)
+                stats.sort_stats('cumulative').print_stats(25)
+                LOG.info("Method %s took %ss, profile:\n%s", name,
+                         elapsed, report.getvalue())
+
+
+class Metrics(object):
+    """Driver metrics, rendered in the Prometheus text format
+
+    Counters and histograms are updated as things happen, while gauges
+    and counters kept elsewhere are read from callbacks at render time.
+    Metric types and help come from METRIC_HELP.
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+               30, 60, 120, 300)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (name, labels) --> value, or [bucket counts, sum, count]
+        self.counters = collections.defaultdict(float)
+        self.histograms = {}
+        # (name, labels) --> callable returning the value
+        self.callbacks = {}
+        # Exporters already running, so backends start each one once
+        self.exporting = set()
+
+    @staticmethod
+    def _labels(labels):
+        return tuple(sorted(labels.items()))
+
+    def inc(self, name, labels, value=1):
+        with self.lock:
+            self.counters[(name, self._labels(labels))] += value
+
+    def observe(self, name, labels, value):
+        key = (name, self._labels(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [
+                    [0] * len(self.BUCKETS), 0.0, 0]
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def collect(self, name, labels, func):
+        with self.lock:
+            self.callbacks[(name, self._labels(labels))] = func
+
+    @staticmethod
+    def _escape(value):
+        return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+                .replace('\n', '\\n'))
+
+    @classmethod
+    def _format(cls, name, labels, value):
+        if labels:
+            name += '{' + ','.join('{}="{}"'.format(key, cls._escape(val))
+                                   for key, val in labels) + '}'
+        return '{} {}'.format(name, repr(float(value)))
+
+    def render(self):
+        with self.lock:
+            samples = collections.defaultdict(list)
+            for (name, labels), value in self.counters.items():
+                samples[name].append(self._format(name, labels, value))
+            for (name, labels), (buckets, total, count) in (
+                    self.histograms.items()):
+                for bound, bucket in zip(self.BUCKETS, buckets):
+                    samples[name].append(self._format(
+                        name + '_bucket', labels + (('le', repr(
+                            float(bound))),), bucket))
+                samples[name].append(self._format(
+                    name + '_bucket', labels + (('le', '+Inf'),), count))
+                samples[name].append(
+                    self._format(name + '_sum', labels, total))
+                samples[name].append(
+                    self._format(name + '_count', labels, count))
+            callbacks = list(self.callbacks.items())
+        for (name, labels), func in callbacks:
+            try:
+                samples[name].append(self._format(name, labels, func()))
+            except Exception as e:
+                LOG.debug("Could not collect metric %s: %s", name, e)
+        lines = []
+        for name in sorted(samples):
+            kind, description = METRIC_HELP[name]
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            lines.extend(sorted(samples[name]))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """Writes the metrics for the node_exporter textfile collector"""
+        tmp = path + ".tmp"
+        with io.open(tmp, 'w') as f:
+            f.write(self.render())
+        os.rename(tmp, path)
+
+    def wsgi_app(self, environ, start_response):
+        """Serves the metrics over HTTP, for Prometheus to scrape"""
+        body = self.render().encode('utf-8')
+        start_response('200 OK', [
+            ('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'),
+            ('Content-Length', str(len(body)))])
+        return [body]
+
+
+METRICS = Metrics()
+
+
+def get_metrics_hook(metrics, cluster, retried):
+    """Request hook timing requests by method and endpoint template
+
+    Errors are counted by exception type, and those of the retried types
+    (which the SDK retries) as retries as well.
+    """
+    def _hook(send, method, urlpath, *args, **kwargs):
+        labels = {'cluster': cluster, 'method': method.upper(),
+                  'endpoint': get_endpoint_template(urlpath)}
+        start = time.time()
+        try:
+            return send(method, urlpath, *args, **kwargs)
+        except Exception as e:
+            metrics.inc('datera_request_errors_total',
+                        dict(labels, error=type(e).__name__))
+            if isinstance(e, retried):
+                metrics.inc('datera_request_retries_total', labels)
+            raise
+        finally:
+            metrics.observe('datera_request_duration_seconds', labels,
+                            time.time() - start)
+    return _hook
+
+
+def get_endpoint_template(urlpath):
+    """/app_instances/<id>/storage_instances --> with {id} for the ids"""
+    parts = urlpath.strip('/').split('/')
+    return '/' + '/'.join(part if i % 2 == 0 else '{id}'
+                          for i, part in enumerate(parts))
+
+
+class InvalidationJournal(object):
+    """Cache invalidations shared through a file every node can reach
+
+    Driver instances append one JSON line per invalidation and read the
+    lines appended since they last looked, skipping their own and those
+    for other topics (backends).  Appends happen under a lock file next
+    to the journal.  Once the journal grows past max_bytes the next
+    publisher starts a new file, and readers that see the file replaced
+    can't tell what they missed, which receive() reports as None.
+    """
+
+    def __init__(self, path, topic, max_bytes=units.Mi):
+        self.path = path
+        self.topic = topic
+        self.max_bytes = max_bytes
+        self.sender = uuid.uuid4().hex
+        # Only what's published from now on concerns us
+        try:
+            stat = os.stat(self.path)
+            self.inode, self.offset = stat.st_ino, stat.st_size
+        except OSError:
+            self.inode, self.offset = None, 0
+
+    def _lock(self):
+        return lockutils.lock(os.path.basename(self.path) + '.lock',
+                              external=True,
+                              lock_path=os.path.dirname(
+                                  os.path.abspath(self.path)))
+
+    def publish(self, kind, key, data=None):
+        line = json.dumps({'sender': self.sender, 'topic': self.topic,
+                           'kind': kind, 'key': key, 'data': data}) + '\n'
+        with self._lock():
+            try:
+                size = os.path.getsize(self.path)
+            except OSError:
+                size = 0
+            if size > self.max_bytes:
+                tmp = self.path + ".tmp"
+                os.close(os.open(
+                    tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600))
+                os.rename(tmp, self.path)
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                         0o600)
+            try:
+                os.write(fd, line.encode('utf-8'))
+            finally:
+                os.close(fd)
+
+    def receive(self):
+        """[(kind, key, data)] published by others, None if some were lost"""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return []
+        if stat.st_ino != self.inode:
+            lost = self.inode is not None
+            self.inode, self.offset = stat.st_ino, 0
+            if lost:
+                self.offset = stat.st_size
+                return None
+        if stat.st_size <= self.offset:
+            return []
+        with io.open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read(stat.st_size - self.offset)
+        # A line still being written is left for next time
+        data = data[:data.rfind(b'\n') + 1]
+        self.offset += len(data)
+        messages = []
+        for line in data.decode('utf-8').splitlines():
+            try:
+                message = json.loads(line)
+            except ValueError:
+                continue
+            if (message['sender'] != self.sender and
+                    message['topic'] == self.topic):
+                messages.append(
+                    (message['kind'], message['key'], message['data']))
+        return messages
+
+
+# URL scheme of datera_invalidation_url --> class taking (path, topic)
+INVALIDATION_BACKENDS = {'file': InvalidationJournal}
+
+
+def get_invalidation_channel(url, topic):
+    parsed = urlparse.urlparse(url)
+    backend = INVALIDATION_BACKENDS.get(parsed.scheme)
+    if backend is None:
+        raise exception.InvalidInput(
+            reason=_("Unsupported datera_invalidation_url scheme '%s'") %
+            parsed.scheme)
+    return backend(parsed.path, topic)
+
+
+class TokenCache(object):
+    """Login tokens shared by the driver processes of a host
+
+    The file maps an account to its last token and when it was issued.
+    It is only read or rewritten while holding a lock file next to it,
+    and is created readable by its owner only since the tokens are as
+    good as the password.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _lock(self):
+        return lockutils.lock(os.path.basename(self.path) + '.lock',
+                              external=True,
+                              lock_path=os.path.dirname(
+                                  os.path.abspath(self.path)))
+
+    def _load(self):
+        try:
+            with io.open(self.path, 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            if os.path.exists(self.path):
+                LOG.warning("Could not read token cache %s: %s",
+                            self.path, e)
+            return {}
+
+    def _save(self, tokens):
+        tmp = self.path + ".tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(tokens, f)
+        os.rename(tmp, self.path)
+
+    def get(self, account):
+        """Returns (token, issued) for account, or None"""
+        with self._lock():
+            entry = self._load().get(account)
+        if not entry:
+            return None
+        return entry['key'], entry['issued']
+
+    def put(self, account, key, issued):
+        with self._lock():
+            tokens = self._load()
+            tokens[account] = {'key': key, 'issued': issued}
+            self._save(tokens)
+
+    def discard(self, account, key):
+        """Forgets account's token, unless it was replaced since"""
+        with self._lock():
+            tokens = self._load()
+            if tokens.get(account, {}).get('key') == key:
+                del tokens[account]
+                self._save(tokens)
+
+
+class LoginTokens(object):
+    """Keeps the login token of a connection fresh
+
+    As a request hook it answers logins with a token that is still good,
+    whether this process got it or another one left it in the token
+    cache, and only lets logins through to the cluster when there is
+    none.  A token is no longer good once renew_after seconds have passed
+    since it was issued, or once the cluster refused it.
+    """
+
+    def __init__(self, account, renew_after, cache, auth_errors):
+        self.lock = threading.Lock()
+        self.account = account
+        self.renew_after = renew_after
+        self.cache = cache
+        self.auth_errors = auth_errors
+        self.key = None
+        self.issued = None
+        self.refused = None
+        # Called with whether a login was answered without the cluster
+        self.on_lookup = None
+
+    def renew_in(self):
+        """Seconds until the token is due for renewal, None if never"""
+        if not self.key or not self.renew_after:
+            return None
+        return self.issued + self.renew_after - time.time()
+
+    def _good(self, key, issued):
+        return key and key != self.refused and not (
+            self.renew_after and
+            issued + self.renew_after <= time.time())
+
+    def hook(self, send, method, urlpath, *args, **kwargs):
+        """Request hook, see install_request_hook"""
+        if method == 'PUT' and urlpath == '/login':
+            return self._login(send, method, urlpath, *args, **kwargs)
+        try:
+            return send(method, urlpath, *args, **kwargs)
+        except self.auth_errors:
+            # The SDK sends the token as Auth-Token
+            key = next((value for name, value in
+                        (kwargs.get('headers') or {}).items()
+                        if name.lower() == 'auth-token'), None)
+            if key:
+                self.refused = key
+                if self.cache:
+                    self.cache.discard(self.account, key)
+            raise
+
+    def _login(self, send, method, urlpath, *args, **kwargs):
+        # One login at a time, the others get the token it returns
+        with self.lock:
+            key, issued = self.key, self.issued
+            if self.cache:
+                cached = self.cache.get(self.account)
+                if cached and cached[1] > (issued or 0):
+                    key, issued = cached
+            good = self._good(key, issued)
+            if self.on_lookup:
+                self.on_lookup(bool(good))
+            if good:
+                self.key, self.issued = key, issued
+                return {'key': key}, 200, 'OK', {}
+            response = send(method, urlpath, *args, **kwargs)
+            if not response[0].get('key'):
+                # Left for the SDK to complain about
+                return response
+            self.key, self.issued = str(response[0]['key']), time.time()
+            if self.cache:
+                self.cache.put(self.account, self.key, self.issued)
+            return response
+
+
+class SharedCluster(object):
+    """What the backends of a process on the same cluster have in common
+
+    Backends that reach a cluster with the same login and tenant mode
+    share one authenticated client, along with the request hooks
+    installed on it, the last system snapshot and the lookup caches.  The
+    first backend to connect sets the client up with its options.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.api = None
+        self.apiv = None
+        self.thread_local = threading.local()  # pylint: disable=no-member
+        self.request_stats = RequestStats()
+        self.health = HealthProbe()
+        self.probing = False
+        self.tokens = None
+        self.renewing = False
+        self.breaker = None
+        self.hedging = None
+        self.scheduler = None
+        # Last system entity fetched, the load read along with it and when
+        self.stats_lock = threading.Lock()
+        self.system = None
+        self.cluster_load = {}
+        self.system_updated = None
+        self.unavailable_metrics = set()
+        # Parent volume id --> {snapshot uuid: snapshot timestamp}
+        self.snapshot_index = {}
+
+
+# (san_ip, san_login, datera_tenant_id) --> SharedCluster
+SHARED_CLUSTERS = {}
+_shared_clusters_lock = threading.Lock()
+
+
+def get_shared_cluster(san_ip, username, tenant_id):
+    with _shared_clusters_lock:
+        key = (san_ip, username, tenant_id)
+        if key not in SHARED_CLUSTERS:
+            SHARED_CLUSTERS[key] = SharedCluster()
+        return SHARED_CLUSTERS[key]
+
+
+def worst_state(*states):
+    """The worst of some backend_states, ignoring None"""
+    states = [state for state in states if state]
+    for state in BACKEND_STATES:
+        if state in states:
+            return state
+    return None
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of an already sorted, non-empty list"""
+    rank = max(int(round(pct / 100.0 * len(values))), 1)
+    return values[rank - 1]
+
+
+def install_request_hook(api, hook):
+    """Routes every HTTP request the SDK makes through hook
+
+    hook is called as hook(send, method, urlpath, **kwargs) and has to
+    call send with the same arguments to actually make the request.  Hooks
+    installed later wrap the ones installed before them.  Retries and
+    re-logins happen above this level, so each attempt passes through.
+    """
+    connection = api.context.connection
+    send = connection._http_connect_request
+
+    @functools.wraps(send)
+    def _hooked(*args, **kwargs):
+        return hook(send, *args, **kwargs)
+    connection._http_connect_request = _hooked
+
+
+def check_deadline(thread_local):
+    """Seconds left until the running operation's deadline
+
+    Returns None outside of operations with a deadline and raises
+    DateraDeadlineExceeded once it has passed.
+    """
+    deadline = getattr(thread_local, 'deadline', None)
+    if deadline is None:
+        return None
+    operation, expires, budget = deadline
+    remaining = expires - time.time()
+    if remaining <= 0:
+        raise DateraDeadlineExceeded(operation=operation, deadline=budget)
+    return remaining
+
+
+def deadline_sleep(thread_local, seconds):
+    """eventlet.sleep that raises instead of outlasting the deadline"""
+    remaining = check_deadline(thread_local)
+    if remaining is not None and remaining < seconds:
+        eventlet.sleep(remaining)
+        check_deadline(thread_local)
+    eventlet.sleep(seconds)
+
+
+def get_deadline_hook(thread_local):
+    """Request hook holding each request to the operation's deadline
+
+    Requests are not sent once the deadline has passed and are abandoned
+    when it passes while they are in flight.
+    """
+    def _hook(send, *args, **kwargs):
+        remaining = check_deadline(thread_local)
+        if remaining is None:
+            return send(*args, **kwargs)
+        timeout = eventlet.Timeout(remaining)
+        try:
+            return send(*args, **kwargs)
+        except eventlet.Timeout as e:
+            if e is not timeout:
+                raise
+            operation, __, budget = thread_local.deadline
+            raise DateraDeadlineExceeded(operation=operation, deadline=budget)
+        finally:
+            timeout.cancel()
+    return _hook
+
+
+# What lookup() keeps on thread_local for the running operation
+OPERATION_CONTEXT = ('trace_id', 'operation', 'deadline', 'calls')
+
+
+def with_operation_context(thread_local, func):
+    """Wraps func to run with the calling thread's operation context
+
+    Greenthreads spawned by an operation start with an empty thread_local,
+    which would leave their requests without the operation's trace id,
+    request class, deadline and request count.
+    """
+    context = {name: getattr(thread_local, name, None)
+               for name in OPERATION_CONTEXT}
+
+    @functools.wraps(func)
+    def _run(*args, **kwargs):
+        previous = {name: getattr(thread_local, name, None)
+                    for name in OPERATION_CONTEXT}
+        for name, value in context.items():
+            setattr(thread_local, name, value)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            for name, value in previous.items():
+                setattr(thread_local, name, value)
+    return _run
+
+
+def get_call_count_hook(thread_local):
+    """Request hook counting the requests of the running operation
+
+    lookup() starts the count at each top-level operation, requests made
+    outside of one aren't counted.  Retries are counted as requests.
+    """
+    def _hook(send, *args, **kwargs):
+        # A list, so greenthreads working for the operation add to its count
+        calls = getattr(thread_local, 'calls', None)
+        if calls is not None:
+            calls[0] += 1
+        return send(*args, **kwargs)
+    return _hook
+
+
+def latest_metric_value(data):
+    """Digs the most recent point's value out of a metrics response
+
+    Returns None if the response holds no points.
+    """
+    points = []
+
+    def _walk(obj):
+        if isinstance(obj, dict):
+            value = obj.get('value')
+            if isinstance(value, (int, float)):
+                points.append((obj.get('time', 0), value))
+                return
+            obj = list(obj.values())
+        if isinstance(obj, list):
+            for item in obj:
+                _walk(item)
+    _walk(data)
+    return max(points)[1] if points else None
+
+
+# Driver calls of a multi-cluster backend --> the argument naming the volume
+# or snapshot whose cluster runs the call.  Other calls run on every cluster
+CLUSTER_ROUTES = {
+    'create_volume': 'volume',
+    'extend_volume': 'volume',
+    'create_cloned_volume': 'src_vref',
+    'delete_volume': 'volume',
+    'ensure_export': 'volume',
+    'initialize_connection': 'volume',
+    'create_export': 'volume',
+    'detach_volume': 'volume',
+    'create_snapshot': 'snapshot',
+    'delete_snapshot': 'snapshot',
+    'create_volume_from_snapshot': 'snapshot',
+    'retype': 'volume',
+    'manage_existing': 'volume',
+    'manage_existing_snapshot': 'snapshot',
+    'manage_existing_get_size': 'volume',
+    'manage_existing_snapshot_get_size': 'snapshot',
+    'unmanage': 'volume',
+    'clone_image': 'volume',
+    'update_migrated_volume': 'new_volume'}
+# Calls placing a new volume, which go to the cluster of the scheduled pool
+# or the least loaded one
+PLACEMENT_METHODS = ('create_volume', 'clone_image')
+# Calls whose model update records the cluster in provider_id
+PROVIDER_ID_METHODS = ('create_volume', 'create_cloned_volume',
+                       'create_snapshot', 'create_volume_from_snapshot',
+                       'manage_existing', 'manage_existing_snapshot',
+                       'update_migrated_volume')
+# Fields SDK entities need to reach their sub-endpoints
+ENTITY_FIELDS = {'path', 'tenant'}
+# backend_state values, worst first
+BACKEND_STATES = ('down', 'degraded', 'up')
+# Stats describing the backend rather than one of its pools
+BACKEND_STATS = ('volume_backend_name', 'vendor_name', 'driver_version',
+                 'storage_protocol', 'pools')
+
+
+# Names of the driver methods dispatched by lookup
+LOOKUPS = []
+
+# Trace ids are unique per process thanks to the prefix and cheap to make
+_trace_prefix = uuid.uuid4().hex[:8]
+_trace_counter = itertools.count(1)
+
+
+def get_impl_name(name, apiv):
+    return "_" + name + "_" + apiv.replace(".", "_")
+
+
+def resolve_lookups(driver):
+    """Names the implementations of the lookup methods for driver.apiv"""
+    driver.impl_names = {name: get_impl_name(name, driver.apiv)
+                         for name in LOOKUPS}
+
+
 def lookup(func):
+    LOOKUPS.append(func.__name__)
+
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
         obj = args[0]
-        name = "_" + func.__name__ + "_" + obj.apiv.replace(".", "_")
-        LOG.debug("Trying method: %s", name)
-        call_id = uuid.uuid4()
-        if obj.do_profile:
-            LOG.debug("Profiling method: %s, id %s", name, call_id)
-            t1 = time.time()
-        obj.thread_local.trace_id = call_id
-        result = getattr(obj, name)(*args[1:], **kwargs)
-        if obj.do_profile:
-            t2 = time.time()
-            timedelta = round(t2 - t1, 3)
-            LOG.debug("Profile for method %s, id %s: %ss",
-                      name, call_id, timedelta)
-        return result
+        if obj.clusters:
+            return obj._call_clusters(func, args[1:], kwargs)
+        if obj.invalidations:
+            obj._apply_invalidations()
+        name = (obj.impl_names.get(func.__name__) or
+                get_impl_name(func.__name__, obj.apiv))
+        # Resolved before touching thread_local, which only the finally
+        # below puts back
+        impl = getattr(obj, name)
+        metrics = obj.metrics
+        if metrics:
+            labels = {'backend': obj.backend_label,
+                      'operation': func.__name__}
+        # Operations called by another one share its trace id, deadline
+        # and request class (see RequestScheduler)
+        top_level = getattr(obj.thread_local, 'operation', None) is None
+        if top_level:
+            obj.thread_local.trace_id = '{}-{}'.format(
+                _trace_prefix, next(_trace_counter))
+            obj.thread_local.operation = func.__name__
+            obj.thread_local.calls = [0]
+        budget = obj.deadlines.get(func.__name__, obj.default_deadline)
+        set_deadline = (
+            budget and getattr(obj.thread_local, 'deadline', None) is None)
+        if set_deadline:
+            obj.thread_local.deadline = (
+                func.__name__, time.time() + budget, budget)
+        start = time.time()
+        obj.ops_in_flight += 1
+        try:
+            if top_level and obj.profiler and obj.profiler.sampled():
+                return obj.profiler.run(name, impl, *args[1:], **kwargs)
+            return impl(*args[1:], **kwargs)
+        except Exception:
+            if metrics:
+                metrics.inc('datera_operation_errors_total', labels)
+            raise
+        finally:
+            if metrics:
+                metrics.observe('datera_operation_duration_seconds', labels,
+                                time.time() - start)
+            obj.ops_in_flight -= 1
+            if set_deadline:
+                obj.thread_local.deadline = None
+            if top_level:
+                obj.thread_local.operation = None
+                calls = obj.thread_local.calls[0]
+                obj.thread_local.calls = None
+                if metrics:
+                    metrics.inc('datera_operation_requests_total', labels,
+                                calls)
+                call_budget = obj.call_budgets.get(func.__name__)
+                if call_budget is not None and calls > call_budget:
+                    LOG.warning("Operation %(op)s [%(trace)s] made %(calls)s "
+                                "requests to the cluster, over its budget "
+                                "of %(budget)s",
+                                {'op': func.__name__,
+                                 'trace': obj.thread_local.trace_id,
+                                 'calls': calls, 'budget': call_budget})
     return wrapper
 
 
@@ -297,6 +1670,44 @@ def get_tenant(driver, project_id):
     return _format_tenant(driver.tenant_id)
 
 
+def paged_list(driver, endpoint, page_size=None, fields=None, **params):
+    """Yields the entities of a collection, fetching a page at a time
+
+    Pages hold datera_list_page_size entities unless page_size says
+    otherwise.  Nothing more is fetched once the caller stops iterating.
+    With datera_list_fields set, entities only hold the given fields
+    besides the ones the SDK needs to work with them.
+    """
+    for page in list_pages(driver, endpoint, page_size, fields, **params):
+        for entity in page:
+            yield entity
+
+
+def list_pages(driver, endpoint, page_size=None, fields=None, **params):
+    """Yields the pages of a collection, see paged_list"""
+    page_size = page_size or driver.page_size
+    if fields and driver.list_fields:
+        params['fields'] = ','.join(sorted(set(fields) | ENTITY_FIELDS))
+    offset = 0
+    while True:
+        try:
+            page = endpoint.list(offset=offset, limit=page_size, **params)
+        except Exception as e:
+            if 'fields' not in params or not isinstance(
+                    e, dfs_sdk.exceptions.ApiInvalidRequestError):
+                raise
+            LOG.warning("Datera cluster %s doesn't support selecting the "
+                        "fields to list, listing whole entities",
+                        driver.san_ip)
+            driver.list_fields = False
+            del params['fields']
+            continue
+        yield page
+        if len(page) < page_size:
+            return
+        offset += len(page)
+
+
 def cvol_to_ai(driver, resource, tenant=None):
     if not tenant:
         tenant = get_tenant(driver, resource['project_id'])
@@ -308,9 +1719,10 @@ def cvol_to_ai(driver, resource, tenant=None):
     cid = resource.get('id', None)
     if not cid:
         raise ValueError('Unsure what id key to use for object', resource)
+    # Only the first match is used, so that's all that is fetched
     ais = driver.api.app_instances.list(
         filter='match(name,.*{}.*)'.format(cid),
-        tenant=tenant)
+        tenant=tenant, limit=1)
     if not ais:
         raise exception.VolumeNotFound(volume_id=cid)
     return ais[0]
@@ -325,6 +1737,48 @@ def cvol_to_dvol(driver, resource, tenant=None):
     return vol
 
 
+def ai_to_dvol(ai):
+    """Builds the volume entity of an app_instance we already have
+
+    The app_instance body carries its storage_instances and volumes, so
+    this skips the list calls cvol_to_dvol has to make.
+    """
+    vol = ai['storage_instances'][0]['volumes'][0]
+    return dfs_sdk.base.Entity(ai.context, vol, vol.get('name'), vol['path'])
+
+
+def get_size_override(path, size):
+    """Builds a template_override resizing the volume a clone source is in
+
+    path is the clone source, either a volume or one of its snapshots:
+    /app_instances/<ai>/storage_instances/<si>/volumes/<vol>[/snapshots/<ts>]
+    """
+    parts = path.strip('/').split('/')
+    storage_name, volume_name = parts[3], parts[5]
+    return {
+        'storage_instances': {
+            storage_name: {
+                'volumes': {
+                    volume_name: {
+                        'size': str(size)}}}}}
+
+
+def get_pool_media(pool):
+    """Returns the media tier ('flash' or 'hybrid') a pool places on
+
+    Pools are named after placement policies or placement modes.  Ones
+    that don't pin a tier, like single_flash or custom policies, return
+    None.  Of those only the default placement is sized by the whole
+    cluster.
+    """
+    name = pool.lower().replace('_', '-')
+    if name == 'all-flash':
+        return 'flash'
+    if name == 'hybrid':
+        return 'hybrid'
+    return None
+
+
 def _version_to_int(ver):
     # Using a factor of 100 per digit so up to 100 versions are supported
     # per major/minor/patch/subpatch digit in this calculation
@@ -355,7 +1809,9 @@ def register_driver(driver):
                  get_tenant,
                  create_tenant,
                  cvol_to_ai,
-                 cvol_to_dvol]:
+                 cvol_to_dvol,
+                 list_pages,
+                 paged_list]:
 
         f = types.MethodType(func, driver)
         setattr(driver, func.__name__, f)
@@ -13,12 +13,18 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import functools
+import inspect
+import os
+import signal
 import time
 import uuid
 
-from eventlet.green import threading
+import eventlet
+from eventlet import wsgi as eventlet_wsgi
 from oslo_config import cfg
 from oslo_log import log as logging
+from oslo_service import loopingcall
 from oslo_utils import importutils
 import six
 
@@ -30,10 +36,12 @@ import cinder.volume.drivers.datera.datera_api21 as api21
 import cinder.volume.drivers.datera.datera_api22 as api22
 import cinder.volume.drivers.datera.datera_common as datc
 from cinder.volume.drivers.san import san
+from cinder.volume import volume_utils as volutils
 
 LOG = logging.getLogger(__name__)
 
 dfs_sdk = importutils.try_import('dfs_sdk')
+dexceptions = importutils.try_import('dfs_sdk.exceptions')
 
 d_opts = [
     cfg.StrOpt('datera_api_port',
@@ -77,6 +85,35 @@ d_opts = [
     cfg.BoolOpt('datera_disable_profiler',
                 default=False,
                 help="Set to True to disable profiling in the Datera driver"),
+    cfg.IntOpt('datera_profile_sample_rate',
+               default=100,
+               help="Profile one in every this many driver operations "
+                    "with cProfile, logging how long it took.  0 to only "
+                    "profile on demand, see datera_profile_signal"),
+    cfg.IntOpt('datera_profile_slow_after',
+               default=30,
+               help="Seconds after which a profiled operation also logs "
+                    "its cProfile report"),
+    cfg.StrOpt('datera_metrics_file',
+               default=None,
+               help="File to write Prometheus metrics of driver operations "
+                    "and REST requests to, for the node_exporter textfile "
+                    "collector.  Written every datera_metrics_interval "
+                    "seconds"),
+    cfg.IntOpt('datera_metrics_interval',
+               default=15,
+               help="Seconds between writes of datera_metrics_file"),
+    cfg.PortOpt('datera_metrics_port',
+                default=0,
+                help="Port to serve Prometheus metrics on over HTTP, 0 for "
+                     "none"),
+    cfg.StrOpt('datera_metrics_host',
+               default='127.0.0.1',
+               help="Address to serve Prometheus metrics on"),
+    cfg.StrOpt('datera_profile_signal',
+               default=None,
+               help="Signal, e.g. SIGUSR1, that switches profiling of "
+                    "every driver operation on and off"),
     cfg.BoolOpt('datera_disable_extended_metadata',
                 default=False,
                 help="Set to True to disable sending additional metadata to "
@@ -95,6 +132,185 @@ d_opts = [
                      "via the following format, WITHOUT ANY 'DF:' PREFIX: "
                      "'datera_volume_type_defaults="
                      "iops_per_gb:100,bandwidth_per_gb:200...etc'."),
+    cfg.BoolOpt('datera_deferred_delete',
+                default=False,
+                help="Set to True to have delete_volume rename the backend "
+                     "app_instance to a pending-delete name and return "
+                     "immediately.  A background reaper then offlines and "
+                     "deletes it (API 2.2+ only)"),
+    cfg.StrOpt('datera_deferred_delete_journal',
+               default=None,
+               help="Path of the journal tracking pending deletes so they "
+                    "survive a cinder-volume restart.  Defaults to "
+                    "$state_path/datera-delete-<volume_backend_name>.json"),
+    cfg.IntOpt('datera_deferred_delete_interval',
+               default=10,
+               help="Seconds between deferred delete reaper runs"),
+    cfg.IntOpt('datera_deferred_delete_batch',
+               default=5,
+               help="Maximum number of pending deletes the reaper will "
+                    "finish per run"),
+    cfg.IntOpt('datera_deferred_delete_max_attempts',
+               default=10,
+               help="Number of failed attempts after which the reaper "
+                    "gives up on a pending delete and leaves the "
+                    "app_instance for an operator.  0 retries forever"),
+    cfg.IntOpt('datera_stats_refresh_interval',
+               default=0,
+               help="Seconds between background refreshes of the cluster "
+                    "stats.  get_volume_stats reports the latest refreshed "
+                    "stats right away instead of waiting on the cluster.  "
+                    "0 refreshes them inline (API 2.2+ only)"),
+    cfg.IntOpt('datera_stats_refresh_timeout',
+               default=30,
+               help="Seconds a background stats refresh may take before it "
+                    "is abandoned"),
+    cfg.IntOpt('datera_stats_stale_after',
+               default=300,
+               help="Seconds since the last good stats refresh after which "
+                    "the backend reports a backend_state of 'degraded'"),
+    cfg.BoolOpt('datera_placement_pools',
+                default=False,
+                help="Set to True to report a Cinder pool per placement "
+                     "policy (placement mode before product version 3.3), "
+                     "each with the capacity of its media tier.  Policies "
+                     "that don't pin a tier report unknown capacity, "
+                     "except the default one, which reports the whole "
+                     "cluster's.  Volumes "
+                     "whose volume-type doesn't set DF:placement_policy or "
+                     "DF:placement_mode get the placement of the pool the "
+                     "scheduler chose (API 2.2+ only)"),
+    cfg.IntOpt('datera_qos_rebalance_interval',
+               default=0,
+               help="Seconds between checks for QoS changes on volume-types. "
+                    "When a type's QoS specs or DF: QoS extra-specs change, "
+                    "the performance policies of its existing volumes are "
+                    "recomputed.  0 disables the check (API 2.2+ only)"),
+    cfg.IntOpt('datera_qos_rebalance_concurrency',
+               default=4,
+               help="Maximum number of volumes the QoS rebalancer updates "
+                    "at the same time"),
+    cfg.FloatOpt('datera_qos_rebalance_rate',
+                 default=10.0,
+                 help="Maximum number of volumes per second the QoS "
+                      "rebalancer starts on.  0 for no limit"),
+    cfg.BoolOpt('datera_qos_rebalance_dry_run',
+                default=False,
+                help="Set to True to have the QoS rebalancer only log the "
+                     "performance policy changes it would make"),
+    cfg.IntOpt('datera_health_probe_interval',
+               default=0,
+               help="Seconds between background probes of the round-trip "
+                    "latency of the cluster's management API.  The last "
+                    "probes decide the backend_state reported in the "
+                    "stats.  0 disables the probe (API 2.2+ only)"),
+    cfg.IntOpt('datera_health_probe_timeout',
+               default=10,
+               help="Seconds a health probe may take before it counts as "
+                    "failed"),
+    cfg.IntOpt('datera_health_degraded_latency',
+               default=1000,
+               help="Milliseconds of p95 health probe latency above which "
+                    "the backend reports a backend_state of 'degraded'"),
+    cfg.IntOpt('datera_circuit_breaker_threshold',
+               default=5,
+               help="Number of requests in a row the cluster has to fail, "
+                    "by not answering or answering 5xx, for the driver to "
+                    "fail further requests right away instead of retrying "
+                    "them.  0 disables the circuit breaker"),
+    cfg.IntOpt('datera_circuit_breaker_reset',
+               default=30,
+               help="Seconds the circuit breaker fails requests fast before "
+                    "letting one through to see if the cluster recovered"),
+    cfg.BoolOpt('datera_hedge_gets',
+                default=False,
+                help="Set to True to send a second copy of GETs that haven't "
+                     "been answered by the p95 latency of their call site, "
+                     "using whichever answer comes first"),
+    cfg.FloatOpt('datera_hedge_max_rate',
+                 default=0.05,
+                 help="Maximum fraction of a call site's GETs that are "
+                      "hedged"),
+    cfg.ListOpt('datera_hedge_endpoints',
+                default=[],
+                help="Other management IPs of the cluster at san_ip to send "
+                     "hedged GETs to, in turn.  Without any they go to "
+                     "san_ip"),
+    cfg.IntOpt('datera_api_concurrency',
+               default=0,
+               help="Most requests to the cluster in flight at once.  As "
+                    "room frees up, waiting requests of interactive "
+                    "operations go first, then normal ones, then bulk "
+                    "ones.  0 for no limit"),
+    cfg.DictOpt('datera_request_budgets',
+                default={'bulk': 4},
+                help="Most requests each class of operation can have in "
+                     "flight at once, e.g. interactive:8,bulk:2.  Classes "
+                     "are interactive (exports, attach and detach), bulk "
+                     "(manageable listings, image caching, stats and QoS "
+                     "rebalancing) and normal (the rest).  Classes left out "
+                     "are only bounded by datera_api_concurrency"),
+    cfg.IntOpt('datera_list_page_size',
+               default=100,
+               help="Number of entities fetched per request when listing "
+                    "app_instances, snapshots and other collections"),
+    cfg.BoolOpt('datera_list_fields',
+                default=False,
+                help="Set to True to have collection listings ask the "
+                     "cluster for only the fields the driver uses.  Turns "
+                     "itself off if the cluster rejects field selection"),
+    cfg.IntOpt('datera_token_renew_after',
+               default=0,
+               help="Seconds after logging in at which the login token is "
+                    "renewed in the background, ahead of the cluster "
+                    "expiring it.  Set to 0 to only log in again once the "
+                    "cluster refuses the token"),
+    cfg.StrOpt('datera_token_cache',
+               default=None,
+               help="File in which the Datera driver processes of a host "
+                    "share their login tokens, so that one login serves "
+                    "them all for each cluster and account.  It is created "
+                    "readable by its owner only"),
+    cfg.StrOpt('datera_invalidation_url',
+               default=None,
+               help="Channel through which the cinder-volume nodes of an "
+                    "active/active cluster tell each other about changes "
+                    "that invalidate their caches, such as volumes being "
+                    "deleted, resized or renamed.  Supported: "
+                    "file://<path>, a journal file on storage all the "
+                    "nodes mount"),
+    cfg.IntOpt('datera_operation_deadline',
+               default=300,
+               help="Seconds a driver operation may take, including every "
+                    "request, retry and poll it makes, before it fails.  "
+                    "0 for no deadline"),
+    cfg.DictOpt('datera_operation_deadlines',
+                default={},
+                help="Per-operation deadlines overriding "
+                     "datera_operation_deadline, as 'operation:seconds' "
+                     "pairs, eg. 'create_export:60,create_volume:120'.  "
+                     "Attach and detach operations and get_volume_stats "
+                     "default to 60 seconds, clone_image and background "
+                     "work have none"),
+    cfg.DictOpt('datera_call_budgets',
+                default={},
+                help="Most requests to the cluster a driver operation is "
+                     "expected to make, including retries, as "
+                     "'operation:requests' pairs, eg. "
+                     "'create_volume:6,initialize_connection:5'.  "
+                     "Operations making more are logged with a warning"),
+    cfg.DictOpt('datera_clusters',
+                default={},
+                help="Additional Datera clusters managed by this backend, "
+                     "as 'name:san_ip' pairs sharing san_login and "
+                     "san_password.  Every cluster, including the one at "
+                     "san_ip which is named after volume_backend_name, is "
+                     "reported as a pool with its own connection, caches and "
+                     "stats.  New volumes go to the cluster of the pool the "
+                     "scheduler chose, otherwise to the one with the most "
+                     "free capacity for its load.  The cluster of a volume or "
+                     "snapshot is recorded in its provider_id.  "
+                     "datera_placement_pools is ignored when this is set"),
 ]
 
 
@@ -198,8 +414,13 @@ class DateraDriver(san.SanISCSIDriver, api21.DateraApi, api22.DateraApi):
     HEADER_DATA = {'Datera-Driver': 'OpenStack-Cinder-{}'.format(VERSION)}
 
     def __init__(self, *args, **kwargs):
+        # (name, san_ip) when this driver is one of the clusters of a
+        # multi-cluster backend
+        cluster = kwargs.pop('cluster', None)
         super(DateraDriver, self).__init__(*args, **kwargs)
         self.configuration.append_config_values(d_opts)
+        self.cluster_name, self.san_ip = cluster or (
+            None, self.configuration.san_ip)
         self.username = self.configuration.san_login
         self.password = self.configuration.san_password
         self.ldap = self.configuration.datera_ldap_server
@@ -224,15 +445,31 @@ class DateraDriver(san.SanISCSIDriver, api21.DateraApi, api22.DateraApi):
         self.api_check = time.time()
         self.api_cache = []
         self.api_timeout = 0
-        self.do_profile = not self.configuration.datera_disable_profiler
+        self.page_size = self.configuration.datera_list_page_size
+        self.list_fields = self.configuration.datera_list_fields
+        self.profiler = None
+        if not self.configuration.datera_disable_profiler:
+            self.profiler = datc.SampledProfiler(
+                self.configuration.datera_profile_sample_rate,
+                self.configuration.datera_profile_slow_after)
         self.do_metadata = (
             not self.configuration.datera_disable_extended_metadata)
         self.image_cache = self.configuration.datera_enable_image_cache
         self.image_type = self.configuration.datera_image_cache_volume_type_id
-        self.thread_local = threading.local()  # pylint: disable=no-member
+        # Client, stats and caches shared with the other backends of this
+        # process on the same cluster, login and tenant mode
+        self.shared = datc.get_shared_cluster(
+            self.san_ip, self.username, self.tenant_id)
+        # Parent volume id --> {snapshot uuid: snapshot timestamp}, for
+        # snapshots that predate recording the timestamp in
+        # provider_location
+        self.snapshot_index = self.shared.snapshot_index
+        self.thread_local = self.shared.thread_local
         self.datera_version = None
         self.apiv = None
         self.api = None
+        # Operation --> name of its implementation for apiv
+        self.impl_names = {}
         self.filterf = self.get_filter_function()
         self.goodnessf = self.get_goodness_function()
 
@@ -243,6 +480,76 @@ class DateraDriver(san.SanISCSIDriver, api21.DateraApi, api22.DateraApi):
         backend_name = self.configuration.safe_get(
             'volume_backend_name')
         self.backend_name = backend_name or 'Datera'
+
+        # Cluster name --> driver of that cluster, for multi-cluster backends
+        self.clusters = {}
+        # The multi-cluster backend driver this cluster driver belongs to
+        self.parent = None
+        if self.configuration.datera_clusters and not cluster:
+            clusters = [(self.backend_name, self.configuration.san_ip)]
+            clusters.extend(sorted(
+                self.configuration.datera_clusters.items()))
+            for name, san_ip in clusters:
+                driver = DateraDriver(*args, cluster=(name, san_ip), **kwargs)
+                driver.parent = self
+                self.clusters[name] = driver
+
+        # Names this backend, or this cluster of it, in metrics and
+        # invalidations
+        self.backend_label = '/'.join(
+            filter(None, (self.backend_name, self.cluster_name)))
+        self.metrics = None
+        if (self.configuration.datera_metrics_file or
+                self.configuration.datera_metrics_port):
+            self.metrics = datc.METRICS
+        self.deferred_delete = self.configuration.datera_deferred_delete
+        self.delete_journal = None
+        self.placement_pools = (self.configuration.datera_placement_pools and
+                                not (cluster or self.clusters))
+        self.provision_tally = datc.ProvisionTally()
+        # Greenthread seeding provision_tally, while it runs
+        self.seeder = None
+        self.request_stats = self.shared.request_stats
+        self.ops_in_flight = 0
+        self.cluster_load = {}
+        self.default_deadline = (
+            self.configuration.datera_operation_deadline)
+        self.deadlines = dict(datc.OPERATION_DEADLINES)
+        self.deadlines.update(
+            (operation, float(seconds)) for operation, seconds in
+            self.configuration.datera_operation_deadlines.items())
+        self.call_budgets = {
+            operation: int(calls) for operation, calls in
+            self.configuration.datera_call_budgets.items()}
+        self.health = self.shared.health
+        self.breaker = None
+        self.hedging = None
+        self.scheduler = None
+        self.stats_refresher = None
+        self.stats_updated = None
+        # Volume-type id --> QoS policies seen by the last rebalancer check
+        self.qos_fingerprints = None
+        if self.deferred_delete and not self.clusters:
+            journal = self.configuration.datera_deferred_delete_journal
+            if not journal:
+                journal = os.path.join(
+                    CONF.state_path,
+                    'datera-delete-{}.json'.format(self.backend_name))
+            # The cluster at san_ip keeps the journal it had before
+            # datera_clusters was set
+            if self.cluster_name not in (None, self.backend_name):
+                root, ext = os.path.splitext(journal)
+                journal = '{}-{}{}'.format(root, self.cluster_name, ext)
+            self.delete_journal = datc.DeleteJournal(
+                journal,
+                self.configuration.datera_deferred_delete_max_attempts)
+        self.invalidations = None
+        url = self.configuration.datera_invalidation_url
+        if url and not self.clusters:
+            self.invalidations = datc.get_invalidation_channel(
+                url, self.backend_label)
+            self.provision_tally.listener = functools.partial(
+                self.publish_invalidation, 'tally')
         datc.register_driver(self)
 
     def do_setup(self, context):
@@ -255,25 +562,496 @@ class DateraDriver(san.SanISCSIDriver, api21.DateraApi, api22.DateraApi):
             LOG.error(msg)
             raise exception.InvalidInput(msg)
 
+        if self.clusters:
+            if self.configuration.datera_placement_pools:
+                LOG.warning("datera_placement_pools is ignored when "
+                            "datera_clusters is set")
+            for driver in self.clusters.values():
+                driver.do_setup(context)
+            primary = self.clusters[self.backend_name]
+            self.api = primary.api
+            self.apiv = primary.apiv
+            return
+
+        shared = self.shared
+        with shared.lock:
+            if not shared.api:
+                self._connect(shared)
+        self.api = shared.api
+        self.apiv = shared.apiv
+        self.breaker = shared.breaker
+        self.hedging = shared.hedging
+        self.scheduler = shared.scheduler
+        if self.apiv:
+            datc.resolve_lookups(self)
+        if self.metrics:
+            self._start_metrics()
+        if self.profiler and self.configuration.datera_profile_signal:
+            self._install_profile_signal(
+                self.configuration.datera_profile_signal)
+
+        if self.deferred_delete:
+            if self.apiv == '2.2':
+                self._start_delete_reaper()
+            else:
+                LOG.warning("Deferred delete requires API 2.2, volumes will "
+                            "be deleted synchronously")
+                self.deferred_delete = False
+
+        if (self.configuration.datera_token_renew_after and self.api and
+                not shared.renewing):
+            self._start_token_renewer()
+
+        if (self.configuration.datera_stats_refresh_interval and
+                self.apiv == '2.2'):
+            self._start_stats_refresher()
+
+        if (self.configuration.datera_health_probe_interval and
+                self.apiv == '2.2'):
+            self._start_health_probe()
+
+        if self.configuration.datera_qos_rebalance_interval:
+            if self.apiv == '2.2':
+                self._start_qos_rebalancer()
+            else:
+                LOG.warning("QoS rebalancing requires API 2.2, volume-type "
+                            "QoS changes will only apply on retype")
+
+    def _start_metrics(self):
+        metrics = self.metrics
+        shared = self.shared
+        metrics.collect('datera_operations_in_flight',
+                        {'backend': self.backend_label},
+                        lambda: self.ops_in_flight)
+        metrics.collect('datera_requests_in_flight', {'cluster': self.san_ip},
+                        lambda: shared.request_stats.in_flight)
+        if shared.scheduler:
+            metrics.collect(
+                'datera_requests_waiting', {'cluster': self.san_ip},
+                lambda: shared.scheduler.summary()['api_requests_waiting'])
+        path = self.configuration.datera_metrics_file
+        if path and ('file', path) not in metrics.exporting:
+            metrics.exporting.add(('file', path))
+            LOG.info("Writing driver metrics to %s", path)
+            writer = loopingcall.FixedIntervalLoopingCall(
+                self._write_metrics, path)
+            writer.start(
+                interval=self.configuration.datera_metrics_interval)
+        port = self.configuration.datera_metrics_port
+        host = self.configuration.datera_metrics_host
+        if port and ('http', host, port) not in metrics.exporting:
+            try:
+                sock = eventlet.listen((host, port))
+            except OSError as e:
+                LOG.warning("Could not serve driver metrics on %s:%s: %s",
+                            host, port, e)
+                return
+            metrics.exporting.add(('http', host, port))
+            LOG.info("Serving driver metrics on %s:%s", host, port)
+            eventlet.spawn_n(eventlet_wsgi.server, sock, metrics.wsgi_app,
+                             log_output=False)
+
+    def _write_metrics(self, path):
+        # Exceptions would stop the looping call for good
+        try:
+            self.metrics.write(path)
+        except Exception as e:
+            LOG.warning("Could not write driver metrics to %s: %s", path, e)
+
+    def _count_cache(self, cache, hit):
+        if self.metrics:
+            self.metrics.inc('datera_cache_lookups_total',
+                             {'cluster': self.san_ip, 'cache': cache,
+                              'result': 'hit' if hit else 'miss'})
+
+    def _install_profile_signal(self, name):
+        signum = getattr(signal, name.upper(), None)
+        if not isinstance(signum, int):
+            LOG.warning("Unknown datera_profile_signal %s", name)
+            return
+        previous = signal.getsignal(signum)
+
+        def _handler(*args):
+            self.profiler.toggle()
+            # Other backends of the process may be listening too
+            if callable(previous):
+                previous(*args)
+        try:
+            signal.signal(signum, _handler)
+        except ValueError as e:
+            LOG.warning("Could not listen for %s: %s", name, e)
+
+    def _connect(self, shared):
+        """Logs in to the cluster on behalf of the backends sharing it"""
+        cache = self.configuration.datera_token_cache
+        shared.tokens = datc.LoginTokens(
+            '{}@{}/{}'.format(self.username, self.san_ip, self.ldap or ''),
+            self.configuration.datera_token_renew_after,
+            datc.TokenCache(cache) if cache else None,
+            (dexceptions.ApiAuthError,))
         # Try each valid api version starting with the latest until we find
         # one that works
         for apiv in reversed(datc.API_VERSIONS):
             try:
-                api = dfs_sdk.get_api(self.configuration.san_ip,
-                                      self.username,
-                                      self.password,
-                                      'v{}'.format(apiv),
-                                      disable_log=True,
-                                      extra_headers=self.HEADER_DATA,
-                                      thread_local=self.thread_local,
-                                      ldap_server=self.ldap)
+                # Logging in on the first request lets the token hook
+                # answer it
+                api = self._get_api(self.san_ip, apiv, immediate_login=False)
+                datc.install_request_hook(api, shared.tokens.hook)
                 system = api.system.get()
                 LOG.debug('Connected successfully to cluster: %s', system.name)
-                self.api = api
-                self.apiv = apiv
+                shared.api = api
+                shared.apiv = apiv
                 break
             except Exception as e:
                 LOG.warning(e)
+        else:
+            return
+
+        if self.configuration.datera_hedge_gets:
+            # Installed first so the hooks below see a hedged GET as a
+            # single request
+            senders = []
+            for endpoint in self.configuration.datera_hedge_endpoints:
+                # Logging in through the same tokens as the primary
+                hedge_api = self._get_api(endpoint, apiv,
+                                          immediate_login=False)
+                datc.install_request_hook(hedge_api, shared.tokens.hook)
+                senders.append(
+                    hedge_api.context.connection._http_connect_request)
+            shared.hedging = datc.HedgedRequests(
+                self.configuration.datera_hedge_max_rate, senders,
+                thread_local=shared.thread_local)
+            datc.install_request_hook(api, shared.hedging.hook)
+        datc.install_request_hook(api, shared.request_stats.hook)
+        datc.install_request_hook(
+            api, datc.get_call_count_hook(shared.thread_local))
+        if self.metrics:
+            datc.install_request_hook(api, datc.get_metrics_hook(
+                self.metrics, self.san_ip,
+                (dexceptions.Api503RetryError,
+                 dexceptions.ApiConnectionError)))
+            shared.tokens.on_lookup = functools.partial(
+                self._count_cache, 'login_token')
+        datc.install_request_hook(
+            api, datc.get_deadline_hook(shared.thread_local))
+        budgets = {cls: int(budget) for cls, budget in
+                   self.configuration.datera_request_budgets.items()}
+        if self.configuration.datera_api_concurrency or any(
+                budgets.values()):
+            # Installed after the deadline hook so requests that waited
+            # are checked against the deadline again, and after the request
+            # stats so waiting doesn't count as cluster latency
+            shared.scheduler = datc.RequestScheduler(
+                self.configuration.datera_api_concurrency, budgets,
+                shared.thread_local)
+            datc.install_request_hook(api, shared.scheduler.hook)
+        threshold = self.configuration.datera_circuit_breaker_threshold
+        if threshold:
+            # Installed last so open breakers fail before anything else
+            shared.breaker = datc.CircuitBreaker(
+                self.san_ip, threshold,
+                self.configuration.datera_circuit_breaker_reset,
+                (dexceptions.ApiConnectionError,
+                 dexceptions.ApiInternalError,
+                 dexceptions.ApiUnavailableError,
+                 dexceptions.Api503RetryError))
+            datc.install_request_hook(api, shared.breaker.hook)
+
+    def _get_api(self, hostname, apiv, **kwargs):
+        return dfs_sdk.get_api(hostname,
+                               self.username,
+                               self.password,
+                               'v{}'.format(apiv),
+                               disable_log=True,
+                               extra_headers=self.HEADER_DATA,
+                               thread_local=self.thread_local,
+                               ldap_server=self.ldap,
+                               **kwargs)
+
+    def _start_delete_reaper(self):
+        LOG.info("Starting deferred delete reaper for backend '%s'",
+                 self.backend_name)
+        reaper = loopingcall.FixedIntervalLoopingCall(self.reap_deletes)
+        reaper.start(
+            interval=self.configuration.datera_deferred_delete_interval)
+
+    def _start_token_renewer(self):
+        # One renewer serves all the backends sharing the cluster
+        self.shared.renewing = True
+        LOG.info("Starting login token renewer for backend '%s'",
+                 self.backend_name)
+        renewer = loopingcall.DynamicLoopingCall(self._renew_token)
+        renewer.start()
+
+    def _renew_token(self):
+        """Logs in again when the token is due, returns when to check next"""
+        # Exceptions would stop the looping call for good
+        tokens = self.shared.tokens
+        renew_in = tokens.renew_in()
+        if renew_in is None:
+            return tokens.renew_after
+        if renew_in > 0:
+            return renew_in
+        try:
+            self.api.context.connection.login()
+        except Exception as e:
+            LOG.warning("Could not renew the login token for cluster %s: "
+                        "%s", self.san_ip, e)
+            return min(tokens.renew_after, 60)
+        return max(tokens.renew_in() or 0, 1)
+
+    def _start_stats_refresher(self):
+        LOG.info("Starting stats refresher for backend '%s'",
+                 self.backend_name)
+        self.stats_refresher = loopingcall.FixedIntervalLoopingCall(
+            self._refresh_stats)
+        self.stats_refresher.start(
+            interval=self.configuration.datera_stats_refresh_interval)
+
+    def _refresh_stats(self):
+        # Exceptions would stop the looping call for good
+        timeout = self.configuration.datera_stats_refresh_timeout
+        try:
+            with eventlet.Timeout(timeout):
+                self.update_cluster_stats()
+        except eventlet.Timeout:
+            LOG.warning("Refreshing cluster stats timed out after %ss",
+                        timeout)
+        except Exception as e:
+            LOG.warning("Failed to refresh cluster stats: %s", e)
+
+    def _start_health_probe(self):
+        # One probe serves all the backends sharing the cluster
+        if self.shared.probing:
+            return
+        self.shared.probing = True
+        LOG.info("Starting health probe for backend '%s'", self.backend_name)
+        probe = loopingcall.FixedIntervalLoopingCall(self._probe_health)
+        probe.start(
+            interval=self.configuration.datera_health_probe_interval)
+
+    def _probe_health(self):
+        # Exceptions would stop the looping call for good
+        start = time.time()
+        try:
+            with eventlet.Timeout(
+                    self.configuration.datera_health_probe_timeout):
+                self.api.system.get()
+        except (Exception, eventlet.Timeout) as e:
+            LOG.debug("Health probe of cluster %s failed: %s",
+                      self.san_ip, e)
+            self.health.record(None)
+        else:
+            self.health.record(time.time() - start)
+
+    def _get_health_state(self):
+        """'up', 'degraded' or 'down' going by the health probes, if any
+
+        An open circuit breaker makes the backend down and a half-open one
+        degraded.
+        """
+        state = self.health.state(
+            self.configuration.datera_health_degraded_latency)
+        if self.breaker:
+            state = datc.worst_state(state, {
+                datc.CircuitBreaker.OPEN: 'down',
+                datc.CircuitBreaker.HALF_OPEN: 'degraded'}.get(
+                    self.breaker.state))
+        return state
+
+    def _start_qos_rebalancer(self):
+        LOG.info("Starting QoS rebalancer for backend '%s'",
+                 self.backend_name)
+        rebalancer = loopingcall.FixedIntervalLoopingCall(
+            self.check_qos_changes)
+        rebalancer.start(
+            interval=self.configuration.datera_qos_rebalance_interval)
+
+    # ===================
+    # = Cache Coherence =
+    # ===================
+
+    def publish_invalidation(self, kind, key, data=None):
+        """Tells the other nodes' drivers about a change to kind/key"""
+        if not self.invalidations:
+            return
+        try:
+            self.invalidations.publish(kind, key, data)
+        except Exception as e:
+            LOG.warning("Could not publish %s invalidation of %s: %s",
+                        kind, key, e)
+
+    def _apply_invalidations(self):
+        """Brings the caches up to date with other nodes' changes"""
+        try:
+            messages = self.invalidations.receive()
+        except Exception as e:
+            LOG.warning("Could not receive cache invalidations: %s", e)
+            return
+        if messages is None:
+            LOG.info("Missed cache invalidations, dropping caches")
+            self.snapshot_index.clear()
+            self.provision_tally.reset()
+            return
+        for kind, key, data in messages:
+            if kind == 'volume':
+                self.snapshot_index.pop(key, None)
+            elif kind == 'snapshot':
+                self.snapshot_index.get(key, {}).pop(data, None)
+            elif kind == 'tally':
+                self.provision_tally.apply(key, data)
+
+    # =================
+    # = Multi-Cluster =
+    # =================
+
+    def _call_clusters(self, func, args, kwargs):
+        """Runs a driver call on the clusters it concerns
+
+        Calls about a volume or snapshot go to the cluster it lives on,
+        the rest go to every cluster.
+        """
+        method = func.__name__
+        param = datc.CLUSTER_ROUTES.get(method)
+        if param is None:
+            return self._call_all_clusters(method, args, kwargs)
+        resource = inspect.getcallargs(func, self, *args, **kwargs)[param]
+        driver = self._get_resource_cluster(resource)
+        if driver is None and method in datc.PLACEMENT_METHODS:
+            driver = self._pick_cluster()
+        elif driver is None:
+            driver = self.clusters[self.backend_name]
+        result = getattr(driver, method)(*args, **kwargs)
+        update = {'provider_id': driver.cluster_name}
+        if method == 'clone_image':
+            model_update, cloned = result
+            if cloned:
+                result = (dict(model_update or {}, **update), cloned)
+        elif method in datc.PROVIDER_ID_METHODS:
+            result = dict(result or {}, **update)
+        return result
+
+    def _call_all_clusters(self, method, args, kwargs):
+        drivers = [driver for driver in self.clusters.values()
+                   if driver.apiv]
+        if method == 'get_volume_stats':
+            return self._get_clusters_stats(drivers, *args, **kwargs)
+        if method in ('get_manageable_volumes', 'get_manageable_snapshots'):
+            return self._get_clusters_manageable(drivers, method, *args)
+        results = [getattr(driver, method)(*args, **kwargs)
+                   for driver in drivers]
+        if method == 'rebalance_qos':
+            report = {'checked': 0, 'changed': {}, 'failed': {}}
+            for result in results:
+                report['checked'] += result['checked']
+                report['changed'].update(result['changed'])
+                report['failed'].update(result['failed'])
+            return report
+
+    def _get_resource_cluster(self, resource):
+        """The cluster driver a volume or snapshot lives on, if known"""
+        name = resource.get('provider_id', None)
+        if name in self.clusters:
+            return self.clusters[name]
+        host = resource.get('host', None)
+        if host:
+            return self.clusters.get(volutils.extract_host(host, 'pool'))
+        # Snapshots created before datera_clusters was set
+        if resource.get('volume_id', None):
+            volume = resource.get('volume', None)
+            if volume:
+                return self._get_resource_cluster(volume)
+        return None
+
+    def _pick_cluster(self):
+        """The connected cluster with the most free capacity for its load
+
+        Clusters that are down are only picked if all of them are, and
+        degraded ones count as twice as loaded.
+        """
+        def _score(driver):
+            stats = driver.cluster_stats
+            state = datc.worst_state(stats.get('backend_state'),
+                                     driver._get_health_state())
+            if state == 'down':
+                return -1
+            load = (1 + driver.ops_in_flight +
+                    driver.request_stats.summary()['api_requests_in_flight'])
+            if state == 'degraded':
+                load *= 2
+            return stats.get('free_capacity_gb', 0) / load
+
+        drivers = [driver for driver in self.clusters.values()
+                   if driver.apiv]
+        if not drivers:
+            return self.clusters[self.backend_name]
+        return max(drivers, key=_score)
+
+    def _is_cluster_resource(self, resource):
+        """Whether a volume or snapshot lives on this driver's cluster"""
+        if not self.parent:
+            return True
+        driver = self.parent._get_resource_cluster(resource)
+        if driver is None:
+            driver = self.parent.clusters[self.backend_name]
+        return driver is self
+
+    def _get_clusters_stats(self, drivers, refresh=False):
+        pools = []
+        for driver in drivers:
+            stats = driver.get_volume_stats(refresh=refresh)
+            pool = {key: value for key, value in stats.items()
+                    if key not in datc.BACKEND_STATS}
+            pool['pool_name'] = driver.cluster_name
+            pools.append(pool)
+        self.cluster_stats = {
+            'volume_backend_name': self.backend_name,
+            'vendor_name': 'Datera',
+            'driver_version': self.VERSION,
+            'storage_protocol': 'iSCSI',
+            'total_capacity_gb': sum(
+                pool.get('total_capacity_gb', 0) for pool in pools),
+            'free_capacity_gb': sum(
+                pool.get('free_capacity_gb', 0) for pool in pools),
+            'pools': pools}
+        return self.cluster_stats
+
+    def _get_clusters_manageable(self, drivers, method, cinder_resources,
+                                 marker, limit, offset, sort_keys, sort_dirs):
+        # Every cluster lists everything so the pages span all of them
+        results = []
+        for driver in drivers:
+            for result in getattr(driver, method)(
+                    cinder_resources, None, None, 0, sort_keys, sort_dirs):
+                result['extra_info']['cluster'] = driver.cluster_name
+                results.append(result)
+        return volutils.paginate_entries_list(
+            results, marker, limit, offset, sort_keys, sort_dirs)
+
+    def update_provider_info(self, volumes, snapshots):
+        """Records the cluster of volumes and snapshots without one
+
+        Those were created before datera_clusters was set, on the cluster
+        at san_ip.
+        """
+        if not self.clusters:
+            return None, None
+        volume_clusters = {}
+        volume_updates = []
+        for volume in volumes:
+            driver = (self._get_resource_cluster(volume) or
+                      self.clusters[self.backend_name])
+            volume_clusters[volume['id']] = driver.cluster_name
+            if not volume.get('provider_id', None):
+                volume_updates.append({'id': volume['id'],
+                                       'provider_id': driver.cluster_name})
+        snapshot_updates = [
+            {'id': snapshot['id'],
+             'provider_id': volume_clusters.get(snapshot['volume_id'],
+                                                self.backend_name)}
+            for snapshot in snapshots
+            if not snapshot.get('provider_id', None)]
+        return volume_updates, snapshot_updates
 
     # =================
 
@@ -312,6 +1090,30 @@ class DateraDriver(san.SanISCSIDriver, api21.DateraApi, api22.DateraApi):
     def delete_volume(self, volume):
         pass
 
+    @datc.lookup
+    def reap_deletes(self):
+        """Finish deleting app_instances queued by deferred delete."""
+        pass
+
+    # =================
+    # = QoS Rebalance =
+    # =================
+
+    @datc.lookup
+    def rebalance_qos(self, context, volume_type_id=None, dry_run=False):
+        """Recompute the performance policies of a volume-type's volumes.
+
+        Without a volume_type_id every volume-type is rebalanced.  Returns
+        a report of the changes, which are only reported and not applied
+        when dry_run is set.
+        """
+        pass
+
+    @datc.lookup
+    def check_qos_changes(self):
+        """Rebalance volume-types whose QoS changed since the last check."""
+        pass
+
     # =================
     # = Ensure Export =
     # =================
@@ -621,6 +1423,11 @@ class DateraDriver(san.SanISCSIDriver, api21.DateraApi, api22.DateraApi):
         """
         pass
 
+    @datc.lookup
+    def update_cluster_stats(self):
+        """Fetch fresh cluster stats for get_volume_stats to report."""
+        pass
+
     # =========
     # = Login =
     # =========